@@ -0,0 +1,649 @@
+# -*- coding: utf8 -*-
+
+"""
+Archive reading, consolidation and restoring for simple Backup tool.
+by Tobias Küster, 2026
+
+Reading the zip and (compressed) tar archives created by the backup tool, and
+merging a full backup and the incremental backups following it into a new,
+"synthetic" full backup, without having to read the backed up directory again,
+or restoring the files from such a chain of archives.
+
+Consolidating takes the newest version of each file from the chain of archives
+and drops the files listed as deleted in the incremental archives. The archives
+are read sequentially, one after the other, and when both the source and the
+target are zip files, the already compressed data of each entry is copied as it
+is, without decompressing and compressing it again.
+
+Restoring likewise determines which archive holds the newest version of each
+file, and extracts just those entries, reading the archives in parallel, so each
+file is written only once, instead of extracting all the archives one after the
+other and overwriting files again and again. The members of compressed tar
+archives can only be listed by decompressing the entire archive, so they are
+taken from the catalog, if available; otherwise, such an archive is listed while
+extracting the members not in the newer archives, reading it only once, too.
+
+Archives split into volumes by a sink are read as one archive, given the name of
+their first volume, see backup_sink.
+
+Hard links (link members in tar files, or listed in zip files) are restored and
+consolidated as links to the file they link to, if that is still the same file;
+if it was deleted or replaced since, the first link gets the file's data instead.
+Sparse tar members are written as such again, and when restoring, blocks of zeros
+are skipped, so sparse files become sparse again, see backup_sparse.
+
+Files stored as deltas in incremental archives (see backup_delta) are rebuilt in
+a temporary directory, starting with their version in the last full archive and
+applying the deltas of the archives after it in order, when restoring them or
+consolidating the archives.
+"""
+
+import copy
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Dict, IO, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+import backup_compress
+import backup_sink
+import backup_sparse
+import backup_zip
+from backup_delta import Delta, apply_delta, decode_deltas
+from backup_journal import PART_EXT
+from backup_manifest import DELETED_LIST, DELTA_LIST, HARDLINK_LIST, format_hardlinks, parse_hardlinks
+from backup_stats import ArchiveStats
+
+
+COPY_SIZE = 1 << 20
+
+
+class Member(NamedTuple):
+	"""Class representing a file in an archive, independent of the archive type.
+	"""
+
+	name: str
+	size: int
+	mtime: float
+	mode: int
+	info: Union[zipfile.ZipInfo, tarfile.TarInfo]
+	link: str = ""  # name of the file this is a hard link to, if any
+
+
+class ZipArchive:
+	"""Class for reading zip archives, either decompressing the entries' data or
+	accessing their raw compressed data.
+	"""
+
+	def __init__(self, path: str):
+		self.path = path
+		self.fp = backup_sink.open_volumes(path)
+		try:
+			self.zip_file = zipfile.ZipFile(self.fp)
+		except Exception:
+			self.fp.close()
+			raise
+		self._members = None
+
+	def members(self) -> List[Member]:
+		"""Get all members of the archive, except for the lists of deleted files, deltas
+		and hard links; the latter are included as members with the info of their target.
+		"""
+		if self._members is None:
+			self._members = [Member(i.filename, i.file_size, time.mktime(i.date_time + (0, 0, -1)),
+			                        i.external_attr >> 16, i)
+			                 for i in self.zip_file.infolist()
+			                 if i.filename not in (DELETED_LIST, DELTA_LIST, HARDLINK_LIST) and not i.is_dir()]
+			by_name = {m.name: m for m in self._members}
+			if HARDLINK_LIST in self.zip_file.namelist():
+				links = parse_hardlinks(self.zip_file.read(HARDLINK_LIST))
+				self._members.extend(by_name[target]._replace(name=name, link=target)
+				                     for name, target in links.items() if target in by_name)
+		return self._members
+
+	def deleted(self) -> List[str]:
+		"""Get the list of files deleted since the previous backup, if any."""
+		try:
+			return self.zip_file.read(DELETED_LIST).decode("utf8", "surrogateescape").splitlines()
+		except KeyError:
+			return []
+
+	def deltas(self) -> Dict[str, Delta]:
+		"""Get the files stored as deltas to their previous version, if any."""
+		try:
+			return decode_deltas(self.zip_file.read(DELTA_LIST))
+		except KeyError:
+			return {}
+
+	def is_incremental(self) -> bool:
+		"""Check whether the archive is an incremental backup."""
+		return DELETED_LIST in self.zip_file.namelist()
+
+	def is_listed(self) -> bool:
+		"""Check whether the members can be listed quickly, which is always the case,
+		as they are in the central directory.
+		"""
+		return True
+
+	def iter_data(self, names: Optional[set] = None) -> Iterable[Tuple[Member, IO[bytes]]]:
+		"""Iterate the members (or those with the given names) and their data."""
+		for member in self.members():
+			if names is None or member.name in names:
+				with self.zip_file.open(member.info) as f:
+					yield member, f
+
+	def iter_raw(self, names: Optional[set] = None) -> Iterable[Tuple[Member, IO[bytes]]]:
+		"""Iterate the members (or those with the given names) and their raw, still
+		compressed data, as stored in the zip file.
+		"""
+		with backup_sink.open_volumes(self.path) as f:
+			for member in self.members():
+				if names is None or member.name in names:
+					f.seek(member.info.header_offset)
+					name_len, extra_len = struct.unpack("<2H", f.read(30)[26:30])
+					f.seek(name_len + extra_len, os.SEEK_CUR)
+					yield member, LimitedReader(f, member.info.compress_size)
+
+	def close(self):
+		self.zip_file.close()
+		self.fp.close()
+
+
+class TarArchive:
+	"""Class for reading (compressed) tar archives sequentially, as streams.
+	"""
+
+	def __init__(self, path: str):
+		self.path = path
+		self._members, self._deleted, self._deltas, self._incremental = None, [], {}, False
+
+	def members(self) -> List[Member]:
+		"""Get all members of the archive, except for the lists of deleted files and
+		deltas; for this, the entire archive has to be read once, unless it has been
+		read entirely before, or the members are known already (see use_listing).
+		"""
+		if self._members is None:
+			for _ in self.iter_data(set()):
+				pass
+		return self._members
+
+	def use_listing(self, names: Iterable[str], lists: Dict[str, Optional[bytes]]):
+		"""Take the names of the members and the content of the lists of deleted files,
+		deltas and hard links (None for those the archive does not have) as given,
+		e.g. from the catalog, instead of reading the archive for listing them. The
+		members then have nothing but their names and the files they link to.
+		"""
+		links = parse_hardlinks(lists[HARDLINK_LIST]) if lists.get(HARDLINK_LIST) else {}
+		self._members = [Member(name, 0, 0, 0, None, links.get(name, "")) for name in names]
+		self._incremental = lists.get(DELETED_LIST) is not None
+		self._deleted = lists[DELETED_LIST].decode("utf8", "surrogateescape").splitlines() if self._incremental else []
+		self._deltas = decode_deltas(lists[DELTA_LIST]) if lists.get(DELTA_LIST) else {}
+
+	def is_listed(self) -> bool:
+		"""Check whether the members are known already, or can be listed quickly,
+		i.e. without decompressing the entire archive.
+		"""
+		return self._members is not None or self.codec() not in backup_compress.KNOWN_CODECS
+
+	def codec(self) -> str:
+		"""Get the codec of the archive from its extension."""
+		return backup_sink.archive_name(self.path).rsplit(".", 1)[-1]
+
+	def deleted(self) -> List[str]:
+		"""Get the list of files deleted since the previous backup, if any."""
+		self.members()
+		return self._deleted
+
+	def deltas(self) -> Dict[str, Delta]:
+		"""Get the files stored as deltas to their previous version, if any."""
+		self.members()
+		return self._deltas
+
+	def is_incremental(self) -> bool:
+		"""Check whether the archive is an incremental backup."""
+		self.members()
+		return self._incremental
+
+	def iter_data(self, names: Optional[set] = None) -> Iterable[Tuple[Member, Optional[IO[bytes]]]]:
+		"""Iterate the members (or those with the given names) and their data (or
+		None for members other than regular files, e.g. symlinks and hard links).
+		If not known yet, the members are listed at the same time, so the archive
+		does not have to be read once more for that.
+		"""
+		codec = self.codec()
+		listing = self._members is None
+		members, deleted, deltas, incremental = [], [], {}, False
+		with backup_sink.open_volumes(self.path) as f:
+			# uncompressed tar files are read with random access, skipping the data not needed
+			compressed = codec in backup_compress.KNOWN_CODECS
+			stream = backup_compress.open_decompressed(f, codec) if compressed else f
+			with stream, tarfile.open(fileobj=stream, mode="r|" if compressed else "r:") as tar_file:
+				for info in iter_tar(tar_file):
+					if info.name == DELETED_LIST:
+						deleted = tar_file.extractfile(info).read().decode("utf8", "surrogateescape").splitlines()
+						incremental = True
+					elif info.name == DELTA_LIST:
+						deltas = decode_deltas(tar_file.extractfile(info).read())
+					else:
+						link = info.linkname if info.islnk() else ""
+						member = Member(info.name, info.size, info.mtime, info.mode, info, link)
+						if listing:
+							members.append(member)
+						if names is None or info.name in names:
+							yield member, tar_file.extractfile(info) if info.isreg() else None
+		if listing:
+			self._members, self._deleted, self._deltas, self._incremental = members, deleted, deltas, incremental
+
+	def close(self):
+		pass
+
+
+def iter_tar(tar_file: tarfile.TarFile) -> Iterable[tarfile.TarInfo]:
+	"""Iterate the members of the tar file, like iterating the tar file itself, but
+	without tarfile keeping the infos of all the members read so far.
+	"""
+	while (info := tar_file.next()) is not None:
+		tar_file.members.clear()
+		yield info
+
+
+class LimitedReader:
+	"""File-like object for reading at most the given number of bytes from a file."""
+
+	def __init__(self, fileobj, size: int):
+		self.fp = fileobj
+		self.remaining = size
+
+	def read(self, n=-1) -> bytes:
+		n = self.remaining if n < 0 else min(n, self.remaining)
+		data = self.fp.read(n)
+		self.remaining -= len(data)
+		return data
+
+
+class DeltaArchive:
+	"""Class for rebuilding the selected files stored as deltas in the archives in a
+	temporary directory (see rebuild_deltas), and reading them like the members of
+	an archive, with the modification times and modes of their latest versions.
+	"""
+
+	def __init__(self, archives: List[Union[ZipArchive, TarArchive]], selected: Dict[str, int], tmp_dir: str):
+		self.files, latest = rebuild_deltas(archives, selected, tmp_dir)
+		self._members = [m._replace(size=os.path.getsize(self.files[m.name]), info=None, link="")
+		                 for m in latest.values()]
+
+	def members(self) -> List[Member]:
+		return self._members
+
+	def deleted(self) -> List[str]:
+		return []
+
+	def deltas(self) -> Dict[str, Delta]:
+		return {}
+
+	def iter_data(self, names: Optional[set] = None) -> Iterable[Tuple[Member, IO[bytes]]]:
+		for member in self._members:
+			if names is None or member.name in names:
+				with open(self.files[member.name], "rb") as f:
+					yield member, f
+
+	def close(self):
+		pass
+
+
+def open_archive(path: str) -> Union[ZipArchive, TarArchive]:
+	"""Open zip or (compressed) tar archive, or volume set of one, for reading."""
+	return ZipArchive(path) if is_zip_archive(path) else TarArchive(path)
+
+
+def is_zip_archive(path: str) -> bool:
+	"""Check whether the archive, or volume set, is a zip file."""
+	with backup_sink.open_volumes(path) as f:
+		return zipfile.is_zipfile(f)
+
+
+def select_members(archives: List[Union[ZipArchive, TarArchive]]) -> Dict[str, int]:
+	"""Select the newest version of each file from the chain of archives, i.e. a
+	full backup followed by incremental backups, and leave out files that have
+	been deleted since. Returns the index of the archive to take each file from.
+	"""
+	selected, deleted = {}, set()
+	for i in reversed(range(len(archives))):
+		for member in archives[i].members():
+			if member.name not in selected and member.name not in deleted:
+				selected[member.name] = i
+		# files deleted in this archive still exist in the previous ones
+		deleted.update(archives[i].deleted())
+	return selected
+
+
+def resolve_links(archives: List[Union[ZipArchive, TarArchive]],
+                  selected: Dict[str, int]) -> Tuple[Dict[str, Member], Dict[int, Dict[str, str]]]:
+	"""Resolve the hard links among the selected members of the archives: links to
+	a file selected from the same archive, i.e. still the same file, are kept, as
+	are links to the first of several links to a file deleted or replaced since,
+	which gets the data of that file instead. Returns the links by their names,
+	and for each archive the names of the files whose data is taken for the names
+	of such first links.
+	"""
+	links, renames = {}, {}
+	for k, archive in enumerate(archives):
+		for member in archive.members():
+			if member.link and selected.get(member.name) == k:
+				if selected.get(member.link) == k:
+					links[member.name] = member
+				elif member.link in renames.setdefault(k, {}):
+					links[member.name] = member._replace(link=renames[k][member.link])
+				else:
+					renames[k][member.link] = member.name
+	return links, renames
+
+
+def rebuild_deltas(archives: List[Union[ZipArchive, TarArchive]], selected: Dict[str, int],
+                   tmp_dir: str) -> Tuple[Dict[str, str], Dict[str, Member]]:
+	"""Rebuild the selected files stored as deltas in the temporary directory: their
+	version in the last archive before holding the entire file is extracted, and the
+	deltas of the archives after that are applied to it in order, reading each of
+	the archives only once. If that version is a hard link, the data of the file
+	it links to is used. Returns the paths of the rebuilt files and their latest
+	members (as read from the archives) by their names.
+	"""
+	deltas = [archive.deltas() for archive in archives]
+	contents = [{m.name for m in archive.members()} for archive in archives]
+	links = [{m.name: m.link for m in archive.members() if m.link} for archive in archives]
+	needed: Dict[int, set] = {}
+	for name, k in selected.items():
+		while name in deltas[k]:
+			needed.setdefault(k, set()).add(name)
+			k = next((i for i in reversed(range(k)) if name in contents[i]), None)
+			if k is None:
+				raise ValueError(f"No previous version of {name} for its delta")
+		needed.setdefault(k, set()).add(name)
+		# a hard link in a tar archive has the data of the file it links to
+		if name in links[k]:
+			needed[k].add(links[k][name])
+
+	paths, latest, count = {}, {}, 0
+	for k in sorted(needed):
+		for member, data in archives[k].iter_data(needed[k]):
+			if selected.get(member.name) == k:
+				latest[member.name] = member
+			count += 1
+			path = os.path.join(tmp_dir, str(count))
+			with open(path, "wb") as out:
+				if member.name in deltas[k]:
+					with open(paths[member.name], "rb") as old:
+						apply_delta(old, deltas[k][member.name], data, out)
+					os.remove(paths[member.name])
+				elif data is None:
+					if member.link not in paths:
+						raise ValueError(f"No data for {member.name}, linking to {member.link}")
+					with open(paths[member.link], "rb") as source:
+						shutil.copyfileobj(source, out, COPY_SIZE)
+				else:
+					shutil.copyfileobj(data, out, COPY_SIZE)
+			paths[member.name] = path
+	return {n: p for n, p in paths.items() if n in selected}, latest
+
+
+def consolidate(paths: List[str], target_file: str, level: int = -1, threads: int = None) -> ArchiveStats:
+	"""Merge the chain of archives with the given paths, ordered from the full
+	backup to the latest incremental backup, into a new full archive with the
+	given filename, whose type (zip or tar, possibly compressed) is determined by
+	its extension. Entries of zip archives are copied without recompressing them
+	if the new archive is a zip file, too. The new archive is written to a ".part"
+	file first, which is renamed when complete.
+	"""
+	archives = [open_archive(p) for p in paths]
+	tmp_dir = tempfile.mkdtemp(prefix="backup-consolidate-", dir=os.path.dirname(os.path.abspath(target_file)))
+	try:
+		selected = select_members(archives)
+		links, renames = resolve_links(archives, selected)
+		deltas = {n: i for n, i in selected.items() if n in archives[i].deltas()}
+		names = [{n for n, i in selected.items() if i == k and n not in links and n not in deltas
+		          and n not in renames.get(k, {}).values()} | set(renames.get(k, {})) for k in range(len(archives))]
+		if deltas:
+			archives.append(DeltaArchive(archives, deltas, tmp_dir))
+			names.append(set(deltas))
+		with open(target_file + PART_EXT, "wb") as f:
+			if target_file.endswith(".zip"):
+				stats = write_zip(archives, names, renames, links, f, backup_zip.DEFAULT_LEVEL if level < 0 else level)
+			else:
+				stats = write_tar(archives, names, renames, links, f, target_file.rsplit(".", 1)[-1], level, threads)
+		os.replace(target_file + PART_EXT, target_file)
+		return stats
+	finally:
+		for archive in archives:
+			archive.close()
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def write_zip(archives: List[Union[ZipArchive, TarArchive]], names: List[set], renames: Dict[int, Dict[str, str]],
+              links: Dict[str, Member], fileobj, level: int) -> ArchiveStats:
+	"""Write the selected members of the archives to a new zip file, copying the
+	raw data of zip entries and compressing the data of tar members, and list the
+	hard links at the end.
+	"""
+	writer = backup_zip.ZipWriter(fileobj)
+	stats = ArchiveStats()
+	for k, (archive, selected) in enumerate(zip(archives, names)):
+		rename = renames.get(k, {})
+		if isinstance(archive, ZipArchive):
+			for member, data in archive.iter_raw(selected):
+				zinfo = member.info
+				info = backup_zip.EntryInfo(rename.get(member.name, member.name), member.mtime, member.mode,
+				                            zinfo.compress_type,
+				                            max(zinfo.file_size, zinfo.compress_size) > backup_zip.ZIP64_LIMIT)
+				writer.start_entry(info, zinfo.CRC, zinfo.compress_size, zinfo.file_size)
+				while chunk := data.read(COPY_SIZE):
+					writer.write(chunk)
+				writer.end_entry(zinfo.CRC, zinfo.compress_size, zinfo.file_size)
+				stats.files += 1
+				stats.bytes_in += zinfo.file_size
+				stats.bytes_out += zinfo.compress_size
+		else:
+			for member, data in archive.iter_data(selected):
+				if data is None:
+					continue  # symlinks etc. can not be represented in zip files
+				info = backup_zip.EntryInfo(rename.get(member.name, member.name), member.mtime, member.mode,
+				                            zipfile.ZIP_DEFLATED, member.size * 1.05 > backup_zip.ZIP64_LIMIT)
+				writer.start_entry(info)
+				compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+				crc, compress_size = 0, 0
+				while chunk := data.read(COPY_SIZE):
+					crc = zlib.crc32(chunk, crc)
+					compressed = compressor.compress(chunk)
+					writer.write(compressed)
+					compress_size += len(compressed)
+				compressed = compressor.flush()
+				writer.write(compressed)
+				compress_size += len(compressed)
+				writer.end_entry(crc, compress_size, member.size)
+				stats.files += 1
+				stats.bytes_in += member.size
+				stats.bytes_out += compress_size
+	if links:
+		writer.writestr(HARDLINK_LIST, format_hardlinks({n: m.link for n, m in links.items()}), level=level)
+	writer.close()
+	return stats
+
+
+def write_tar(archives: List[Union[ZipArchive, TarArchive]], names: List[set], renames: Dict[int, Dict[str, str]],
+              links: Dict[str, Member], fileobj, codec: str, level: int, threads: int) -> ArchiveStats:
+	"""Write the selected members of the archives to a new, optionally compressed
+	tar file, decompressing the data of zip entries, and add the hard links at the
+	end, so the files they link to are always before them.
+	"""
+	stats = ArchiveStats()
+	stream = backup_compress.open_compressed(fileobj, codec, level, threads) \
+	         if codec in backup_compress.KNOWN_CODECS else nullcontext(fileobj)
+	with stream as out, tarfile.open(fileobj=out, mode="w|") as tar_file:
+		for k, (archive, selected) in enumerate(zip(archives, names)):
+			rename = renames.get(k, {})
+			for member, data in archive.iter_data(selected):
+				if isinstance(member.info, tarfile.TarInfo):
+					info = copy.copy(member.info)
+					info.name = rename.get(member.name, member.name)
+					# names are taken from the attributes, added to the header again if needed
+					info.pax_headers = {k: v for k, v in info.pax_headers.items() if k not in ("path", "linkpath")}
+				else:
+					info = tarfile.TarInfo(rename.get(member.name, member.name))
+					info.size, info.mtime, info.mode = member.size, member.mtime, member.mode & 0o7777
+				if info.sparse is not None:
+					# the map contains only the data ranges, the holes are read as zeros
+					ranges = [(offset, length) for offset, length in info.sparse if length]
+					info.pax_headers, info.sparse = {}, None
+					if not backup_sparse.add_sparse(tar_file, info, data, ranges):
+						tar_file.addfile(info, data)
+				else:
+					tar_file.addfile(info, data)
+				tar_file.members.clear()  # not needed for writing, see backup_core.forget_member
+				stats.files += 1
+				stats.bytes_in += member.size
+		for member in links.values():
+			info = tarfile.TarInfo(member.name)
+			info.type, info.linkname = tarfile.LNKTYPE, member.link
+			info.mtime, info.mode = member.mtime, member.mode & 0o7777
+			tar_file.addfile(info)
+			stats.files += 1
+	stats.bytes_out = fileobj.tell()
+	return stats
+
+
+def restore(paths: List[str], target_dir: str, names: List[str] = None, threads: int = None,
+            listings: Dict[str, Tuple[List[str], Dict[str, Optional[bytes]]]] = None) -> ArchiveStats:
+	"""Restore the files from the chain of archives with the given paths, ordered
+	from the full backup to the latest incremental backup, to the target directory,
+	using the same relative paths as in the archives. Optionally, only the files
+	with the given names, or in the directories with the given names, are restored;
+	hard links are restored together with the file they link to. The archives are
+	read in parallel, using the given number of threads, starting with the newest:
+	the members of an archive that can not be listed quickly (and are not given
+	in the listings, by path, see TarArchive.use_listing) are extracted while
+	listing it, unless in newer archives, and only then the older archives are
+	started. Such archives are thus read one after the other on the calling thread,
+	as the files of an older archive to be extracted are only known once the newer
+	ones are read completely, while the files of the archives before them are still
+	extracted in the pool. Files stored as deltas are rebuilt afterwards.
+	"""
+	archives = [open_archive(p) for p in paths]
+	try:
+		for path, archive in zip(paths, archives):
+			if isinstance(archive, TarArchive) and path in (listings or {}):
+				archive.use_listing(*listings[path])
+		stats, links, deltas = ArchiveStats(), {}, {}
+		newer = set()  # names of the files in newer archives, or deleted in those
+		with ThreadPoolExecutor(threads or os.cpu_count() or 1) as pool:
+			futures = []
+			for k in reversed(range(len(archives))):
+				archive, listed = archives[k], archives[k].is_listed()
+				if not listed:
+					streamed = extract(archive, Remaining(newer, names), target_dir)
+				available = {m.name for m in archive.members() if m.name not in newer}
+				found, renames = resolve_links([archive], dict.fromkeys(available, 0))
+				wanted = {n for n in available if names is None or matches(n, names)}
+				found = {n: m for n, m in found.items() if n in wanted}
+				selected = wanted | {m.link for m in found.values()}
+				rename = {t: n for t, n in renames.get(0, {}).items() if n in selected}
+				delta_names = selected & set(archive.deltas())
+				files = selected - set(found) - delta_names - set(rename.values()) | set(rename)
+				if not listed:
+					# only files linked to are still missing; files stored as deltas have been
+					# extracted as they are, and are replaced by the rebuilt files below
+					files -= wanted
+					for member in archive.members():
+						if member.name in delta_names:
+							streamed.files -= 1
+							streamed.bytes_out -= member.size
+					stats.add(streamed)
+				if files:
+					futures.append(pool.submit(extract, archive, files, target_dir, rename))
+				links.update(found)
+				deltas.update(dict.fromkeys(delta_names, k))
+				newer.update(m.name for m in archive.members())
+				newer.update(archive.deleted())
+			for future in futures:
+				stats.add(future.result())
+		if deltas:
+			os.makedirs(target_dir, exist_ok=True)
+			tmp_dir = tempfile.mkdtemp(prefix=".backup-delta-", dir=target_dir)
+			try:
+				stats.add(extract(DeltaArchive(archives, deltas, tmp_dir), set(deltas), target_dir))
+			finally:
+				shutil.rmtree(tmp_dir, ignore_errors=True)
+		# the files linked to are all restored now
+		for name, member in links.items():
+			path, source = target_path(target_dir, name), target_path(target_dir, member.link)
+			if path is not None and source is not None and os.path.exists(source):
+				os.makedirs(os.path.dirname(path), exist_ok=True)
+				if os.path.lexists(path):
+					os.remove(path)
+				os.link(source, path)
+				stats.files += 1
+		return stats
+	finally:
+		for archive in archives:
+			archive.close()
+
+
+class Remaining:
+	"""Names of the members to extract from an archive while listing it: those not
+	in the given names of files in newer archives, matching the names to be
+	restored, if any.
+	"""
+
+	def __init__(self, newer: set, names: Optional[List[str]]):
+		self.newer = newer
+		self.names = names
+
+	def __contains__(self, name: str) -> bool:
+		return name not in self.newer and (self.names is None or matches(name, self.names))
+
+
+def extract(archive: Union[ZipArchive, TarArchive], names: set, target_dir: str,
+            renames: Dict[str, str] = None) -> ArchiveStats:
+	"""Extract the files with the given names from the archive to the target
+	directory, optionally with other names, restoring their modes and modification
+	times. Blocks of zeros are not written, so sparse files become sparse again.
+	"""
+	stats = ArchiveStats()
+	renames = renames or {}
+	for member, data in archive.iter_data(names):
+		path = target_path(target_dir, renames.get(member.name, member.name))
+		if path is None:
+			continue  # never write outside of the target directory
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		if os.path.lexists(path):
+			os.remove(path)
+		if data is None:
+			if member.info.issym():
+				os.symlink(member.info.linkname, path)
+			continue
+		with open(path, "wb") as f:
+			backup_sparse.write_sparse(data, f, COPY_SIZE)
+		if member.mode & 0o7777:
+			os.chmod(path, member.mode & 0o7777)
+		os.utime(path, (member.mtime, member.mtime))
+		stats.files += 1
+		stats.bytes_out += member.size
+	return stats
+
+
+def target_path(target_dir: str, name: str) -> Optional[str]:
+	"""Get the path to restore the file with the given name to, or None if that
+	would be outside of the target directory.
+	"""
+	target_dir = os.path.abspath(target_dir)
+	path = os.path.normpath(os.path.join(target_dir, name))
+	return path if path.startswith(os.path.join(target_dir, "")) else None
+
+
+def matches(name: str, names: List[str]) -> bool:
+	"""Check whether the name is one of the given names, or in one of those directories."""
+	return any(name == n or name.startswith(n.rstrip("/") + "/") for n in names)
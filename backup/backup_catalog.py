@@ -0,0 +1,274 @@
+# -*- coding: utf8 -*-
+
+"""
+Catalog of backed up files for simple Backup tool.
+by Tobias Küster, 2026
+
+The catalog is a small SQLite database next to the configuration, listing all
+the files in all the archives (and repository snapshots) created so far: their
+name in the archive, size, modification time, CRC (for zip archives) and the
+offset of their entry in the archive (for zip and uncompressed tar archives),
+together with the archive's path, the directory it is a backup of, when it was
+created, and whether it is an incremental backup. For archives, the lists of
+deleted files, deltas and hard links in them are kept, too, so restoring files
+from compressed tar archives does not require reading them once just for listing
+their members, see backup_archive.restore.
+
+Each archive is added to the catalog right after it has been created, and
+existing archives can be imported once, so finding all versions of a file, or
+all files matching a pattern in the backups made within some time, is a simple
+query, instead of opening (and, for tar, reading) all the archives again. The
+results of verifying the archives are recorded, too, so each archive has to be
+verified only once, see backup_verify.
+"""
+
+import os
+import sqlite3
+import tarfile
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import backup_archive
+import backup_compress
+import backup_repo
+import backup_sink
+import backup_zip
+from backup_delta import decode_deltas, encode_deltas
+from backup_manifest import DELETED_LIST, DELTA_LIST, HARDLINK_LIST, format_hardlinks, parse_hardlinks
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+	id INTEGER PRIMARY KEY,
+	path TEXT UNIQUE NOT NULL,
+	directory TEXT NOT NULL,
+	created REAL NOT NULL,
+	incremental INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+	archive INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+	name TEXT NOT NULL,
+	size INTEGER NOT NULL,
+	mtime REAL NOT NULL,
+	crc INTEGER,
+	offset INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_name ON files(name);
+CREATE TABLE IF NOT EXISTS lists (
+	archive INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+	name TEXT NOT NULL,
+	content BLOB
+);
+CREATE TABLE IF NOT EXISTS verifications (
+	archive INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+	verified REAL NOT NULL,
+	files INTEGER NOT NULL,
+	compared INTEGER NOT NULL,
+	errors TEXT NOT NULL
+);
+"""
+
+
+class CatalogEntry(NamedTuple):
+	"""Class representing a version of a file in one of the archives.
+	"""
+
+	name: str
+	size: int
+	mtime: float
+	crc: Optional[int]
+	offset: Optional[int]   # of the entry's header (zip) or data (tar) in the archive
+	archive: str
+	created: float
+
+
+class Catalog:
+	"""Class for adding archives to the catalog database and querying it.
+	"""
+
+	def __init__(self, filename: str):
+		os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+		# archives of several directories may be added concurrently by different jobs
+		self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+		self.db.execute("PRAGMA foreign_keys = ON")
+		self.db.executescript(SCHEMA)
+
+	def add_archive(self, path: str, directory: str, incremental: bool, entries: Iterable[tuple],
+	                lists: Dict[str, Optional[bytes]] = None, created: float = None):
+		"""Add the archive (replacing it, if already in the catalog) with the given
+		entries, as tuples of name, size, mtime, CRC and offset, and the content of
+		its lists of deleted files, deltas and hard links (None for lists it does
+		not have), if known.
+		"""
+		created = created if created is not None else os.path.getmtime(path) if os.path.exists(path) else time.time()
+		with self.db:
+			self.db.execute("DELETE FROM archives WHERE path = ?", (path,))
+			archive = self.db.execute("INSERT INTO archives (path, directory, created, incremental) VALUES (?, ?, ?, ?)",
+			                          (path, directory, created, incremental)).lastrowid
+			self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+			                    ((archive, *entry) for entry in entries))
+			self.db.executemany("INSERT INTO lists VALUES (?, ?, ?)",
+			                    ((archive, name, content) for name, content in (lists or {}).items()))
+
+	def import_archive(self, path: str, directory: str):
+		"""Read the list of files from an existing archive or repository snapshot
+		and add it to the catalog.
+		"""
+		self.add_archive(path, directory, *read_entries(path))
+
+	def contains(self, path: str) -> bool:
+		"""Check whether the archive with the given path is already in the catalog."""
+		return self.db.execute("SELECT 1 FROM archives WHERE path = ?", (path,)).fetchone() is not None
+
+	def prune(self) -> int:
+		"""Remove archives that do not exist any more from the catalog, returning how many."""
+		missing = [(p,) for p, in self.db.execute("SELECT path FROM archives") if not os.path.exists(p)]
+		with self.db:
+			self.db.executemany("DELETE FROM archives WHERE path = ?", missing)
+		return len(missing)
+
+	def versions(self, name: str, since: float = None, until: float = None) -> List[CatalogEntry]:
+		"""Get all versions of the file with the given name (as in the archives) in
+		archives created in the given time span (if any), ordered by the time the
+		archives were created.
+		"""
+		return self._query("f.name = ?", name, since, until)
+
+	def search(self, pattern: str, since: float = None, until: float = None) -> List[CatalogEntry]:
+		"""Get all files whose names match the glob pattern in archives created in
+		the given time span (if any), ordered by name and the time of the archive.
+		"""
+		return self._query("f.name GLOB ?", pattern, since, until)
+
+	def _query(self, condition: str, arg: str, since: Optional[float], until: Optional[float]) -> List[CatalogEntry]:
+		since, until = since if since is not None else 0, until if until is not None else float("inf")
+		return [CatalogEntry(*row) for row in self.db.execute(
+			f"SELECT f.name, f.size, f.mtime, f.crc, f.offset, a.path, a.created "
+			f"FROM files f JOIN archives a ON f.archive = a.id "
+			f"WHERE {condition} AND a.created BETWEEN ? AND ? ORDER BY f.name, a.created", (arg, since, until))]
+
+	def entries(self, path: str) -> List[CatalogEntry]:
+		"""Get all files in the archive with the given path."""
+		return self._query("a.path = ?", path, None, None)
+
+	def lists(self, path: str) -> Optional[Dict[str, Optional[bytes]]]:
+		"""Get the lists of deleted files, deltas and hard links of the archive with
+		the given path, see add_archive, or None if those are not in the catalog.
+		"""
+		rows = self.db.execute("SELECT l.name, l.content FROM lists l JOIN archives a ON l.archive = a.id "
+		                       "WHERE a.path = ?", (path,)).fetchall()
+		return dict(rows) if rows else None
+
+	def unverified(self, directory: str) -> List[Tuple[str, float]]:
+		"""Get the paths and creation times of the archives of the directory that
+		have not been verified successfully yet, ordered by the time they were created.
+		"""
+		return self.db.execute(
+			"SELECT a.path, a.created FROM archives a WHERE a.directory = ? AND NOT EXISTS "
+			"(SELECT 1 FROM verifications v WHERE v.archive = a.id AND v.errors = '') ORDER BY a.created",
+			(directory,)).fetchall()
+
+	def add_verification(self, path: str, files: int, compared: int, errors: List[str]):
+		"""Record the result of verifying the archive: the number of files checked,
+		how many of those were compared to the source, and the errors found, if any.
+		"""
+		with self.db:
+			self.db.execute("INSERT INTO verifications SELECT id, ?, ?, ?, ? FROM archives WHERE path = ?",
+			                (time.time(), files, compared, "\n".join(errors), path))
+
+	def close(self):
+		self.db.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+def read_entries(path: str) -> Tuple[bool, Iterable[tuple], Optional[Dict[str, Optional[bytes]]]]:
+	"""Read whether the archive or repository snapshot is incremental, the entries
+	of its files, as tuples of name, size, mtime, CRC and offset, and the lists of
+	deleted files, deltas and hard links (for archives). Files stored as deltas are
+	listed with their actual size, but without CRC and offset, as those are of the
+	delta's data.
+	"""
+	if path.endswith(".snapshot"):
+		return False, ((f["name"], f["size"], f["mtime_ns"] / 1e9, None, None) for f in backup_repo.iter_files(path)), None
+	if backup_archive.is_zip_archive(path):
+		return read_zip_entries(path)
+	archive = backup_archive.TarArchive(path)
+	if archive.codec() not in backup_compress.KNOWN_CODECS:
+		return read_tar_entries(path)
+	# compressed tar archives are read only once, keeping their members meanwhile
+	deltas = archive.deltas()
+	entries = [(m.name, deltas[m.name].size if m.name in deltas else m.size, m.mtime, None, None)
+	           for m in archive.members()]
+	links = {m.name: m.link for m in archive.members() if m.link}
+	deleted = "".join(f + "\n" for f in archive.deleted()).encode("utf8", "surrogateescape")
+	lists = {DELETED_LIST: deleted if archive.is_incremental() else None,
+	         DELTA_LIST: encode_deltas(deltas) if deltas else None,
+	         HARDLINK_LIST: format_hardlinks(links) if links else None}
+	return archive.is_incremental(), entries, lists
+
+
+def read_tar_entries(path: str) -> Tuple[bool, Iterable[tuple], Dict[str, Optional[bytes]]]:
+	"""Read whether the uncompressed tar archive is incremental, the entries of its
+	files and its lists, like read_entries, but reading the headers one at a time
+	(see backup_archive.iter_tar), as the archive may hold millions of files: first
+	for the lists, which are at the end of the archive, and then for the entries.
+	"""
+	special = (DELETED_LIST, DELTA_LIST)
+	lists, links = dict.fromkeys((DELETED_LIST, DELTA_LIST, HARDLINK_LIST)), {}
+	with backup_sink.open_volumes(path) as f, tarfile.open(fileobj=f, mode="r:") as tar_file:
+		for info in backup_archive.iter_tar(tar_file):
+			if info.name in special:
+				lists[info.name] = tar_file.extractfile(info).read()
+			elif info.islnk():
+				links[info.name] = info.linkname
+	deltas = decode_deltas(lists[DELTA_LIST]) if lists[DELTA_LIST] is not None else {}
+	lists[HARDLINK_LIST] = format_hardlinks(links) if links else None
+
+	def entries():
+		with backup_sink.open_volumes(path) as f, tarfile.open(fileobj=f, mode="r:") as tar_file:
+			for info in backup_archive.iter_tar(tar_file):
+				if info.name in deltas:
+					yield info.name, deltas[info.name].size, info.mtime, None, None
+				elif info.name not in special:
+					yield info.name, info.size, info.mtime, None, info.offset_data
+
+	return lists[DELETED_LIST] is not None, entries(), lists
+
+
+def read_zip_entries(path: str) -> Tuple[bool, Iterable[tuple], Dict[str, Optional[bytes]]]:
+	"""Read whether the zip archive is incremental, the entries of its files and
+	its lists, like read_entries, but reading the central directory one record at
+	a time (see backup_zip.iter_central), as the archive may hold millions of files.
+	Hard links listed in the archive are included with the CRC and offset of their
+	target.
+	"""
+	special = (DELETED_LIST, DELTA_LIST, HARDLINK_LIST)
+	with backup_sink.open_volumes(path) as f:
+		records = {r.name: r for r in backup_zip.iter_central(f) if r.name in special}
+		lists = {n: backup_zip.read_entry(f, records[n]) if n in records else None for n in special}
+	deltas = decode_deltas(lists[DELTA_LIST]) if lists[DELTA_LIST] is not None else {}
+	links = parse_hardlinks(lists[HARDLINK_LIST]) if lists[HARDLINK_LIST] is not None else {}
+
+	def entries():
+		targets, linked = {}, set(links.values())
+		with backup_sink.open_volumes(path) as f:
+			for r in backup_zip.iter_central(f):
+				if r.name in special or r.name.endswith("/"):
+					continue
+				if r.name in linked:
+					targets[r.name] = r
+				if r.name in deltas:
+					yield r.name, deltas[r.name].size, r.mtime, None, None
+				else:
+					yield r.name, r.file_size, r.mtime, r.crc, r.header_offset
+		for name, target in links.items():
+			if target in targets:
+				r = targets[target]
+				yield name, r.file_size, r.mtime, r.crc, r.header_offset
+
+	return lists[DELETED_LIST] is not None, entries(), lists
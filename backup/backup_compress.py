@@ -0,0 +1,141 @@
+# -*- coding: utf8 -*-
+
+"""
+Compressed streams for simple Backup tool.
+by Tobias Küster, 2026
+
+File-like objects for writing gzip, xz, and zstd compressed tar files using
+several threads. For gzip and xz, the data is split into blocks that are
+compressed independently in a pool of threads and written in order: for gzip,
+all blocks are raw deflate streams ended with a sync-flush, forming a single
+deflate stream within a single gzip member (like pigz does); for xz, each block
+is a complete xz stream, and concatenated streams are valid xz files, too. The
+zstd compressor has its own worker threads, but requires the optional zstandard
+module to be installed. For reading such files, e.g. for restoring or
+consolidating backups, the files are decompressed as streams.
+"""
+
+import gzip
+import lzma
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+
+CODEC_GZ = "gz"
+CODEC_XZ = "xz"
+CODEC_ZST = "zst"
+KNOWN_CODECS = (CODEC_GZ, CODEC_XZ, CODEC_ZST)
+
+DEFAULT_LEVELS = {CODEC_GZ: 6, CODEC_XZ: 6, CODEC_ZST: 3}
+BLOCK_SIZES = {CODEC_GZ: 1 << 20, CODEC_XZ: 1 << 22}
+
+
+class ParallelWriter:
+	"""File-like object compressing all data written to it in blocks, using a pool
+	of threads, and writing the compressed blocks to the underlying file object.
+	"""
+
+	def __init__(self, fileobj, codec: str, level: int = -1, threads: int = None):
+		self.fp = fileobj
+		self.codec = codec
+		self.level = DEFAULT_LEVELS[codec] if level < 0 else level
+		self.threads = threads or os.cpu_count() or 1
+		self.block_size = BLOCK_SIZES[codec]
+		self.pool = ThreadPoolExecutor(self.threads)
+		self.in_flight = deque()
+		self.buffer = bytearray()
+		self.crc, self.size = 0, 0
+		if codec == CODEC_GZ:
+			self.fp.write(struct.pack("<2sBBLBB", b"\x1f\x8b", 8, 0, int(time.time()), 0, 3))
+
+	def write(self, data: bytes) -> int:
+		"""Add data to the current block, and compress the block when it is full."""
+		self.buffer += data
+		while len(self.buffer) >= self.block_size:
+			self._submit(bytes(self.buffer[:self.block_size]))
+			del self.buffer[:self.block_size]
+		return len(data)
+
+	def _submit(self, block: bytes):
+		self.in_flight.append((block, self.pool.submit(compress_block, self.codec, block, self.level)))
+		if len(self.in_flight) > 2 * self.threads:
+			self._write_next()
+
+	def _write_next(self):
+		block, future = self.in_flight.popleft()
+		self.fp.write(future.result())
+		self.crc = zlib.crc32(block, self.crc)
+		self.size += len(block)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, *args):
+		"""Close the writer, or after an error only stop the pool of threads, without
+		writing the remaining data.
+		"""
+		if exc_type is None:
+			self.close()
+		else:
+			self.pool.shutdown(cancel_futures=True)
+
+	def close(self):
+		"""Compress and write the remaining data and the trailer, if any. The
+		underlying file object is not closed.
+		"""
+		if self.buffer:
+			self._submit(bytes(self.buffer))
+			self.buffer.clear()
+		while self.in_flight:
+			self._write_next()
+		self.pool.shutdown()
+		if self.codec == CODEC_GZ:
+			# empty final block ending the deflate stream, followed by crc and size
+			self.fp.write(zlib.compressobj(self.level, zlib.DEFLATED, -15).flush(zlib.Z_FINISH))
+			self.fp.write(struct.pack("<2L", self.crc, self.size & 0xFFFFFFFF))
+
+
+def compress_block(codec: str, block: bytes, level: int) -> bytes:
+	"""Compress a single block, so it can be concatenated with the other blocks."""
+	if codec == CODEC_GZ:
+		compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+		return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+	return lzma.compress(block, format=lzma.FORMAT_XZ, preset=level)
+
+
+def open_compressed(fileobj, codec: str, level: int = -1, threads: int = None):
+	"""Get a file-like object for writing data compressed with the given codec and
+	level (or the codec's default level) to the given file object using the given
+	number of threads. The returned object has to be closed (or used as a context
+	manager) to write any remaining data, but does not close the underlying file
+	object.
+	"""
+	if codec != CODEC_ZST:
+		return ParallelWriter(fileobj, codec, level, threads)
+	if zstandard is None:
+		raise Exception("The 'zstandard' module is required for zstd-compressed archives")
+	level = DEFAULT_LEVELS[codec] if level < 0 else level
+	compressor = zstandard.ZstdCompressor(level=level, threads=threads or -1)
+	return compressor.stream_writer(fileobj, closefd=False)
+
+
+def open_decompressed(fileobj, codec: str):
+	"""Get a file-like object for reading data compressed with the given codec
+	from the given file object, e.g. for reading compressed tar files as streams.
+	"""
+	if codec == CODEC_GZ:
+		return gzip.GzipFile(fileobj=fileobj, mode="rb")
+	if codec == CODEC_XZ:
+		return lzma.LZMAFile(fileobj, "rb")
+	if zstandard is None:
+		raise Exception("The 'zstandard' module is required for zstd-compressed archives")
+	return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
@@ -10,85 +10,608 @@ the actual backup-creation, this also provides helper methods for determining
 when a file was changed and whether a new backup is due.
 """
 
+import glob
 import os
+import queue
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import replace
 from datetime import datetime as dt
-from typing import Iterable
-from tarfile import TarFile
-from zipfile import ZipFile, ZIP_DEFLATED
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from io import BytesIO
+from tarfile import TarFile, TarInfo
 
+import backup_archive
+import backup_catalog
+import backup_compress
+import backup_io
+import backup_manifest
 import backup_model
+import backup_repo
+import backup_sink
+import backup_sparse
+import backup_verify
+import backup_watch
+import backup_zip
+from backup_catalog import Catalog
+from backup_compress import KNOWN_CODECS
+from backup_delta import DeltaSet, encode_deltas
+from backup_journal import Checkpoint, Journal, PART_EXT
+from backup_scan import Cancelled, FileEntry, Snapshot, total_size
+from backup_manifest import DELETED_LIST, DELTA_LIST, HARDLINK_LIST, find_hardlinks, format_hardlinks
+from backup_stats import ArchiveStats, BackupEvent, format_size, EVENT_CANCELLED, EVENT_DONE, EVENT_FILE, \
+                         EVENT_FINISH, EVENT_SKIP, EVENT_START
 from backup_model import Directory, Configuration
 import config
 
 
 TYPE_ZIP = "zip"
 TYPE_TAR = "tar"
-KNOWN_TYPES = (TYPE_ZIP, TYPE_TAR)
+TYPE_AUTO = "auto"
+TYPE_TGZ = "tar.gz"
+TYPE_TXZ = "tar.xz"
+TYPE_TZST = "tar.zst"
+TYPE_REPO = "repo"
+KNOWN_TYPES = (TYPE_ZIP, TYPE_TAR, TYPE_AUTO, TYPE_TGZ, TYPE_TXZ, TYPE_TZST, TYPE_REPO)
+
+# file extensions for archive types not being the extension itself
+EXTENSIONS = {TYPE_AUTO: TYPE_ZIP, TYPE_REPO: "snapshot"}
 
 
 # BACKUP CREATION
 
-def perform_backup_iter(conf: Configuration) -> Iterable[str]:
+def perform_backup_iter(conf: Configuration, jobs: int = None) -> Iterable[str]:
 	"""Perform the backup, creating archive files of all directories to be
 	included in the backup and moving those archives to the appointed target.
-	This function is a generator/iterator, yielding after each directory.
+	This function is a generator/iterator, yielding a message before each
+	directory and at the end; see perform_backup_events for more details.
+	"""
+	for event in perform_backup_events(conf, jobs):
+		if event.kind not in (EVENT_FILE, EVENT_FINISH):
+			yield str(event)
+
+
+def perform_backup_events(conf: Configuration, jobs: int = None,
+                          cancel: threading.Event = None) -> Iterable[BackupEvent]:
+	"""Perform the backup like perform_backup_iter, but yield progress events when
+	a directory is started, skipped, or finished, and for each file added to an
+	archive, holding the number of files and bytes processed so far, the total
+	size of the files to be backed up, and the time spent in the different phases.
+	With more than one job, several directories are backed up concurrently, see
+	perform_parallel_iter. Each directory is scanned by its own job, so the total
+	size (and the estimated remaining time) includes the directories started so
+	far, and grows as further directories are started.
+
+	The progress is recorded in a journal, so if the backup is interrupted, the
+	next run continues where this one stopped, see backup_journal. The backup can
+	be cancelled by setting the given event, in which case the last event is of
+	kind EVENT_CANCELLED instead of EVENT_DONE.
 	"""
+	jobs = jobs or conf.jobs
+	start = time.perf_counter()
+	stats, phases = ArchiveStats(), {}
+	progress = BackupEvent(EVENT_FILE)
+
+	conf.apply_excludes()
+	backup_io.configure(conf.read_buffer, conf.drop_cache)
+
+	# restore time of last backup of directories finished in an interrupted run
+	journal = Journal.open(config.JOURNAL_FILE, conf.target_pattern)
 	for directory in conf.directories:
-		if directory.include and any(directory.iter_include()):
-			yield f"Backing up {directory.path}"
-			backup_directory(conf, directory)
-			directory.last_backup = dt.now().timestamp()
-		else:
-			yield f"Skipping {directory.path}"
-	yield "Done"
+		finished = journal.finished.get(directory.path, journal.stale_finished.get(directory.path))
+		if finished is not None:
+			directory.last_backup = max(directory.last_backup, finished)
+
+	kind = EVENT_CANCELLED
+	try:
+		for event in perform_parallel_iter(conf, jobs, stats, journal, cancel):
+			if event.kind == EVENT_START:
+				progress.bytes_total += event.bytes_total
+			if event.kind == EVENT_FILE:
+				progress.files += 1
+				progress.bytes_in += event.bytes_in
+			if event.kind == EVENT_FINISH:
+				progress.bytes_out += event.stats.bytes_out
+				for name, seconds in event.phases.items():
+					phases[name] = phases.get(name, 0.0) + seconds
+			yield replace(event, files=progress.files, bytes_in=progress.bytes_in, bytes_out=progress.bytes_out,
+			              bytes_total=progress.bytes_total, elapsed=time.perf_counter() - start)
+		kind = EVENT_DONE
+	except Cancelled:
+		pass
+	finally:
+		# the journal is kept for resuming the backup, unless it is complete
+		journal.close(remove=kind == EVENT_DONE)
+	yield BackupEvent(kind, "", progress.files, progress.bytes_in, progress.bytes_out,
+	                  progress.bytes_total, time.perf_counter() - start, phases, stats)
+
+
+def perform_parallel_iter(conf: Configuration, jobs: int, stats: ArchiveStats, journal: Journal = None,
+                          cancel: threading.Event = None) -> Iterable[BackupEvent]:
+	"""Back up up to the given number of directories at once, each in its own
+	thread, yielding the events of backup_directory_iter when they come in.
+	The directories are grouped by the devices they are read from and written to:
+	a new backup is only started if no other running backup is reading from its
+	source device or writing to it, and does not write to the device another
+	backup is reading from, so each disk is read sequentially by a single job.
+	When the cancel event is set, no new backups are started and the running ones
+	stop at the next file, raising Cancelled.
+	"""
+	pending = [(i, d) for i, d in enumerate(conf.directories)]
+	running = {}  # index -> (source devices, target devices)
+	results = queue.Queue()
+	dir_stats = [ArchiveStats() for _ in pending]
+	cancelled = False
+
+	def worker(i, directory):
+		def report(entry):
+			if cancel is not None and cancel.is_set():
+				raise Cancelled(entry.path)
+			results.put((i, BackupEvent(EVENT_FILE, entry.path, bytes_in=entry.size), None))
+		try:
+			for event in backup_directory_iter(conf, directory, dir_stats[i], report, journal, jobs):
+				results.put((i, event, None))
+			results.put((i, None, None))
+		except BaseException as e:
+			results.put((i, None, e))
+
+	def conflicts(src, tgt):
+		return any(src & (src2 | tgt2) or tgt & src2 for src2, tgt2 in running.values())
+
+	with ThreadPoolExecutor(jobs) as pool:
+		while pending or running:
+			if cancel is not None and cancel.is_set() and pending:
+				pending.clear()
+				cancelled = True
+			for i, directory in list(pending):
+				if len(running) >= jobs:
+					break
+				if not directory.include:
+					pending.remove((i, directory))
+					yield BackupEvent(EVENT_SKIP, directory.path)
+					continue
+				src = {get_device(directory.path)} - {None}
+				tgt = {get_device(get_target_file(conf, directory))} - {None}
+				if not conflicts(src, tgt):
+					pending.remove((i, directory))
+					running[i] = (src, tgt)
+					pool.submit(worker, i, directory)
+			if running:
+				i, event, error = results.get()
+				if error is not None:
+					raise error
+				if event is None:
+					del running[i]
+					stats.add(dir_stats[i])
+				else:
+					yield event
+	if cancelled:
+		raise Cancelled()
+
+
+def backup_directory_iter(conf: Configuration, directory: Directory, stats: ArchiveStats,
+                          report: Callable[[FileEntry], None] = None, journal: Journal = None,
+                          jobs: int = None) -> Iterable[BackupEvent]:
+	"""Back up a single directory if it is included in the backup and there are any
+	files to be archived, yielding an event with the total size of those files
+	before starting the backup (so scanning is done by the job itself), and update
+	the time of the last backup and the manifest, and the given stats afterwards,
+	yielding another event with the stats and the time spent in each phase. The
+	report function, if any, is called for each file added to the archive, and
+	the progress is recorded in the journal, if any; directories already finished
+	according to the journal are skipped. The number of jobs, if given, overrides
+	the one of the configuration, see backup_directory.
+	"""
+	if journal is not None and directory.path in journal.finished:
+		yield BackupEvent(EVENT_SKIP, directory.path)
+		return
 
+	# the directory is scanned only once (or not at all, if this was already done
+	# in update_includes) and the snapshot is shared by all of the following
+	t0 = time.perf_counter()
+	if directory.include and (any(directory.iter_include()) or
+	                          directory.incremental and directory.deleted_files()):
+		size = total_size(directory.include_entries())
+		t1 = time.perf_counter()
+		yield BackupEvent(EVENT_START, directory.path, bytes_total=size)
+		dir_stats = backup_directory(conf, directory, report, journal, jobs)
+		t2 = time.perf_counter()
+		directory.last_backup = dt.now().timestamp()
+		directory.update_manifest()
+		backup_watch.mark_clean(config.DIRTY_FILE, directory.path, directory.snapshot_time())
+		if journal is not None:
+			journal.finish(directory.path, directory.last_backup)
+		t3 = time.perf_counter()
+		stats.add(dir_stats)
+		yield BackupEvent(EVENT_FINISH, directory.path, phases={"scan": t1 - t0, "archive": t2 - t1, "manifest": t3 - t2},
+		                  stats=dir_stats)
+	else:
+		yield BackupEvent(EVENT_SKIP, directory.path)
 
-def backup_directory(conf: Configuration, directory: Directory):
+
+def backup_directory(conf: Configuration, directory: Directory, report: Callable[[FileEntry], None] = None,
+                     journal: Journal = None, jobs: int = None) -> ArchiveStats:
 	"""Perform the backup for a single directory and move the resulting archive
-	to the given target directory.
+	to the given target directory, calling the report function, if any, for each
+	file when it is added to the archive. The archive is written to a ".part" file
+	first, continuing the one of an interrupted run according to the journal,
+	if any, and renamed when complete, or written to the configured sink. The
+	CPU cores are shared by the given number of jobs (or those configured).
 	"""
-	target_file = get_target_file(conf, directory)
+	target_file = journal is not None and journal.target_file(directory.path, directory.archive_type) \
+	              or get_target_file(conf, directory)
 
 	tgt_parent, _ = os.path.split(target_file)
 	os.makedirs(tgt_parent, exist_ok=True)
 
 	archive_actions = {
 		TYPE_ZIP: create_zip,
-		TYPE_TAR: create_tar
+		TYPE_TAR: create_tar,
+		TYPE_AUTO: create_auto,
+		TYPE_TGZ: create_tar,
+		TYPE_TXZ: create_tar,
+		TYPE_TZST: create_tar,
 	}
+
+	# share the CPU cores between the directories being backed up concurrently
+	threads = max(1, (os.cpu_count() or 1) // (jobs or conf.jobs))
+
+	# snapshots in the repository always list all the files, since files already
+	# stored there (i.e. not changed since the last snapshot) are not stored again
+	if directory.archive_type == TYPE_REPO:
+		files = report_files(directory.iter_members(all_files=True), report)
+		if journal is not None:
+			journal.checkpoint(directory.path, target_file, directory.archive_type)
+		repo = backup_repo.get_repository(re.sub(r"^~", config.USER_DIR, conf.target_pattern))
+		stats = backup_repo.write_snapshot(directory.path, files, target_file, repo,
+		                                   threads=threads, level=directory.compression_level)
+		catalog_archive(directory, target_file)
+		return stats
+
+	# incremental backups also list the files deleted since the last backup
+	extra = {}
+	if directory.incremental:
+		deleted = directory.to_relative(directory.deleted_files())
+		extra[DELETED_LIST] = "".join(f + "\n" for f in deleted).encode("utf8", "surrogateescape")
+
+	checkpoint = journal.checkpoint(directory.path, target_file, directory.archive_type) \
+	             if journal is not None else Checkpoint()
+	# zip files can not hold hard links, so further links to the same file are listed instead
+	links = {}
+	if directory.archive_type in (TYPE_ZIP, TYPE_AUTO):
+		links = find_hardlinks(directory.iter_members())
+		if links:
+			extra[HARDLINK_LIST] = format_hardlinks(links)
+
+	# large files changed since the last backup may be stored as deltas to that
+	deltas = DeltaSet(directory.path, directory.delta_size, tgt_parent) if directory.delta_size else None
+	if deltas is not None and directory.incremental:
+		deltas.prepare(m for m in directory.iter_members() if m[1] not in links)
+		if deltas.deltas:
+			extra[DELTA_LIST] = encode_deltas(deltas.deltas)
+
+	# with a sink other than the local file system, or split into volumes, the archive
+	# is written through the sink's pipe, and can not be continued if interrupted
+	sink = conf.sink != backup_sink.SINK_LOCAL or conf.volume_size
+	# files skipped when resuming a partial archive are not in the written files, but
+	# zip and uncompressed tar archives can be listed quickly, without reading the data,
+	# so the written files are only kept (in a temporary file, see Snapshot) if needed
+	readable = directory.archive_type in (TYPE_ZIP, TYPE_AUTO, TYPE_TAR) and not sink
+	written = Snapshot() if deltas is not None or not readable else None
+
 	function = archive_actions[directory.archive_type]
+	files = (m for m in report_files(directory.iter_members(), report, written) if m[1] not in links)
+	if deltas is not None:
+		files = deltas.substitute(files)
+
+	if sink:
+		checkpoint = Checkpoint(opener=backup_sink.get_sink(conf.sink, conf.volume_size).open)
+	# with hash_check, the files' hashes for the manifest are calculated while archiving them
+	checkpoint.hashes = {} if directory.hash_check else None
+
+	try:
+		if sink:
+			stats = function(files, target_file, extra, threads, directory.compression_level, checkpoint)
+			# volume sets are cataloged under the name of their first volume
+			target_file = checkpoint.fp.commit()[0]
+		else:
+			stats = function(files, target_file + PART_EXT, extra, threads, directory.compression_level, checkpoint)
+			os.replace(target_file + PART_EXT, target_file)
+		# the CRCs of files stored as deltas are those of the deltas' data
+		catalog_archive(directory, target_file, None if readable else written, checkpoint.crcs,
+		                set(deltas.deltas) if deltas is not None else set(), extra)
+		if deltas is not None:
+			deltas.update(directory.scan(), directory.iter_members(), directory.to_members(written))
+		if checkpoint.hashes:
+			directory.hashes().update(checkpoint.hashes)
+	finally:
+		if deltas is not None:
+			deltas.close()
+	return stats
+
+
+def catalog_archive(directory: Directory, target_file: str, written: Snapshot = None,
+                    crcs: Sequence[int] = (), skip_crcs: Set[str] = frozenset(), extra: Dict[str, bytes] = None):
+	"""Add the archive just created to the catalog, either reading its list of files
+	(with CRCs and offsets, if available) or taking the given files written to it,
+	adding the CRCs calculated while writing the files (for tar archives), if any,
+	in the order of the files in the archive, except for the files with the given
+	names. In the latter case, the lists of deleted files and deltas are taken from
+	the additional members written, and the hard links are found among the files.
+	"""
+	with Catalog(config.CATALOG_FILE) as catalog:
+		if written is None:
+			incremental, entries, lists = backup_catalog.read_entries(target_file)
+		else:
+			incremental = directory.incremental
+			links = find_hardlinks(directory.to_members(written))
+			lists = {DELETED_LIST: (extra or {}).get(DELETED_LIST), DELTA_LIST: (extra or {}).get(DELTA_LIST),
+			         HARDLINK_LIST: format_hardlinks(links) if links else None}
+			entries = ((name, entry.size, entry.mtime_ns / 1e9, None, None)
+			           for entry, name in directory.to_members(written))
+		entries = (e[:3] + (crcs[i],) + e[4:] if i < len(crcs) and crcs[i] >= 0 and e[0] not in skip_crcs else e
+		           for i, e in enumerate(entries))
+		catalog.add_archive(target_file, directory.path, incremental, entries, lists)
+
+
+def create_zip(files: Iterable[Tuple[FileEntry, str]], target_file: str, extra: Dict[str, bytes] = None,
+               threads: int = None, level: int = -1, checkpoint: Checkpoint = None, auto=False) -> ArchiveStats:
+	"""Create zip file using given filename containing the given files, as pairs
+	of snapshot entry and name in the archive, plus additional members with the
+	given names and content. The files are compressed in parallel using the given
+	number of threads and compression level, see backup_zip. If a checkpoint is
+	given, a partial zip file is continued and the files written are recorded.
+	"""
+	level = backup_zip.DEFAULT_LEVEL if level < 0 else level
+	checkpoint = checkpoint or Checkpoint()
+	f, files = checkpoint.open(target_file, files)
+	with f:
+		try:
+			stats = backup_zip.write_zip(files, f, level=level, threads=threads, extra=extra, auto=auto,
+			                             checkpoint=checkpoint)
+			backup_io.finish_target(f)
+			return stats
+		finally:
+			checkpoint.sync()
 
-	cwd = os.path.abspath(".")
-	os.chdir(directory.parent())
-	function(directory.to_relative(directory.iter_include()), target_file)
-	os.chdir(cwd)
 
+def create_auto(files: Iterable[Tuple[FileEntry, str]], target_file: str, extra: Dict[str, bytes] = None,
+                threads: int = None, level: int = -1, checkpoint: Checkpoint = None) -> ArchiveStats:
+	"""Create zip file like create_zip, but store files that can not be compressed
+	instead of deflating them.
+	"""
+	return create_zip(files, target_file, extra, threads, level, checkpoint, auto=True)
+
+
+def create_tar(files: Iterable[Tuple[FileEntry, str]], target_file: str, extra: Dict[str, bytes] = None,
+               threads: int = None, level: int = -1, checkpoint: Checkpoint = None) -> ArchiveStats:
+	"""Create tar file using given filename containing the given files, as pairs
+	of snapshot entry and name in the archive, plus additional members with the
+	given names and content. The tar file is compressed if the filename has the
+	extension of one of the known codecs, using the given number of threads and
+	compression level, see backup_compress. If a checkpoint is given, a partial
+	(uncompressed) tar file is continued and the files written are recorded.
+	"""
+	stats = ArchiveStats()
+	codec = target_file.removesuffix(PART_EXT).rsplit(".", 1)[-1]
+	checkpoint = checkpoint or Checkpoint()
+	f, files = checkpoint.open(target_file, files, resumable=codec not in KNOWN_CODECS)
+	with f:
+		try:
+			start = f.tell()
+			# the compressing stream (and its threads) is closed also if writing the archive fails
+			stream = backup_compress.open_compressed(f, codec, level, threads) if codec in KNOWN_CODECS else nullcontext(f)
+			with stream as out, TarFile.open(fileobj=out, mode="w|", copybufsize=backup_io.settings.buffer_size) as tar_file:
+				for entry, arcname in files:
+					hasher = backup_manifest.new_hash() if checkpoint.hashes is not None else None
+					crc = add_to_tar(tar_file, entry, arcname, hasher)
+					forget_member(tar_file, entry)
+					# the hash is complete only if the entire file was read
+					digest = backup_manifest.final_hash(hasher, entry) if hasher is not None and crc is not None else None
+					checkpoint.add(entry, arcname, start + tar_file.offset, crc=crc, digest=digest)
+					stats.files += 1
+					stats.bytes_in += entry.size
+				for name, data in (extra or {}).items():
+					info = TarInfo(name)
+					info.size, info.mtime = len(data), dt.now().timestamp()
+					tar_file.addfile(info, BytesIO(data))
+			stats.bytes_out = f.tell()
+			backup_io.finish_target(f)
+		finally:
+			checkpoint.sync()
+	return stats
+
+
+def add_to_tar(tar_file: TarFile, entry: FileEntry, arcname: str, hasher=None) -> Optional[int]:
+	"""Add the file to the tar archive, reading it with a large buffer and without
+	keeping it in the page cache, see backup_io. Sparse files are added as sparse
+	members, reading only their data, see backup_sparse; further hard links to a
+	file already in the archive are added as links (by tarfile itself). Returns
+	the CRC32 of the data added, if a regular (not sparse) member was added; the
+	data is also added to the hash object, if any.
+	"""
+	info = tar_file.gettarinfo(entry.path, arcname)
+	if info.isreg():
+		with backup_io.open_source(entry.path, checksum=True, hasher=hasher) as f:
+			if backup_sparse.maybe_sparse(entry):
+				ranges = backup_sparse.data_ranges(f.fileno(), info.size)
+				if backup_sparse.has_holes(ranges, info.size) and backup_sparse.add_sparse(tar_file, info, f, ranges):
+					return None
+			tar_file.addfile(info, f)
+			return f.crc
+	tar_file.addfile(info)
+	return None
+
+
+def forget_member(tar_file: TarFile, entry: FileEntry):
+	"""Drop what the tar file remembers about the file just added: tarfile keeps
+	the infos of all members, and the inodes of all files for detecting hard links,
+	so memory would grow with the number of files; only the inodes of files with
+	further links are still needed.
+	"""
+	tar_file.members.clear()
+	if entry.nlink <= 1:
+		tar_file.inodes.pop((entry.ino, entry.dev), None)
+
+
+# CONSOLIDATION
+
+def consolidate_iter(conf: Configuration) -> Iterable[str]:
+	"""Consolidate the latest full backup and the incremental backups following it
+	for each directory into a new full backup, yielding a message for each, and add
+	it to the catalog. Existing archives are never replaced: with a target pattern
+	including the time, the next free second is used for the name of the new one,
+	otherwise (e.g. if the full backup of today is part of the chain) it is skipped.
+	"""
+	for directory in conf.directories:
+		chain = find_chain(conf, directory) if directory.archive_type != TYPE_REPO else []
+		if len(chain) < 2:
+			yield f"Nothing to consolidate for {directory.path}"
+			continue
+		full, now = replace(directory, incremental=False), time.time()
+		target_file = get_target_file(conf, full)
+		while archive_exists(target_file) and backup_model.P_TIME in conf.target_pattern:
+			now += 1
+			target_file = get_target_file(conf, full, {backup_model.P_TIME: get_date(now, add_time=True)})
+		if archive_exists(target_file):
+			yield f"Not consolidating {directory.path}, as {target_file} exists already"
+			continue
+		yield f"Consolidating {len(chain)} archives of {directory.path}"
+		threads = os.cpu_count() or 1
+		stats = backup_archive.consolidate(chain, target_file, directory.compression_level, threads)
+		catalog_archive(directory, target_file)
+		yield f"Created {target_file} ({stats})"
+
+
+def restore_iter(conf: Configuration, target_dir: str, until: float = None, names: List[str] = None,
+                 paths: List[str] = None) -> Iterable[str]:
+	"""Restore the files of all directories (or those with the given paths) as they
+	were at the given time (or the latest backup) to the target directory, or only
+	the files or directories with the given names (as in the archives), yielding a
+	message for each directory. Only the newest version of each file is extracted
+	from the chain of full and incremental backups, see backup_archive.restore.
+	"""
+	for directory in conf.directories:
+		if paths is not None and directory.path not in paths:
+			continue
+		if directory.archive_type == TYPE_REPO:
+			snapshots = [p for p, _ in find_archives(conf, directory) if until is None or os.path.getmtime(p) <= until]
+			chain = snapshots[-1:]
+		else:
+			chain = find_chain(conf, directory, until)
+		if not chain:
+			yield f"No backup of {directory.path} found"
+			continue
+		yield f"Restoring {directory.path} from {len(chain)} archives"
+		if directory.archive_type == TYPE_REPO:
+			stats = backup_repo.restore_snapshot(chain[0], target_dir, names)
+		else:
+			# compressed tar archives are listed from the catalog, if they are in it
+			with Catalog(config.CATALOG_FILE) as catalog:
+				listings = {p: ([e.name for e in catalog.entries(p)], lists) for p in chain
+				            if backup_sink.archive_name(p).rsplit(".", 1)[-1] in KNOWN_CODECS
+				            and (lists := catalog.lists(p)) is not None}
+			stats = backup_archive.restore(chain, target_dir, names, listings=listings)
+		yield f"Restored {stats.files} files ({format_size(stats.bytes_out)}) to {target_dir}"
+
+
+def import_catalog_iter(conf: Configuration) -> Iterable[str]:
+	"""Add the existing archives of all directories that are not in the catalog
+	yet, and remove archives that do not exist any more, yielding a message for
+	each directory.
+	"""
+	with Catalog(config.CATALOG_FILE) as catalog:
+		for directory in conf.directories:
+			archives = [p for p, _ in find_archives(conf, directory) if not catalog.contains(p)]
+			for path in archives:
+				catalog.import_archive(path, directory.path)
+			yield f"Added {len(archives)} archives of {directory.path} to catalog"
+		yield f"Removed {catalog.prune()} missing archives from catalog"
+
+
+def verify_iter(conf: Configuration, sample: float = 0.0) -> Iterable[str]:
+	"""Verify the archives of all directories that have not been verified yet (or
+	not successfully), comparing the given fraction of the files to the source
+	files, too, and record the results in the catalog, yielding a message for each
+	archive, see backup_verify. Archives have to be in the catalog to be verified.
+	"""
+	with Catalog(config.CATALOG_FILE) as catalog:
+		archives = [(path, directory.path, created, catalog.entries(path))
+		            for directory in conf.directories if directory.archive_type != TYPE_REPO
+		            for path, created in catalog.unverified(directory.path) if os.path.exists(path)]
+		yield f"Verifying {len(archives)} archives"
+		for result in backup_verify.verify_archives(archives, sample):
+			catalog.add_verification(result.path, result.files, result.compared, result.errors)
+			if result.errors:
+				yield "\n  ".join([f"Errors in {result.path}:"] + result.errors)
+			else:
+				yield f"Verified {result.path} ({result.files} files, {result.compared} compared to source)"
 
-def create_zip(filepaths: Iterable[str], target_file: str):
-	"""Create zip file using given filename containing the directory to_compress
-	and all of its files.
+
+def find_chain(conf: Configuration, directory: Directory, until: float = None) -> List[str]:
+	"""Find the latest full backup of the directory (created before the given time,
+	if any) and the incremental backups made after it (and before that time), if
+	any, in the order they were created. If there is no full backup, e.g. because
+	the directory was backed up incrementally from the start, the oldest archive is
+	taken as the base, as that holds all the files (there was no manifest yet).
 	"""
-	with ZipFile(target_file, mode="w", compression=ZIP_DEFLATED, compresslevel=5) as zip_file:
-		for filepath in filepaths:
-			zip_file.write(filepath)
+	chain = []
+	archives = [a for a in find_archives(conf, directory) if until is None or os.path.getmtime(a[0]) <= until]
+	for path, incremental in reversed(archives):
+		chain.insert(0, path)
+		if incremental is None:
+			archive = backup_archive.open_archive(path)
+			incremental = archive.is_incremental()
+			archive.close()
+		if not incremental:
+			return chain
+	return chain
 
 
-def create_tar(filepaths: Iterable[str], target_file: str):
-	"""Create tar file using given filename containing the directory to_compress
-	and all of its files.
+def find_archives(conf: Configuration, directory: Directory) -> List[Tuple[str, Optional[bool]]]:
+	"""Find existing archives of the directory created with the current target
+	pattern, in the order they were created, and whether they are incremental,
+	if this can be told from the file name (i.e. if the pattern includes {inc}).
+	Archives split into volumes are found by the name of their first volume.
 	"""
-	with TarFile(target_file, mode="w") as tar_file:
-		for filepath in filepaths:
-			tar_file.add(filepath)
+	tokens = {backup_model.P_DATE: "\x01", backup_model.P_TIME: "\x02", backup_model.P_INC: "\x03"}
+	template = get_target_file(conf, directory, tokens)
+	wildcards = glob.escape(template).translate({1: "*", 2: "*", 3: "*"}) + "*"
+	regex = re.compile(re.escape(template).replace("\x01", r"\d{4}-\d{2}-\d{2}")
+	                   .replace("\x02", r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}").replace("\x03", "(_inc)?")
+	                   + f"(?:{re.escape(backup_sink.FIRST_VOLUME)})?")
+	archives = []
+	for path in glob.glob(wildcards):
+		if match := regex.fullmatch(path):
+			incremental = bool(match.group(1)) if backup_model.P_INC in conf.target_pattern else None
+			archives.append((path, incremental))
+	return sorted(archives, key=lambda a: os.path.getmtime(a[0]))
 
 
 # HElPER FUNCTIONS
 
-def get_target_file(conf: Configuration, directory: Directory) -> str:
+def report_files(files: Iterable[Tuple[FileEntry, str]], report: Callable[[FileEntry], None] = None,
+                 written: Snapshot = None) -> Iterable[Tuple[FileEntry, str]]:
+	"""Pass on the files to be archived, calling the report function, if any, for
+	each of them, i.e. when the archiver gets to that file, and adding their entries
+	to the snapshot of written files, if any.
+	"""
+	for entry, arcname in files:
+		if report:
+			report(entry)
+		if written is not None:
+			written.append(entry)
+		yield entry, arcname
+
+
+def get_target_file(conf: Configuration, directory: Directory, values: Dict[str, str] = None) -> str:
 	"""Substitute placeholders and normalize file name, i.e. replace leading '.'
 	(hidden files) with '_', but only in directory name, not in target path,
-	replace '~' with home dir, and replace multiple '/' with single '/'.
+	replace '~' with home dir, and replace multiple '/' with single '/'. The
+	values of some placeholders can be overridden, e.g. for finding archives.
 	"""
 	src_parent, src_dir = os.path.split(re.sub(r"(?<=/)\.", "_", directory.path))
 	placeholders = {
@@ -97,23 +620,47 @@ def get_target_file(conf: Configuration, directory: Directory) -> str:
 		backup_model.P_PRNT: src_parent,
 		backup_model.P_DIRN: src_dir,
 		backup_model.P_INC: "_inc" if directory.incremental else "",
+		**(values or {}),
 	}
 	target_file = conf.target_pattern
 	target_file = re.sub(r"^~", config.USER_DIR, target_file)
 	target_file = re.sub(r"\{.*?\}", lambda m: placeholders[m.group()], target_file)
 	target_file = re.sub(r"/+", "/", target_file)
-	return '.'.join((target_file, directory.archive_type))
+	return '.'.join((target_file, EXTENSIONS.get(directory.archive_type, directory.archive_type)))
+
+
+def archive_exists(target_file: str) -> bool:
+	"""Check whether there is an archive, or volume set, with the given name."""
+	return os.path.exists(target_file) or os.path.exists(backup_sink.volume_name(target_file, 1))
+
+
+def get_device(path: str) -> Optional[str]:
+	"""Get the device the given file or directory (or its closest existing parent)
+	is stored on, for deciding which backups can run concurrently. For partitions,
+	this is the whole disk the partition is on, and for solid-state disks, this is
+	None, as those do not suffer from concurrent access.
+	"""
+	path = os.path.abspath(path)
+	while not os.path.exists(path):
+		path = os.path.dirname(path)
+	dev = os.stat(path).st_dev
+	sysfs = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+	if not os.path.exists(sysfs):
+		return str(dev)
+	disk = os.path.realpath(sysfs)
+	if os.path.exists(os.path.join(disk, "partition")):
+		disk = os.path.dirname(disk)
+	try:
+		with open(os.path.join(disk, "queue", "rotational")) as f:
+			return disk if f.read().strip() == "1" else None
+	except OSError:
+		return disk
 
 
 def get_size(directory: Directory) -> str:
     """Get size of files in directory as human-readable string."""
-    size = sum(os.path.getsize(f) for f in directory.iter_include())
-    if size:
-        p = max(i for i in range(5) if 1024**i <= size)
-        ext = ("B", "KB", "MB", "GB", "TB")[p]
-        return f"{size / 1024**p:.1f} {ext}"
-    else:
-        return "nothing"
+    size = total_size(directory.include_entries())
+    return format_size(size) if size else "nothing"
 
 
 def get_date(timestamp=None, add_time=False) -> str:
@@ -0,0 +1,259 @@
+# -*- coding: utf8 -*-
+
+"""
+Block-level deltas for simple Backup tool.
+by Tobias Küster, 2026
+
+In incremental backups, large files that are changed only in parts, like mailbox
+files or databases that are mostly appended to, can be stored as deltas to their
+version in the last backup, instead of in full. For this, the files are divided
+into blocks of BLOCK_SIZE, and for each file of at least the directory's
+delta_size, a signature with a strong hash of each of its blocks is kept in a
+cache next to the manifest, describing the file as it was archived last time.
+When the file changed, it is read once, and each of its blocks that matches a
+block in the signature (preferably at the same position, otherwise anywhere in
+the file, e.g. when it was moved) is referenced, and only the other blocks are
+stored in the archive, together with a map of the blocks in an extra member
+(DELTA_LIST). To restore or consolidate such a file, the last version of it in
+the archives before is restored first, and the deltas are applied on top of it.
+
+Unlike rsync, blocks are only compared at multiples of the block size, instead
+of at each byte offset using a rolling checksum, which can not be done fast
+enough in Python; this covers appended, changed and moved blocks, but not data
+inserted in the middle of a file.
+
+After each backup, signatures are computed for the large files archived in full,
+i.e. those are read once more, and only kept if the file did not change while it
+was being archived; the signatures of files archived as deltas are computed while
+computing the delta.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import BinaryIO, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import backup_io
+from backup_manifest import manifest_file
+from backup_scan import FileEntry
+
+
+BLOCK_SIZE = 1 << 17
+DIGEST_SIZE = 16
+SIGNATURES_EXT = ".signatures.gz"
+
+
+class Signature(NamedTuple):
+	"""Class holding the hashes of the blocks of a file, as archived last time, as
+	well as its size and modification time then.
+	"""
+
+	size: int
+	mtime_ns: int
+	block_size: int
+	digests: bytes
+
+	def digest(self, i: int) -> bytes:
+		"""Get the hash of the block with the given index."""
+		return self.digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+
+
+class Delta(NamedTuple):
+	"""Class describing a file stored as delta: its size, the block size, and runs
+	of blocks, as triples of source (0 for blocks of the previous version of the
+	file, 1 for blocks stored in the archive), index of the first block in that
+	source, and number of blocks.
+	"""
+
+	size: int
+	block_size: int
+	runs: List[List[int]]
+
+
+def load_signatures(path: str) -> Dict[str, Signature]:
+	"""Load the signatures of the files in the directory with the given path, by
+	their relative paths, or an empty dict if there are none.
+	"""
+	try:
+		with gzip.open(manifest_file(path, SIGNATURES_EXT), "rb") as f:
+			data = f.read()
+	except FileNotFoundError:
+		return {}
+	signatures, pos = {}, 0
+	while pos < len(data):
+		name, size, mtime_ns, block_size, count, rest = data[pos:].split(b"\0", 5)
+		pos += len(data) - pos - len(rest)
+		digests = data[pos:pos + int(count) * DIGEST_SIZE]
+		pos += len(digests)
+		signatures[os.fsdecode(name)] = Signature(int(size), int(mtime_ns), int(block_size), digests)
+	return signatures
+
+
+def save_signatures(path: str, signatures: Dict[str, Signature]):
+	"""Save the signatures of the files in the directory with the given path."""
+	filename = manifest_file(path, SIGNATURES_EXT)
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	with gzip.open(filename + ".tmp", "wb", compresslevel=1) as f:
+		for name, sig in signatures.items():
+			count = len(sig.digests) // DIGEST_SIZE
+			f.write(b"%s\0%d\0%d\0%d\0%d\0" % (os.fsencode(name), sig.size, sig.mtime_ns, sig.block_size, count))
+			f.write(sig.digests)
+	os.replace(filename + ".tmp", filename)
+
+
+def block_digest(block: bytes) -> bytes:
+	"""Get the strong hash of a block."""
+	return hashlib.blake2b(block, digest_size=DIGEST_SIZE).digest()
+
+
+def file_signature(entry: FileEntry) -> Optional[Signature]:
+	"""Calculate the signature of the file, or None if it can not be read or does
+	not match the snapshot entry (any more), e.g. because it was changed since.
+	"""
+	digests = []
+	try:
+		with backup_io.open_source(entry.path) as f:
+			while block := f.read(BLOCK_SIZE):
+				digests.append(block_digest(block))
+		st = os.stat(entry.path)
+	except OSError:
+		return None
+	if (st.st_size, st.st_mtime_ns) != (entry.size, entry.mtime_ns):
+		return None
+	return Signature(entry.size, entry.mtime_ns, BLOCK_SIZE, b"".join(digests))
+
+
+def compute_delta(path: str, old: Signature, out: BinaryIO) -> Tuple[Delta, Signature]:
+	"""Read the file and write the blocks not contained in the old signature to the
+	output, returning the delta and the signature of the file as read.
+	"""
+	bs = old.block_size
+	index = {}
+	for i in reversed(range(len(old.digests) // DIGEST_SIZE)):
+		index[old.digest(i)] = i
+	runs, digests, size, stored = [], [], 0, 0
+	with backup_io.open_source(path) as f:
+		while block := f.read(bs):
+			digest = block_digest(block)
+			# prefer the block at the same position, e.g. for files only appended to
+			i = len(digests)
+			source, start = (0, i) if old.digest(i) == digest else (0, index.get(digest))
+			if start is None:
+				out.write(block)
+				source, start = 1, stored
+				stored += 1
+			if runs and runs[-1][0] == source and runs[-1][1] + runs[-1][2] == start:
+				runs[-1][2] += 1
+			else:
+				runs.append([source, start, 1])
+			digests.append(digest)
+			size += len(block)
+		mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+	return Delta(size, bs, runs), Signature(size, mtime_ns, bs, b"".join(digests))
+
+
+def apply_delta(old: BinaryIO, delta: Delta, data: BinaryIO, out: BinaryIO):
+	"""Write the new version of the file, taking blocks from the old version (which
+	must allow random access) and from the data stored in the archive.
+	"""
+	pos = 0
+	for source, start, count in delta.runs:
+		for i in range(start, start + count):
+			length = min(delta.block_size, delta.size - pos)
+			if source == 0:
+				old.seek(i * delta.block_size)
+				block = old.read(length)
+			else:
+				block = data.read(length)
+				while len(block) < length and (more := data.read(length - len(block))):
+					block += more
+			if len(block) != length:
+				raise ValueError("Delta does not match previous version of the file")
+			out.write(block)
+			pos += length
+
+
+def encode_deltas(deltas: Dict[str, Delta]) -> bytes:
+	"""Encode the deltas as content of the list in the archive."""
+	return json.dumps({name.replace(os.sep, "/"): d._asdict() for name, d in deltas.items()}).encode("utf8")
+
+
+def decode_deltas(data: bytes) -> Dict[str, Delta]:
+	"""Decode the list of deltas in an archive, see encode_deltas."""
+	return {name: Delta(**d) for name, d in json.loads(data.decode("utf8")).items()}
+
+
+class DeltaSet:
+	"""Class for storing large files of a directory as deltas in an incremental
+	backup, and updating their signatures after the backup. The data of the deltas
+	is kept in a temporary directory in the given parent directory, if any.
+	"""
+
+	def __init__(self, root: str, min_size: int, tmp_parent: str = None):
+		self.root = root
+		self.tmp_parent = tmp_parent
+		self.prefix = len(os.path.join(root, ""))
+		self.min_size = min_size
+		self.signatures = load_signatures(root)
+		self.deltas: Dict[str, Delta] = {}
+		self.entries: Dict[str, FileEntry] = {}
+		self.new_signatures: Dict[str, Signature] = {}
+		self.tmp = None
+
+	def prepare(self, members: Iterable[Tuple[FileEntry, str]]):
+		"""Compute the deltas of the given files, as pairs of snapshot entry and name
+		in the archive, that are large enough and have a signature, writing the data
+		to be stored to temporary files, next to the archive (the default temporary
+		directory may be too small for them). Files with hard links are always stored
+		in full, as their previous version may be just a link in the archive.
+		"""
+		for entry, arcname in members:
+			old = self.signatures.get(entry.path[self.prefix:])
+			if entry.size < self.min_size or entry.nlink > 1 or old is None:
+				continue
+			if self.tmp is None:
+				self.tmp = tempfile.mkdtemp(prefix=".backup-delta-", dir=self.tmp_parent)
+			path = os.path.join(self.tmp, str(len(self.deltas)))
+			try:
+				with open(path, "wb") as out:
+					delta, signature = compute_delta(entry.path, old, out)
+			except OSError:
+				continue  # archived in full, which will fail, too
+			self.deltas[arcname] = delta
+			self.entries[arcname] = entry._replace(path=path, size=os.path.getsize(path), nlink=1, blocks=-1)
+			self.new_signatures[entry.path[self.prefix:]] = signature
+
+	def substitute(self, members: Iterable[Tuple[FileEntry, str]]) -> Iterable[Tuple[FileEntry, str]]:
+		"""Pass on the files to be archived, with the files stored as deltas replaced
+		by the temporary files holding their data.
+		"""
+		for entry, arcname in members:
+			yield self.entries.get(arcname, entry), arcname
+
+	def update(self, snapshot: Iterable[FileEntry], members: Iterable[Tuple[FileEntry, str]],
+	           written: Iterable[Tuple[FileEntry, str]]):
+		"""Update and save the signatures after the backup: the signatures of files
+		written to the archive in full are calculated (if they are large enough), those
+		of files not in the archive are kept, if the files still exist, and those of
+		files in the archive but not written now (when continuing an interrupted
+		backup) are dropped, as it is not known which version is in the archive.
+		"""
+		# only files with signatures are kept in memory, not all the files in the snapshot
+		signatures = {n: self.signatures[n] for e in snapshot if (n := e.path[self.prefix:]) in self.signatures}
+		for entry, _ in members:
+			signatures.pop(entry.path[self.prefix:], None)
+		for entry, arcname in written:
+			name = entry.path[self.prefix:]
+			if arcname in self.deltas:
+				signatures[name] = self.new_signatures[name]
+			elif entry.size >= self.min_size:
+				signatures[name] = file_signature(entry)
+		save_signatures(self.root, {n: s for n, s in signatures.items() if s is not None})
+
+	def close(self):
+		"""Remove the temporary files."""
+		if self.tmp is not None:
+			shutil.rmtree(self.tmp, ignore_errors=True)
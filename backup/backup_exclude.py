@@ -0,0 +1,135 @@
+# -*- coding: utf8 -*-
+
+"""
+Exclude rules for simple Backup tool.
+by Tobias Küster, 2026
+
+Files and whole subdirectories can be excluded from the backup, both globally
+and for each directory, using patterns like in a .gitignore file, a maximum
+file size, and by skipping cache directories marked with a CACHEDIR.TAG file
+(see https://bford.info/cachedir/). The rules are compiled into a few regular
+expressions and applied while scanning the directory, so excluded directories
+are never descended into, and excluded files are not even stat-ed (unless only
+their size is to be checked); as all other parts of the program work on the
+result of the scan, the same rules apply to sizing, change detection and
+archiving.
+
+Patterns are matched against the path relative to the backed up directory:
+- `*` and `?` match any characters (or one character) except `/`, and `**`
+  matches any characters including `/`, e.g. `**/build` or `logs/**`
+- patterns without a `/` (other than at the end) match at any depth, e.g.
+  `node_modules` or `*.pyc`; others are relative to the directory, e.g. `/out`
+  or `docs/_build`
+- patterns ending with `/` only match directories, e.g. `.cache/`
+- patterns starting with `!` include files again that were excluded by a
+  previous pattern, unless their parent directory is excluded
+- empty lines and lines starting with `#` are ignored
+"""
+
+import os
+import re
+from typing import Iterable, List, Optional, Pattern, Tuple
+
+
+CACHEDIR_TAG = "CACHEDIR.TAG"
+CACHEDIR_SIGNATURE = b"Signature: 8a477f597d28d172789f06886806bc55"
+
+
+class Excludes:
+	"""Class holding the compiled exclude rules for one directory.
+	"""
+
+	def __init__(self, patterns: Iterable[str] = (), max_size: int = 0, caches: bool = False):
+		self.patterns = tuple(patterns)
+		self.max_size = max_size
+		self.caches = caches
+		self.rules = compile_patterns(self.patterns)
+
+	def __bool__(self) -> bool:
+		return bool(self.rules or self.max_size or self.caches)
+
+	def __eq__(self, other) -> bool:
+		return isinstance(other, Excludes) and \
+		       (self.patterns, self.max_size, self.caches) == (other.patterns, other.max_size, other.caches)
+
+	def excluded(self, path: str, is_dir: bool) -> bool:
+		"""Check whether the file or directory with the given relative path is
+		excluded by the patterns; the last matching pattern decides.
+		"""
+		for files, dirs, negate in reversed(self.rules):
+			regex = dirs if is_dir else files
+			if regex is not None and regex.fullmatch(path):
+				return not negate
+		return False
+
+	def too_large(self, size: int) -> bool:
+		"""Check whether a file of the given size is excluded."""
+		return 0 < self.max_size < size
+
+	def is_cache(self, path: str, names: Iterable[str]) -> bool:
+		"""Check whether the directory with the given path and containing files
+		with the given names is a cache directory to be excluded.
+		"""
+		if not self.caches or CACHEDIR_TAG not in names:
+			return False
+		try:
+			with open(os.path.join(path, CACHEDIR_TAG), "rb") as f:
+				return f.read(len(CACHEDIR_SIGNATURE)) == CACHEDIR_SIGNATURE
+		except OSError:
+			return False
+
+
+def compile_patterns(patterns: Iterable[str]) -> List[Tuple[Optional[Pattern], Optional[Pattern], bool]]:
+	"""Compile the patterns into rules, as triples of regular expressions for files
+	and for directories and whether the rule includes the matches again; runs of
+	patterns with the same effect are combined into a single rule.
+	"""
+	groups = []  # lists of (regex, directory only) with the same negation
+	for pattern in patterns:
+		pattern = pattern.strip()
+		if not pattern or pattern.startswith("#"):
+			continue
+		negate = pattern.startswith("!")
+		regex, dir_only = translate(pattern[1:] if negate else pattern)
+		if not groups or groups[-1][1] != negate:
+			groups.append(([], negate))
+		groups[-1][0].append((regex, dir_only))
+
+	def combine(regexes: List[str]) -> Optional[Pattern]:
+		return re.compile("|".join(f"(?:{r})" for r in regexes)) if regexes else None
+
+	return [(combine([r for r, dir_only in group if not dir_only]), combine([r for r, _ in group]), negate)
+	        for group, negate in groups]
+
+
+def translate(pattern: str) -> Tuple[str, bool]:
+	"""Translate a single gitignore-style pattern into a regular expression for the
+	relative path, and whether it only matches directories.
+	"""
+	dir_only = pattern.endswith("/")
+	pattern = pattern.rstrip("/")
+	anchored = "/" in pattern
+	pattern = pattern.lstrip("/")
+	parts, i = [], 0
+	while i < len(pattern):
+		if pattern.startswith("**/", i):
+			parts.append("(?:.*/)?")
+			i += 3
+		elif pattern.startswith("**", i):
+			parts.append(".*")
+			i += 2
+		elif pattern[i] == "*":
+			parts.append("[^/]*")
+			i += 1
+		elif pattern[i] == "?":
+			parts.append("[^/]")
+			i += 1
+		elif pattern[i] == "[" and (end := pattern.find("]", i + 2)) > 0:
+			body = pattern[i + 1:end]
+			parts.append("[" + ("^" + body[1:] if body[0] == "!" else body).replace("\\", "\\\\") + "]")
+			i = end + 1
+		else:
+			parts.append(re.escape(pattern[i]))
+			i += 1
+	regex = "".join(parts)
+	return (regex if anchored else "(?:.*/)?" + regex), dir_only
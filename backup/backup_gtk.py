@@ -11,16 +11,30 @@ similar layout.
 - some text fields for "global" configuration like name patterns etc.
 - buttons for adding and removing directories, and for creating the backup
 - automatically save configuration on exit
+- sizes and include flags are updated in the background, showing the cached values;
+  on start, only directories never scanned before are scanned
 """
 
+import functools
+import os
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 
 import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, GLib
 
-from backup_core import get_date, get_size, perform_backup_iter, KNOWN_TYPES
+from backup_core import get_date, get_size, perform_backup_events, KNOWN_TYPES, \
+                        EVENT_CANCELLED, EVENT_DONE, EVENT_FILE
 from backup_model import Directory
+from backup_scan import Cancelled
+from backup_watch import load_dirty
+import config
+
+
+# Directory attributes that are shown (and can be edited) in the table
+TABLE_FIELDS = ["archive_type", "size", "last_backup", "include", "incremental"]
 
 
 class BackupFrame:
@@ -30,31 +44,40 @@ class BackupFrame:
 
 	def __init__(self, conf):
 		self.conf = conf
+		self.scan_cancel = None
+		self.backup_cancel = threading.Event()
 
 		# Entries for basic Configuration attributes
 		self.pattern = Gtk.Entry()
 		self.pattern.set_text(self.conf.target_pattern)
+		self.jobs = Gtk.SpinButton.new_with_range(1, 64, 1)
+		self.jobs.set_value(self.conf.jobs)
+		self.jobs.set_tooltip_text("Number of Directories to Back Up Concurrently")
 
 		# create tool bar and buttons
 		header = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
 		header.pack_start(Gtk.Label(label="Target Pattern"), False, False, 10)
 		header.pack_start(self.pattern, True, True, 0)
+		header.pack_start(Gtk.Label(label="Jobs"), False, False, 10)
+		header.pack_start(self.jobs, False, False, 0)
 		header.pack_end(create_button("document-save", self.do_backup, "Create Backup of Selected Directories"), False, False, 0)
+		stop = create_button("process-stop", self.do_cancel, "Stop Backup or Refreshing Sizes and Include State")
+		header.pack_end(stop, False, False, 0)
 		header.pack_end(create_button("view-refresh", self.do_refresh, "Refresh Include State"), False, False, 0)
 		header.pack_end(create_button("list-remove", self.do_remove, "Remove Directory"), False, False, 0)
 		header.pack_end(create_button("list-add", self.do_add, "Add Directory"), False, False, 0)
 
+		# progress of the current backup operation or background scan
+		self.progress = Gtk.ProgressBar()
+		self.progress.set_show_text(True)
+		self.progress.set_text("")
+
 		# create table model and body section with table view
 		self.create_table()
 		table_scroller = Gtk.ScrolledWindow()
 		table_scroller.add(self.table)
 
-		# progress of the current backup operation
-		self.progress = Gtk.ProgressBar()
-		self.progress.set_show_text(True)
-		self.progress.set_text("")
-
-		self.widgets = [self.table, *header.get_children()]
+		self.widgets = [w for w in [self.table, *header.get_children()] if w is not stop]
 
 		# main vertical "box" for all the contents of the window
 		body = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
@@ -65,7 +88,7 @@ class BackupFrame:
 		# put it all together in a window
 		self.window = Gtk.ApplicationWindow(title="Simple Backup Tool")
 		self.window.resize(800, 400)
-		self.window.connect("delete-event", lambda *_: self.update_conf())
+		self.window.connect("delete-event", lambda *_: self.do_cancel(None) or self.update_conf())
 		self.window.connect("destroy", Gtk.main_quit)
 		self.window.add(body)
 		self.window.show_all()
@@ -74,9 +97,15 @@ class BackupFrame:
 		""" Update Configuration from Entries and Directories Table.
 		"""
 		self.conf.target_pattern = self.pattern.get_text()
+		self.conf.jobs = self.jobs.get_value_as_int()
+		# keep attributes not shown in the table, e.g. compression level
+		known = {d.path: d for d in self.conf.directories}
 		def to_directory(values):
 			values[3] = values.pop() # replace date string with timestamp
-			return Directory(*values)
+			directory = Directory(*values)
+			if directory.path in known:
+				directory = replace(known[directory.path], **{f: getattr(directory, f) for f in TABLE_FIELDS})
+			return directory
 		self.conf.directories = [to_directory(list(vals)) for vals in self.store]
 		if check:
 			try:
@@ -84,13 +113,85 @@ class BackupFrame:
 			except Exception as e:
 				show_warning(self.window, "Warning", str(e))
 
-	def update_table(self):
-		"""Update table view from configuration, e.g. after updating the dates.
+	def update_table(self, refresh_includes=False, only_new=False, paths=None):
+		"""Update table view from configuration, e.g. after updating the dates, and
+		start updating the sizes and include flags in the background, optionally
+		only of the directories with the given paths.
 		"""
 		self.store.clear()
 		for d in self.conf.directories:
-			vals = [d.path, d.archive_type, get_size(d), get_date(d.last_backup), d.include, d.incremental, d.last_backup]
+			vals = [d.path, d.archive_type, d.size, get_date(d.last_backup), d.include, d.incremental, d.last_backup]
 			self.store.append(vals)
+		self.start_scan(refresh_includes, only_new, paths)
+
+	def start_scan(self, refresh_includes=False, only_new=False, paths=None):
+		"""Scan the directories in a pool of background threads and update their
+		sizes, and optionally include flags, in the table as soon as the result for
+		each directory is available; until then, the cached values are shown. A
+		previous scan that is still running is cancelled. With only_new, only the
+		directories without cached statistics are scanned, e.g. on start, and with
+		paths, only those directories, e.g. after a backup. The scan only updates
+		the directories in memory and never writes their manifests, which may be
+		written by a backup at the same time.
+		"""
+		self.cancel_scan()
+		cancel = self.scan_cancel = threading.Event()
+		self.conf.apply_excludes()
+		directories = [d for d in self.conf.directories
+		               if (not only_new or d.scanned < 0) and (paths is None or d.path in paths)]
+		# only the paths changed since the last backup are scanned, if they are known
+		dirty = load_dirty(config.DIRTY_FILE) if refresh_includes else {}
+		done, errors = [], []
+
+		def worker(directory):
+			try:
+				if refresh_includes:
+					directory.manifest(refresh=True)
+				directory.scan(refresh=True, cancel=cancel, dirty=dirty.get(directory.path))
+				if refresh_includes:
+					directory.update_include(save_verified=False)
+				size = get_size(directory)
+			except Cancelled:
+				return
+			GLib.idle_add(update_row, directory, size)
+
+		def check_error(directory, future):
+			# any other error, e.g. a missing directory, is shown instead of the size
+			if future.exception() is not None:
+				GLib.idle_add(update_row, directory, "error", f"Could not scan {directory.path}: {future.exception()}")
+
+		def update_row(directory, size, error=None):
+			if not cancel.is_set():
+				for row in self.store:
+					if row[0] == directory.path:
+						row[2], row[4] = size, directory.include
+				done.append(directory)
+				if error is not None:
+					errors.append(error)
+				finished = len(done) == len(directories)
+				self.progress.set_text("; ".join(errors) if finished else error or f"Scanned {directory.path}")
+				self.progress.set_fraction(len(done) / len(directories))
+			return False
+
+		pool = ThreadPoolExecutor(max(1, self.conf.jobs))
+		for directory in directories:
+			pool.submit(worker, directory).add_done_callback(functools.partial(check_error, directory))
+		pool.shutdown(wait=False)
+
+	def do_cancel(self, _widget):
+		""" Cancel running backup, which can be continued later, or background scan
+		"""
+		self.backup_cancel.set()
+		self.cancel_scan()
+
+	def cancel_scan(self, _widget=None):
+		""" Cancel background scan of the directories, if any, keeping the sizes
+		and include flags not updated so far.
+		"""
+		if self.scan_cancel is not None:
+			self.scan_cancel.set()
+			self.progress.set_text("")
+			self.progress.set_fraction(0)
 
 	def do_add(self, _widget):
 		""" Callback for creating a new Directory entry
@@ -101,7 +202,7 @@ class BackupFrame:
 		if dialog.run() and dialog.get_filename():
 			self.update_conf()
 			self.conf.directories.append(Directory(dialog.get_filename(), "zip"))
-			self.update_table()
+			self.update_table(paths={dialog.get_filename()})
 		dialog.destroy()
 
 	def do_remove(self, _widget):
@@ -113,32 +214,39 @@ class BackupFrame:
 			self.update_conf()
 
 	def do_refresh(self, _widget):
-		""" Calculate include status from last-backup and last-changed
+		""" Calculate include status from last-backup and last-changed (in the
+		background, see start_scan)
 		"""
 		self.update_conf(True)
-		self.conf.update_includes()
-		self.update_table()
+		self.update_table(refresh_includes=True)
 
 	def do_backup(self, _widget):
 		""" Create backup of the selected Directories. This uses two concurrent
 		processes: one for performing the actual backup, and one for updating
-		the UI (the latter can not be done from the backup-thread).
+		the UI (the latter can not be done from the backup-thread), showing the
+		progress by bytes, the throughput and the estimated remaining time.
 		"""
+		self.cancel_scan()
 		self.update_conf(True)
 		if ask_dialog(self.window, "Create Backup?"):
-			n, done = len(self.conf.directories) + 1, []
+			events = []
+			self.backup_cancel.clear()
+			included = {d.path for d in self.conf.directories if d.include}
 
 			def worker():
-				for i, msg in enumerate(perform_backup_iter(self.conf)):
-					done.append(msg)
+				for event in perform_backup_events(self.conf, cancel=self.backup_cancel):
+					events.append(event)
 
 			def update_progress():
-				if done:
-					self.progress.set_text(done[-1])
-					self.progress.set_fraction(len(done) / n)
-				all_done = len(done) >= n
+				if events:
+					event = events[-1]
+					self.progress.set_text(str(event) if event.kind != EVENT_FILE else
+					                       f"{os.path.basename(event.path)}: {event}")
+					self.progress.set_fraction(event.fraction())
+					del events[:-1]
+				all_done = bool(events) and events[-1].kind in (EVENT_DONE, EVENT_CANCELLED)
 				if all_done:
-					self.update_table()
+					self.update_table(paths=included)
 				for widget in self.widgets:
 					widget.set_sensitive(all_done)
 				return not all_done
@@ -152,7 +260,7 @@ class BackupFrame:
 		"""
         # XXX why float in last place???
 		self.store = Gtk.ListStore(str, str, str, str, bool, bool, float)
-		self.update_table()
+		self.update_table(only_new=True)
 
 		self.table = Gtk.TreeView.new_with_model(self.store)
 		self.select = self.table.get_selection()
@@ -0,0 +1,192 @@
+# -*- coding: utf8 -*-
+
+"""
+File input and output for simple Backup tool.
+by Tobias Küster, 2026
+
+A backup reads (and writes) much more data than fits into memory, and all of it
+only once, so keeping it in the page cache is of no use, but pushes out the data
+other programs on the same machine are actually working with. Therefore, the
+archivers read the source files with large buffers, tell the kernel that they are
+read sequentially (so it reads ahead further), and that their pages will not be
+needed again once read (only for files of at least DROP_MIN_SIZE, so small files
+other programs may be using are left alone). Archives are synced to disk once
+when they are complete, instead of after each file, and their pages are then
+dropped from the cache, too. Very large files can also be read using mmap.
+
+Where posix_fadvise is not available (e.g. on macOS), the hints are left out.
+"""
+
+import mmap
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable
+
+
+DEFAULT_BUFFER = 4 << 20
+# files at least this large are read using mmap, or 0 to never use mmap
+MMAP_THRESHOLD = 256 << 20
+# pages of files smaller than this are not dropped from the cache
+DROP_MIN_SIZE = 1 << 20
+
+
+class IOSettings:
+	"""Class holding the settings for reading and writing files, see configure.
+	"""
+
+	buffer_size = DEFAULT_BUFFER
+	drop_cache = True
+
+
+settings = IOSettings()
+
+
+def configure(buffer_size: int = 0, drop_cache: bool = True):
+	"""Set the size of the read buffers (or the default, if 0) and whether to drop
+	files read and written from the page cache.
+	"""
+	settings.buffer_size = buffer_size or DEFAULT_BUFFER
+	settings.drop_cache = drop_cache
+
+
+def fadvise(fd: int, offset: int, length: int, advice: str):
+	"""Give the kernel the advice (name of a POSIX_FADV_ constant) on how the range
+	of the file will be accessed, if supported.
+	"""
+	if hasattr(os, "posix_fadvise"):
+		try:
+			os.posix_fadvise(fd, offset, length, getattr(os, "POSIX_FADV_" + advice))
+		except OSError:
+			pass  # e.g. not supported by the file system
+
+
+class SourceFile:
+	"""File-like object for reading a file sequentially with large buffers, which
+	drops the file's pages from the cache when closed (if large enough), and
+	optionally calculates the CRC32 of the data read, e.g. for verifying archives,
+	and adds it to the given hash object, e.g. for the manifest.
+	"""
+
+	def __init__(self, path: str, checksum=False, hasher=None):
+		self.fp = open(path, "rb", buffering=0)
+		self.size = os.fstat(self.fp.fileno()).st_size
+		self.crc = 0 if checksum else None
+		self.hasher = hasher
+		fadvise(self.fp.fileno(), 0, 0, "SEQUENTIAL")
+
+	def read(self, size: int = -1) -> bytes:
+		if size is None or size < 0:
+			data = self.fp.readall()
+		else:
+			# raw files may return less than requested, but callers expect full reads
+			data = self.fp.read(size)
+			while data and len(data) < size and (more := self.fp.read(size - len(data))):
+				data += more
+		if self.crc is not None:
+			self.crc = zlib.crc32(data, self.crc)
+		if self.hasher is not None:
+			self.hasher.update(data)
+		return data
+
+	def readinto(self, buffer) -> int:
+		n = self.fp.readinto(buffer)
+		if self.crc is not None:
+			self.crc = zlib.crc32(memoryview(buffer)[:n], self.crc)
+		if self.hasher is not None:
+			self.hasher.update(memoryview(buffer)[:n])
+		return n
+
+	def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+		return self.fp.seek(offset, whence)
+
+	def tell(self) -> int:
+		return self.fp.tell()
+
+	def fileno(self) -> int:
+		return self.fp.fileno()
+
+	def close(self):
+		if not self.fp.closed:
+			if settings.drop_cache and self.size >= DROP_MIN_SIZE:
+				fadvise(self.fp.fileno(), 0, 0, "DONTNEED")
+			self.fp.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+def open_source(path: str, checksum=False, hasher=None) -> SourceFile:
+	"""Open a file to be backed up for reading, see SourceFile."""
+	return SourceFile(path, checksum, hasher)
+
+
+def read_range(path: str, offset: int, length: int) -> bytes:
+	"""Read a range of a file to be backed up, e.g. a chunk to be compressed, using
+	mmap for very large files, and drop the range from the cache afterwards.
+	"""
+	with open(path, "rb", buffering=0) as f:
+		fd = f.fileno()
+		size = os.fstat(fd).st_size
+		fadvise(fd, offset, length, "SEQUENTIAL")
+		if 0 < MMAP_THRESHOLD <= size and length > 0 and offset + length <= size:
+			start = offset - offset % mmap.ALLOCATIONGRANULARITY
+			with mmap.mmap(fd, offset + length - start, access=mmap.ACCESS_READ, offset=start) as m:
+				data = m[offset - start:]
+		else:
+			f.seek(offset)
+			data = f.read(length)
+			while data and len(data) < length and (more := f.read(length - len(data))):
+				data += more
+		if settings.drop_cache and size >= DROP_MIN_SIZE:
+			fadvise(fd, offset, length, "DONTNEED")
+	return data
+
+
+def finish_target(fp: BinaryIO):
+	"""Flush the completely written archive to disk and drop it from the cache;
+	file-like objects other than actual files (e.g. of sinks) are just flushed.
+	"""
+	fp.flush()
+	try:
+		fd = fp.fileno()
+	except (AttributeError, OSError):
+		return
+	os.fsync(fd)
+	if settings.drop_cache:
+		fadvise(fd, 0, 0, "DONTNEED")
+
+
+def drop_written(fp: BinaryIO):
+	"""Drop the part of the archive already synced to disk from the cache."""
+	if settings.drop_cache and hasattr(fp, "fileno"):
+		fadvise(fp.fileno(), 0, 0, "DONTNEED")
+
+
+def sync_files(paths: Iterable[str], threads: int = None):
+	"""Flush the files (e.g. new chunks in a repository) and the directories they
+	are in to disk at once, using several threads, and drop them from the cache.
+	"""
+	paths = list(paths)
+	dirs = {os.path.dirname(p) for p in paths}
+
+	def sync(path: str):
+		try:
+			fd = os.open(path, os.O_RDONLY)
+		except OSError:
+			return
+		try:
+			os.fsync(fd)
+			if settings.drop_cache and path not in dirs:
+				fadvise(fd, 0, 0, "DONTNEED")
+		except OSError:
+			pass  # e.g. directories on file systems not supporting that
+		finally:
+			os.close(fd)
+
+	with ThreadPoolExecutor(threads or min(32, 4 * (os.cpu_count() or 1))) as pool:
+		list(pool.map(sync, paths))
+		list(pool.map(sync, dirs))
@@ -0,0 +1,239 @@
+# -*- coding: utf8 -*-
+
+"""
+Checkpoint journal for simple Backup tool.
+by Tobias Küster, 2026
+
+While a backup is running, the progress is recorded in a journal file next to
+the configuration: which directories have been started, with which target file,
+which of their files have been written to the archive so far, and which
+directories have been finished. Archives are first written to a temporary
+".part" file next to the target and only renamed when complete, so an
+interrupted backup never leaves a half-written archive under the final name.
+
+If the backup is interrupted (cancelled, killed, or the machine goes to sleep
+and never comes back), the next run picks up the journal: finished directories
+are skipped (and their time of last backup restored), and the archives of
+unfinished directories are continued after the last file known to have been
+written completely, provided that and all preceding files did not change in the
+meantime. This works for zip (including "auto") and uncompressed tar archives;
+compressed tar archives are started over, and for the "repo" type, chunks
+already stored are not written again anyway.
+
+Entries of files written are added to the journal in batches, after flushing
+and syncing the archive file, so the journal never refers to data that is not
+actually on disk. The journal is removed after a backup run has completed.
+"""
+
+import itertools
+import json
+import os
+import threading
+import time
+from array import array
+from typing import BinaryIO, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import backup_io
+from backup_scan import FileEntry
+
+
+PART_EXT = ".part"
+# journals older than this are not resumed, as the backup would be too outdated
+MAX_AGE = 24 * 60 * 60
+# files written are added to the journal after this many files or bytes
+CHECKPOINT_FILES = 1000
+CHECKPOINT_BYTES = 64 << 20
+
+
+class FileRecord(NamedTuple):
+	"""Class representing a file written completely to a partial archive.
+	"""
+
+	name: str
+	size: int
+	mtime_ns: int
+	end: int            # offset in the archive after the file's entry
+	central: str = ""   # central directory record (hex) for zip archives
+
+
+class Journal:
+	"""Class for reading and writing the checkpoint journal of a backup run.
+	"""
+
+	def __init__(self, filename: Optional[str], pattern: str):
+		self.filename = filename
+		self.pattern = pattern
+		self.created = time.time()
+		self.started: Dict[str, Tuple[str, str]] = {}  # path -> target file, archive type
+		self.files: Dict[str, List[FileRecord]] = {}
+		self.finished: Dict[str, float] = {}  # path -> time of backup
+		self.stale_finished: Dict[str, float] = {}  # same, for journal not resumed
+		self.lock = threading.Lock()
+		self.fp = None
+
+	@staticmethod
+	def open(filename: Optional[str], pattern: str) -> "Journal":
+		"""Load the journal of an interrupted backup run with the given target
+		pattern from the file, if any, or start a new journal. Journals of another
+		target pattern, or older than MAX_AGE, are not resumed (but the times of
+		their finished directories are still available in stale_finished), and
+		their partial archives are removed.
+		"""
+		journal = Journal(filename, pattern)
+		if filename is None:
+			return journal
+		try:
+			with open(filename, encoding="utf8", errors="surrogateescape") as f:
+				for line in f:
+					try:
+						journal._apply(json.loads(line))
+					except ValueError:
+						break  # incomplete last line, written when interrupted
+		except FileNotFoundError:
+			pass
+		if journal.pattern != pattern or time.time() - journal.created > MAX_AGE:
+			for path, (target_file, _) in journal.started.items():
+				if path not in journal.finished and os.path.exists(target_file + PART_EXT):
+					os.remove(target_file + PART_EXT)
+			stale = journal.finished
+			journal = Journal(filename, pattern)
+			journal.stale_finished = stale
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		journal.fp = open(filename, "a", encoding="utf8", errors="surrogateescape")
+		if not journal.fp.tell():
+			journal._write({"run": journal.created, "pattern": pattern})
+		return journal
+
+	def _apply(self, record: dict):
+		if "run" in record:
+			self.created, self.pattern = record["run"], record["pattern"]
+		elif "start" in record:
+			self.started[record["start"]] = (record["target"], record["type"])
+			self.files[record["start"]] = []
+		elif "files" in record:
+			self.files[record["files"]].extend(FileRecord(*r) for r in record["records"])
+		elif "resume" in record:
+			del self.files[record["resume"]][record["count"]:]
+		elif "finish" in record:
+			self.finished[record["finish"]] = record["last_backup"]
+
+	def _write(self, record: dict):
+		if self.fp is not None:
+			with self.lock:
+				self.fp.write(json.dumps(record) + "\n")
+				self.fp.flush()
+
+	def target_file(self, path: str, archive_type: str) -> Optional[str]:
+		"""Get target file of the unfinished directory with the given path, if it
+		has been started before with the same archive type.
+		"""
+		target_file, started_type = self.started.get(path, (None, None))
+		return target_file if started_type == archive_type else None
+
+	def checkpoint(self, path: str, target_file: str, archive_type: str) -> "Checkpoint":
+		"""Start (or resume) the backup of the directory with the given path and
+		get a checkpoint for recording the files written to its archive.
+		"""
+		if self.target_file(path, archive_type) != target_file:
+			self.started[path] = (target_file, archive_type)
+			self.files[path] = []
+			self._write({"start": path, "target": target_file, "type": archive_type})
+		return Checkpoint(self, path, self.files[path])
+
+	def add_files(self, path: str, records: List[FileRecord]):
+		"""Add records of files completely written to the archive of the directory."""
+		self._write({"files": path, "records": records})
+
+	def finish(self, path: str, last_backup: float):
+		"""Record that the backup of the directory with the given path is finished."""
+		self.finished[path] = last_backup
+		self._write({"finish": path, "last_backup": last_backup})
+
+	def close(self, remove=False):
+		"""Close the journal file, and remove it if the backup run is complete."""
+		if self.fp is not None:
+			self.fp.close()
+			self.fp = None
+			if remove:
+				os.remove(self.filename)
+
+
+class Checkpoint:
+	"""Class for resuming a partial archive and recording the files written to it.
+	"""
+
+	def __init__(self, journal: Optional[Journal] = None, path: str = None, records: List[FileRecord] = None,
+	             opener: Callable[[str], BinaryIO] = None):
+		self.journal = journal
+		self.opener = opener
+		self.path = path
+		self.records = records or []
+		self.pending: List[FileRecord] = []
+		self.pending_bytes = 0
+		self.resumable = False
+		self.fp = None
+		# CRCs of the files in the archive, in order, or -1 if not known
+		self.crcs = array("q")
+		# hashes of the content of the files written (see backup_manifest), by path,
+		# calculated while writing them if this is a dict
+		self.hashes: Optional[Dict[str, str]] = None
+
+	def open(self, filename: str, files: Iterable[Tuple[FileEntry, str]], resumable=True):
+		"""Open the partial archive for writing, either a new one or (if resumable)
+		an existing one truncated after the last file that was written completely
+		and has not changed since, skipping those files in the given files (as pairs
+		of snapshot entry and name in the archive). New archives are opened with the
+		opener, if any. Returns the file object and the remaining files; the records
+		of the files kept are in records.
+		"""
+		size = os.path.getsize(filename) if resumable and self.records and os.path.exists(filename) else 0
+		files, kept = iter(files), []
+		for record in self.records:
+			if record.end > size:
+				break
+			item = next(files, None)
+			if item is None:
+				break
+			entry, name = item
+			if (name, entry.size, entry.mtime_ns) != (record.name, record.size, record.mtime_ns):
+				files = itertools.chain([item], files)
+				break
+			kept.append(record)
+
+		if kept:
+			self.fp = open(filename, "r+b")
+			self.fp.truncate(kept[-1].end)
+			self.fp.seek(kept[-1].end)
+		else:
+			self.fp = self.opener(filename) if self.opener else open(filename, "wb")
+		if self.journal is not None and len(kept) < len(self.records):
+			self.journal._write({"resume": self.path, "count": len(kept)})
+		self.records = kept
+		self.crcs = array("q", [-1]) * len(kept)
+		self.resumable = resumable
+		return self.fp, files
+
+	def add(self, entry: FileEntry, name: str, end: int, central: bytes = b"", crc: int = None,
+	        digest: str = None):
+		"""Record that the file has been written completely to the archive, up to
+		the given offset, and the CRC32 of its data, if calculated while writing it
+		(for verifying the archive later), as well as the hash of its content, if
+		any (for the manifest); the records are added to the journal in batches.
+		"""
+		self.crcs.append(-1 if crc is None else crc)
+		if digest is not None and self.hashes is not None:
+			self.hashes[entry.path] = digest
+		if self.journal is not None and self.resumable:
+			self.pending.append(FileRecord(name, entry.size, entry.mtime_ns, end, central.hex()))
+			self.pending_bytes += entry.size
+			if len(self.pending) >= CHECKPOINT_FILES or self.pending_bytes >= CHECKPOINT_BYTES:
+				self.sync()
+
+	def sync(self):
+		"""Flush the archive to disk and add the pending records to the journal."""
+		if self.pending and self.fp is not None and not self.fp.closed:
+			self.fp.flush()
+			os.fsync(self.fp.fileno())
+			backup_io.drop_written(self.fp)
+			self.journal.add_files(self.path, self.pending)
+			self.pending, self.pending_bytes = [], 0
@@ -0,0 +1,294 @@
+# -*- coding: utf8 -*-
+
+"""
+File manifests for simple Backup tool.
+by Tobias Küster, 2026
+
+For each backed up directory, a manifest of all the files that were contained in
+the last backup is kept, i.e. their relative paths, sizes, modification times,
+inodes and modes. By comparing the current snapshot of the directory with this
+manifest, added, changed, moved and deleted files can be determined exactly,
+which is more reliable than just comparing modification times to the date of the
+last backup. The manifests are stored in a compact, gzipped format in a folder
+next to the configuration file. The files are listed in the order of the scan
+(see backup_scan.scan_key), so the manifest is never loaded into memory as a
+whole, but read while iterating the snapshot, matching the files by name.
+
+Optionally, the manifest also holds a hash of the content of each file. Files
+whose size, modification time, or inode changed, but whose content is still the
+same (e.g. after "touch" or "git checkout") are then not considered as modified.
+The hashes of the files archived are calculated while archiving them, so those
+files are not read once more for updating the manifest after the backup.
+
+Besides the list of deleted files, archives may also contain a list of files that
+are hard links to another file in the same archive (by device and inode), which
+are then not stored again; this is used for zip files, which can not hold links.
+"""
+
+import gzip
+import hashlib
+import itertools
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import backup_io
+from backup_scan import FileEntry, scan_key
+
+
+MANIFEST_EXT = ".manifest.gz"
+# the manifest starts with this header, as file names are never empty; older ones
+# without it have fewer fields per file, see ManifestEntry
+MANIFEST_HEADER = b"\0backup-manifest\0" b"2\0"
+FIELDS = 9
+OLD_FIELDS = 6
+HASH_BUFFER = 1 << 20
+# the manifest is decompressed and parsed in blocks of this size
+READ_SIZE = 1 << 20
+# name of the archive member holding the list of files deleted since last backup
+DELETED_LIST = ".backup_deleted"
+# name of the archive member listing the hard links to other files in the archive
+HARDLINK_LIST = ".backup_hardlinks"
+# name of the archive member describing the files stored as deltas, see backup_delta
+DELTA_LIST = ".backup_deltas"
+# held while saving the manifest with the given file name
+_save_locks: Dict[str, threading.Lock] = {}
+
+
+class ManifestEntry(NamedTuple):
+	"""Class representing the state of a single file at the time of the last backup.
+	"""
+
+	size: int
+	mtime_ns: int
+	ino: int
+	mode: int
+	dev: int = 0
+	nlink: int = 1
+	blocks: int = -1
+	hash: str = ""
+
+
+class Manifest:
+	"""Class representing the manifest of a directory, which is read from the file
+	again each time it is iterated, instead of being kept in memory; single files
+	are not looked up, but the manifest is compared to a snapshot in order, see join.
+	"""
+
+	def __init__(self, filename: str):
+		self.filename = filename
+
+	def __iter__(self) -> Iterator[str]:
+		return (name for name, _ in self.items())
+
+	def is_current(self) -> bool:
+		"""Check whether the manifest is in the current format, which is always in
+		the order of the scan, by its header, without reading the rest of it.
+		"""
+		with gzip.open(self.filename, "rb") as f:
+			return f.read(len(MANIFEST_HEADER)) == MANIFEST_HEADER
+
+	def items(self) -> Iterator[Tuple[str, ManifestEntry]]:
+		with gzip.open(self.filename, "rb") as f:
+			partial = f.read(len(MANIFEST_HEADER))
+			n = FIELDS if partial == MANIFEST_HEADER else OLD_FIELDS
+			fields, partial = [], b"" if n == FIELDS else partial
+			while data := f.read(READ_SIZE):
+				fields += (partial + data).split(b"\0")
+				partial = fields.pop()
+				complete = len(fields) - len(fields) % n
+				for i in range(0, complete, n):
+					yield os.fsdecode(fields[i]), ManifestEntry(*map(int, fields[i+1:i+n-1]), hash=fields[i+n-1].decode())
+				del fields[:complete]
+
+	def values(self) -> Iterator[ManifestEntry]:
+		return (entry for _, entry in self.items())
+
+
+def manifest_file(path: str, ext: str = MANIFEST_EXT) -> str:
+	"""Get location of manifest file (or another file with the given extension, kept
+	next to it) for the directory with the given path.
+	"""
+	import config  # imported here, as config itself depends on the backup_model
+	name = hashlib.sha1(os.path.abspath(path).encode("utf8", "surrogateescape")).hexdigest()
+	return os.path.join(config.MANIFEST_PATH, name + ext)
+
+
+def load_manifest(path: str) -> Optional[Manifest]:
+	"""Load manifest for the directory with the given path, or None if there is no
+	manifest yet, e.g. because the directory has not been backed up before. Older
+	manifests, possibly listing the files in the order they were found, are saved
+	once in the current format, sorted if needed.
+	"""
+	manifest = Manifest(manifest_file(path))
+	try:
+		if manifest.is_current():
+			return manifest
+		entries = manifest.items()
+		if any(a > b for a, b in itertools.pairwise(scan_key(name) for name in manifest)):
+			entries = sorted(entries, key=lambda item: scan_key(item[0]))
+	except FileNotFoundError:
+		return None
+	save_manifest(path, entries)
+	return manifest
+
+
+def save_manifest(path: str, entries: Iterable[Tuple[str, ManifestEntry]]):
+	"""Save manifest for the directory with the given path, given as its names and
+	entries, in order. The manifest is first written to a temporary file of its own,
+	so an existing manifest is never left half-written, and concurrent saves of the
+	same manifest are serialized, so neither can replace the other's file.
+	"""
+	filename = manifest_file(path)
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	with _save_locks.setdefault(filename, threading.Lock()):
+		fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=os.path.basename(filename), suffix=".tmp")
+		try:
+			with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wb", compresslevel=1) as f:
+				f.write(MANIFEST_HEADER)
+				for name, entry in entries:
+					f.write(b"\0".join([os.fsencode(name), *(b"%d" % x for x in entry[:-1]), entry.hash.encode(), b""]))
+			os.replace(tmp_file, filename)
+		except BaseException:
+			os.remove(tmp_file)
+			raise
+
+
+def create_manifest(root: str, snapshot: Iterable[FileEntry], old: Optional[Manifest] = None,
+                    hashes: Dict[str, str] = None) -> Iterable[Tuple[str, ManifestEntry]]:
+	"""Create the entries of the manifest from the snapshot of the directory at root,
+	and optionally the hashes of the files, by their full paths: those given, or
+	those in the old manifest, if any, if the files did not change since, or else
+	the files are hashed, and the hashes are added to the given ones.
+	"""
+	if hashes is not None:
+		hashes.update(hash_files([e for e, _, o in join(root, snapshot, old)
+		                          if e is not None and e.path not in hashes and is_changed(e, o)]))
+	for e, name, o in join(root, snapshot, old):
+		if e is not None:
+			h = "" if hashes is None else hashes.get(e.path, "" if is_changed(e, o) else o.hash)
+			yield name, ManifestEntry(*e[1:], hash=h)
+
+
+def join(root: str, snapshot: Iterable[FileEntry],
+         manifest: Optional[Manifest]) -> Iterable[Tuple[Optional[FileEntry], str, Optional[ManifestEntry]]]:
+	"""Iterate the snapshot of the directory at root and the manifest side by side,
+	both in the order of the scan, yielding the snapshot entry (or None for files
+	only in the manifest), relative path and manifest entry (or None) of each file.
+	"""
+	prefix = len(os.path.join(root, ""))
+	old = iter(manifest.items() if manifest is not None else ())
+	name, entry = next(old, (None, None))
+	for e in snapshot:
+		rel = e.path[prefix:]
+		key = scan_key(rel)
+		while name is not None and scan_key(name) < key:
+			yield None, name, entry
+			name, entry = next(old, (None, None))
+		if name == rel:
+			yield e, rel, entry
+			name, entry = next(old, (None, None))
+		else:
+			yield e, rel, None
+	while name is not None:
+		yield None, name, entry
+		name, entry = next(old, (None, None))
+
+
+def iter_changed(root: str, snapshot: Iterable[FileEntry], manifest: Manifest) -> Iterable[FileEntry]:
+	"""Iterate entries in the snapshot that are new or changed compared to the manifest.
+	"""
+	return (e for e, _, old in join(root, snapshot, manifest) if e is not None and is_changed(e, old))
+
+
+def is_changed(entry: FileEntry, old: Optional[ManifestEntry]) -> bool:
+	"""Check whether the file is new or changed compared to its manifest entry, if any."""
+	return old is None or old[:4] != (entry.size, entry.mtime_ns, entry.ino, entry.mode)
+
+
+def verify_changed(root: str, snapshot: Iterable[FileEntry], manifest: Manifest,
+                   hashes: Dict[str, str], threads: int = None) -> List[FileEntry]:
+	"""Get the entries in the snapshot reported as changed by iter_changed, except
+	those whose content is still the same according to the hash in the manifest,
+	if the size is still the same. The hashes that had to be calculated are added
+	to the given dictionary, by the files' full paths; files are hashed in parallel
+	using the given number of threads.
+	"""
+	changed = [(e, old) for e, _, old in join(root, snapshot, manifest) if e is not None and is_changed(e, old)]
+	to_check = [e for e, old in changed if e.path not in hashes and
+	            old is not None and old.hash and old.size == e.size]
+	hashes.update(hash_files(to_check, threads))
+	return [e for e, old in changed if old is None or not old.hash or hashes.get(e.path) != old.hash]
+
+
+def hash_files(entries: List[FileEntry], threads: int = None) -> Dict[str, str]:
+	"""Hash files in parallel, returning dictionary of paths and hashes; files
+	that can not be read or that changed since the snapshot are left out.
+	"""
+	with ThreadPoolExecutor(threads or os.cpu_count() or 1) as pool:
+		return {e.path: h for e, h in zip(entries, pool.map(hash_file, entries)) if h is not None}
+
+
+def hash_file(entry: FileEntry) -> Optional[str]:
+	"""Get BLAKE2 hash of the file's content (hashlib releases the GIL for large
+	updates, so several files can be hashed in parallel), or None on errors or if
+	the file's size or modification time no longer match the snapshot entry.
+	"""
+	h = new_hash()
+	try:
+		with backup_io.open_source(entry.path) as f:
+			while data := f.read(HASH_BUFFER):
+				h.update(data)
+	except OSError:
+		return None
+	return final_hash(h, entry)
+
+
+def new_hash():
+	"""Get a new hash object for the content of a file, see hash_file."""
+	return hashlib.blake2b(digest_size=16)
+
+
+def final_hash(h, entry: FileEntry) -> Optional[str]:
+	"""Get the hash of the file's content, read and added to the hash object e.g.
+	while archiving the file, or None if the file's size or modification time no
+	longer match the snapshot entry.
+	"""
+	try:
+		st = os.stat(entry.path)
+	except OSError:
+		return None
+	return h.hexdigest() if (st.st_size, st.st_mtime_ns) == (entry.size, entry.mtime_ns) else None
+
+
+def get_deleted(root: str, snapshot: Iterable[FileEntry], manifest: Manifest) -> List[str]:
+	"""Get relative paths of files in the manifest no longer present in the snapshot.
+	"""
+	return [name for e, name, _ in join(root, snapshot, manifest) if e is None]
+
+
+def find_hardlinks(members: Iterable[Tuple[FileEntry, str]]) -> Dict[str, str]:
+	"""Find files that are hard links to a file before them, i.e. with the same
+	device and inode, returning the name of that first file by the names of links.
+	"""
+	first, links = {}, {}
+	for entry, name in members:
+		if entry.nlink > 1 and (target := first.setdefault((entry.dev, entry.ino), name)) != name:
+			links[name] = target
+	return links
+
+
+def format_hardlinks(links: Dict[str, str]) -> bytes:
+	"""Format the hard links as content of the list in the archive, i.e. the name of
+	each link followed by the name of the file it links to, each on its own line.
+	"""
+	text = "".join(f"{name}\n{target}\n" for name, target in links.items())
+	return text.replace(os.sep, "/").encode("utf8", "surrogateescape")
+
+
+def parse_hardlinks(data: bytes) -> Dict[str, str]:
+	"""Parse the list of hard links in an archive, see format_hardlinks."""
+	lines = data.decode("utf8", "surrogateescape").splitlines()
+	return dict(zip(lines[::2], lines[1::2]))
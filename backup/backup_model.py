@@ -11,9 +11,17 @@ model to JSON files.
 import json
 import os
 import re
+import threading
+import time
 
-from dataclasses import dataclass
-from typing import Iterable, List
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from backup_exclude import Excludes
+from backup_scan import FileEntry, NETWORK_WORKERS, Snapshot, is_network_path, scan
+import backup_manifest
+import backup_sink
+import backup_watch
 
 
 P_DATE, P_TIME, P_PRNT, P_DIRN, P_INC = "{date}", "{datetime}", "{parent}", "{dirname}", "{inc}"
@@ -32,31 +40,184 @@ class Directory:
 	last_backup: float = -1.0
 	include: bool = False
 	incremental: bool = False
+	compression_level: int = -1
+	hash_check: bool = False
+	exclude: List[str] = field(default_factory=list)
+	exclude_size: int = 0
+	exclude_caches: bool = False
+	scan_workers: int = 0
+	files: int = 0
+	newest_mtime: float = -1.0
+	scanned: float = -1.0
+	delta_size: int = 0
 
 	def check_path(self) -> bool:
 		"""Check whether the given path is a valid directory."""
 		return os.path.isdir(self.path)
 
+	def scan(self, refresh=False, cancel: Optional[threading.Event] = None,
+	         dirty: Optional[backup_watch.DirtySet] = None) -> Snapshot:
+		"""Get snapshot of all regular files in the directory, except excluded ones.
+		The directory tree is walked only once and the snapshot is reused until
+		refresh is requested or the exclude rules changed. The scan can be cancelled
+		using the given event, see backup_scan.scan. If the paths changed since the
+		last backup are known from the watcher's journal, only those are scanned, as
+		long as the exclude rules are still the same as when the watcher started.
+		The number of files, newest modification time and time of the scan are kept
+		as statistics, so they can be shown without scanning again on next start.
+		The snapshot is kept in a temporary file, see backup_scan.Snapshot.
+		"""
+		excludes = self.excludes()
+		if refresh or getattr(self, "_snapshot", None) is None or excludes != self._snapshot_excludes:
+			manifest = self.manifest()
+			# the journal can not be used if the exclude rules changed since the watcher started
+			if dirty is not None and manifest is not None and dirty.excludes == excludes:
+				self._snapshot_time = dirty.loaded
+				self._snapshot = backup_watch.scan_dirty(self.path, manifest, dirty.paths, excludes)
+			else:
+				self._snapshot_time = time.time()
+				self._snapshot = scan(self.path, cancel, excludes, self.workers())
+			self._snapshot_excludes = excludes
+			self._modified = None
+			self.files = len(self._snapshot)
+			self.newest_mtime = max((e.mtime for e in self._snapshot), default=-1.0)
+			self.scanned = self._snapshot_time
+		return self._snapshot
+
+	def workers(self) -> int:
+		"""Get the number of threads for scanning the directory: the configured
+		number, or by default several for network file systems and one otherwise.
+		"""
+		if self.scan_workers > 0:
+			return self.scan_workers
+		return NETWORK_WORKERS if is_network_path(self.path) else 1
+
+	def snapshot_time(self) -> float:
+		"""Get the time the current snapshot was taken, i.e. it contains all changes
+		made before that time.
+		"""
+		return self._snapshot_time
+
+	def excludes(self) -> Excludes:
+		"""Get the exclude rules for this directory, combining the global rules of
+		the configuration (see Configuration.apply_excludes) with its own rules.
+		"""
+		patterns, size, caches = getattr(self, "_global_excludes", ([], 0, False))
+		key = (*patterns, *self.exclude), self.exclude_size or size, self.exclude_caches or caches
+		if getattr(self, "_excludes", None) is None or self._excludes_key != key:
+			self._excludes, self._excludes_key = Excludes(*key), key
+		return self._excludes
+
 	def iter_files(self) -> Iterable[str]:
 		"""Iterate all (nested) fiels in the directory, yielding full absolute paths."""
-		return (os.path.join(d, f) for d, _, fs in os.walk(self.path) for f in fs)
+		return (e.path for e in self.scan())
 
 	def iter_modified(self) -> Iterable[str]:
 		"""Iterate modified files only."""
-		return (f for f in self.iter_files() if os.path.getmtime(f) > self.last_backup)
+		return (e.path for e in self.modified_entries())
 
 	def iter_include(self) -> Iterable[str]:
 		"""Iterate all or modified fiels, depending on whether it is a incremental backup."""
-		return self.iter_modified() if self.incremental else self.iter_files()
+		return (e.path for e in self.include_entries())
+
+	def manifest(self, refresh=False) -> Optional[backup_manifest.Manifest]:
+		"""Get manifest of the files contained in the last backup, if any; the manifest
+		is read from its file each time it is used, see backup_manifest.Manifest.
+		"""
+		if refresh or not hasattr(self, "_manifest"):
+			self._manifest = backup_manifest.load_manifest(self.path)
+			self._modified = None
+		return self._manifest
+
+	def update_manifest(self):
+		"""Save the current snapshot as manifest, i.e. after a backup was created.
+		With hash_check, the files' hashes are kept from the last manifest if the
+		files did not change, or taken from archiving them (see Checkpoint.hashes),
+		and only calculated for files whose hash is still missing, e.g. files stored
+		as deltas, or when continuing an interrupted backup. The manifest is written
+		while reading the last one, without keeping either in memory.
+		"""
+		hashes = self.hashes() if self.hash_check else None
+		entries = backup_manifest.create_manifest(self.path, self.scan(), self.manifest(), hashes)
+		backup_manifest.save_manifest(self.path, entries)
+		self._manifest = backup_manifest.Manifest(backup_manifest.manifest_file(self.path))
+		self._modified = None
+
+	def hashes(self) -> Dict[str, str]:
+		"""Get hashes of files calculated for the current snapshot, by full path."""
+		if getattr(self, "_hashes_of", None) is not self.scan():
+			self._hashes, self._hashes_of = {}, self.scan()
+		return self._hashes
+
+	def modified_entries(self) -> Iterable[FileEntry]:
+		"""Iterate snapshot entries of modified files only, i.e. files that were
+		added, changed or moved here since the last backup according to the manifest,
+		or with a newer modification time if there is no manifest yet. With hash_check,
+		files whose content is still the same as in the last backup are not included.
+		"""
+		manifest = self.manifest()
+		if manifest is None:
+			return (e for e in self.scan() if e.mtime > self.last_backup)
+		if getattr(self, "_modified", None) is None:
+			if self.hash_check:
+				changed = backup_manifest.verify_changed(self.path, self.scan(), manifest, self.hashes())
+			else:
+				changed = backup_manifest.iter_changed(self.path, self.scan(), manifest)
+			self._modified = Snapshot(changed)
+		return iter(self._modified)
+
+	def deleted_files(self) -> List[str]:
+		"""Get full paths of files deleted since the last backup according to the manifest."""
+		manifest = self.manifest()
+		if manifest is None:
+			return []
+		return [os.path.join(self.path, f) for f in backup_manifest.get_deleted(self.path, self.scan(), manifest)]
+
+	def include_entries(self) -> Iterable[FileEntry]:
+		"""Iterate snapshot entries of all or modified files, see iter_include."""
+		return self.modified_entries() if self.incremental else iter(self.scan())
+
+	def update_include(self, save_verified=True):
+		"""Update this Directory's 'include' flag based on modified and deleted files,
+		and unless save_verified is False, e.g. in a background scan that must not
+		write anything, save the entries of files verified to be unchanged.
+		"""
+		self.include = self.check_path() and (any(self.iter_modified()) or any(self.deleted_files()))
+		if save_verified and self.hash_check and self.manifest() is not None:
+			self.update_verified()
+
+	def update_verified(self):
+		"""Update manifest entries of files whose size, modification time or inode
+		changed, but whose content was verified to be the same as in the last backup,
+		so they do not have to be hashed again next time.
+		"""
+		modified, hashes = {e.path for e in self.modified_entries()}, self.hashes()
+		if all(p in modified for p in hashes):
+			return  # no files were verified
+
+		def entries():
+			for e, name, old in backup_manifest.join(self.path, self.scan(), self.manifest()):
+				if old is not None:
+					verified = e is not None and e.path not in modified and backup_manifest.is_changed(e, old)
+					yield name, backup_manifest.ManifestEntry(*e[1:], hash=hashes[e.path]) if verified else old
+
+		backup_manifest.save_manifest(self.path, entries())
+
+	def iter_members(self, all_files=False) -> Iterable[Tuple[FileEntry, str]]:
+		"""Iterate files to be included (or all files), as pairs of snapshot entry
+		and relative path.
+		"""
+		return self.to_members(self.scan() if all_files else self.include_entries())
+
+	def to_members(self, entries: Iterable[FileEntry]) -> Iterable[Tuple[FileEntry, str]]:
+		"""Transform snapshot entries to pairs of entry and relative path, see iter_members."""
+		par = self.parent()
+		return ((e, os.path.relpath(e.path, par)) for e in entries)
 
-	def update_include(self):
-		"""Update this Directory's 'include' flag based on last modification time."""
-		self.include = any(self.iter_modified())
-		
 	def to_relative(self, paths: Iterable[str]) -> Iterable[str]:
 		"""Transfort paths to relative paths."""
 		par = self.parent()
-		return (os.path.relpath(p, par) for p in paths if os.path.isfile(p))  # isfile to skip "pipe" files
+		return (os.path.relpath(p, par) for p in paths)  # snapshot contains only regular files
 	
 	def parent(self):
 		"""Get parent directory."""
@@ -70,6 +231,24 @@ class Configuration:
 
 	target_pattern: str
 	directories: List[Directory]
+	jobs: int = 1
+	sink: str = "local"
+	volume_size: int = 0
+	exclude: List[str] = field(default_factory=list)
+	exclude_size: int = 0
+	exclude_caches: bool = False
+	read_buffer: int = 0
+	drop_cache: bool = True
+
+	def __post_init__(self):
+		self.apply_excludes()
+
+	def apply_excludes(self):
+		"""Pass the global exclude rules on to all directories, e.g. after changing
+		them or adding directories; the directories' own rules are added to those.
+		"""
+		for directory in self.directories:
+			directory._global_excludes = (self.exclude, self.exclude_size, self.exclude_caches)
 
 	def check(self):
 		"""Check whether target_pattern is valid and all Directories point to actual
@@ -85,11 +264,18 @@ class Configuration:
 		for directory in self.directories:
 			if not directory.check_path():
 				raise Exception(f"{directory.path} is not a valid directory")
+		if self.sink not in backup_sink.KNOWN_SINKS:
+			raise Exception(f"Invalid Sink: {self.sink}")
 
-	def update_includes(self):
-		"""Update 'include' flag of all contained directories."""
+	def update_includes(self, dirty: Dict[str, backup_watch.DirtySet] = None):
+		"""Update 'include' flag of all contained directories, scanning only the
+		paths changed according to the watcher's journal, if known.
+		"""
+		self.apply_excludes()
 		for directory in self.directories:
-			directory.include = directory.check_path() and any(directory.iter_modified())
+			directory.manifest(refresh=True)
+			directory.scan(refresh=True, dirty=(dirty or {}).get(directory.path))
+			directory.update_include()
 
 
 def load_from_json(json_string: str) -> Configuration:
@@ -103,6 +289,12 @@ def load_from_json(json_string: str) -> Configuration:
 def write_to_json(conf: Configuration) -> str:
 	"""Store backup configuration in JSON file.
 	"""
-	config = dict(conf.__dict__)
-	config["directories"] = [d.__dict__ for d in config["directories"]]
+	config = public_dict(conf)
+	config["directories"] = [public_dict(d) for d in config["directories"]]
 	return json.dumps(config, indent=4)
+
+
+def public_dict(obj) -> dict:
+	"""Get the attributes of the object, without internal (cached) attributes.
+	"""
+	return {k: v for k, v in obj.__dict__.items() if not k.startswith("_")}
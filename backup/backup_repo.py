@@ -0,0 +1,282 @@
+# -*- coding: utf8 -*-
+
+"""
+Deduplicating chunk repository for simple Backup tool.
+by Tobias Küster, 2026
+
+Instead of creating a new archive with all the files each time, the "repo" archive
+type splits the files into chunks, stores each distinct chunk just once in a
+repository directory, and writes a small snapshot file listing the files and
+their chunks. Repeated full backups of large, slowly changing directories thus
+only have to store the chunks that actually changed.
+
+The chunk boundaries are content-defined, so inserting or removing some bytes in
+a file does not shift all the following chunks: each byte is mapped to a single
+pseudo-random bit, and a chunk ends after the first 20-byte window whose bits
+form a fixed pattern (i.e. on average every 1 MB of random data). This window
+fingerprint plays the role of a rolling hash, but can be computed using
+bytes.translate and bytes.find, which is much faster than rolling a hash over
+each byte in Python. Files not changed since the last snapshot (according to
+their size, modification time and inode) are not read at all, but their chunks
+are taken from that snapshot.
+
+The repository is located in a directory "chunks" in the part of the target
+pattern before the first placeholder, so it does not change with the date and
+is shared by all snapshots; each snapshot names it, relative to itself. It holds the
+chunks in files named after the BLAKE2 hash of their content, compressed with
+zlib, as well as a pointer to the latest snapshot of each backed up directory.
+Snapshot files hold one line of JSON for each file, in the order of the scan, so
+they are written, compared to the previous snapshot and read without keeping the
+list of files in memory.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import random
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import backup_io
+from backup_archive import matches
+from backup_journal import PART_EXT
+from backup_scan import FileEntry, scan_key
+from backup_stats import ArchiveStats
+
+
+REPO_DIR = "chunks"
+LATEST_DIR = "latest"
+
+MIN_SIZE = 1 << 18
+MAX_SIZE = 1 << 22
+READ_SIZE = 1 << 22
+DEFAULT_LEVEL = 3
+
+# each byte is mapped to "a" or "b"; a chunk ends after the first occurrence of PATTERN
+_random = random.Random(0x5eed)
+_bits = [0] * 128 + [1] * 128
+_random.shuffle(_bits)
+BIT_TABLE = bytes(b"ab"[b] for b in _bits)
+PATTERN = bytes(_random.choice(b"ab") for _ in range(20))
+
+STORED, COMPRESSED = b"\0", b"\1"
+
+
+def get_repository(target_pattern: str) -> str:
+	"""Get the repository directory for the given target pattern, in the directory
+	of the part before the first placeholder.
+	"""
+	return os.path.join(os.path.dirname(target_pattern.split("{", 1)[0]), REPO_DIR)
+
+
+def snapshot_repository(snapshot_file: str) -> str:
+	"""Get the repository holding the chunks of the given snapshot file, as named in
+	the snapshot, or for older snapshots, the one next to it.
+	"""
+	with gzip.open(snapshot_file, "rt", encoding="utf8", errors="surrogateescape") as f:
+		repo = json.loads(f.readline()).get("repo", REPO_DIR)
+	return os.path.normpath(os.path.join(os.path.dirname(snapshot_file), repo))
+
+
+def iter_chunks(f) -> Iterable[bytes]:
+	"""Read the file and split it into content-defined chunks, see module doc.
+	"""
+	buffer = b""
+	eof = False
+	while not eof:
+		data = f.read(READ_SIZE)
+		eof = not data
+		buffer += data
+		while len(buffer) >= MAX_SIZE or eof and buffer:
+			cut = find_cut(buffer)
+			yield buffer[:cut]
+			buffer = buffer[cut:]
+
+
+def find_cut(data: bytes) -> int:
+	"""Find end of the first chunk in the data, between MIN_SIZE and MAX_SIZE."""
+	if len(data) <= MIN_SIZE:
+		return len(data)
+	end = min(len(data), MAX_SIZE)
+	start = MIN_SIZE - len(PATTERN)
+	pos = data[start:end].translate(BIT_TABLE).find(PATTERN)
+	return end if pos < 0 else start + pos + len(PATTERN)
+
+
+def chunk_path(repo: str, digest: str) -> str:
+	"""Get path of chunk with the given hash in the repository."""
+	return os.path.join(repo, digest[:2], digest)
+
+
+def store_chunk(repo: str, chunk: bytes, level: int) -> Tuple[str, int]:
+	"""Store a chunk in the repository, unless it is already there, and return
+	its hash and the number of bytes written. Chunks are synced to disk only at the
+	end of a backup, so a chunk left incomplete by a crash before that, which does
+	not match its hash, is written again.
+	"""
+	digest = hashlib.blake2b(chunk, digest_size=20).hexdigest()
+	path = chunk_path(repo, digest)
+	if is_valid_chunk(repo, digest):
+		return digest, 0
+	compressed = zlib.compress(chunk, level)
+	data = COMPRESSED + compressed if len(compressed) < len(chunk) else STORED + chunk
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	tmp = f"{path}.{os.getpid()}.{id(chunk)}.tmp"
+	with open(tmp, "wb") as f:
+		f.write(data)
+	os.replace(tmp, path)
+	return digest, len(data)
+
+
+def is_valid_chunk(repo: str, digest: str) -> bool:
+	"""Check whether the chunk with the given hash is in the repository and intact."""
+	try:
+		return hashlib.blake2b(load_chunk(repo, digest), digest_size=20).hexdigest() == digest
+	except (OSError, zlib.error):
+		return False
+
+
+def load_chunk(repo: str, digest: str) -> bytes:
+	"""Load chunk with the given hash from the repository."""
+	with open(chunk_path(repo, digest), "rb") as f:
+		data = f.read()
+	return zlib.decompress(data[1:]) if data[:1] == COMPRESSED else data[1:]
+
+
+def iter_files(snapshot_file: str) -> Iterator[dict]:
+	"""Iterate the files listed in the snapshot file, with their chunks, in the order
+	of the scan. Older snapshots, holding all the files in a single JSON object, are
+	loaded at once and sorted.
+	"""
+	with gzip.open(snapshot_file, "rt", encoding="utf8", errors="surrogateescape") as f:
+		header = json.loads(f.readline())
+		if "files" in header:
+			yield from sorted(header["files"], key=lambda x: scan_key(x["name"]))
+			return
+		for line in f:
+			record = json.loads(line)
+			if "name" in record:
+				yield record
+
+
+def latest_snapshot(repo: str, path: str) -> Optional[str]:
+	"""Get the latest snapshot file of the directory with the given path, if any."""
+	try:
+		with open(latest_file(repo, path)) as f:
+			snapshot_file = f.read().strip()
+	except OSError:
+		return None
+	return snapshot_file if os.path.exists(snapshot_file) else None
+
+
+def latest_file(repo: str, path: str) -> str:
+	"""Get file pointing to the latest snapshot of the directory with the given path."""
+	name = hashlib.sha1(os.path.abspath(path).encode("utf8", "surrogateescape")).hexdigest()
+	return os.path.join(repo, LATEST_DIR, name)
+
+
+def write_snapshot(path: str, files: Iterable[Tuple[FileEntry, str]], target_file: str, repo: str,
+                   extra: Dict[str, bytes] = None, threads: int = None, level: int = -1) -> ArchiveStats:
+	"""Back up the given files, as pairs of snapshot entry and name in the archive,
+	of the directory with the given path to the given repository, and write the
+	list of files and chunks to the target file. Chunks are
+	hashed, compressed and written using the given number of threads. The files
+	have to be in the order of the scan, so they are compared to the ones in the
+	previous snapshot while reading both.
+	"""
+	level = DEFAULT_LEVEL if level < 0 else level
+	latest = latest_snapshot(repo, path)
+	previous = iter_files(latest) if latest is not None else iter(())
+	old = next(previous, None)
+	stats = ArchiveStats()
+
+	threads = threads or os.cpu_count() or 1
+	new_chunks = []
+	with ThreadPoolExecutor(threads) as pool:
+		def store_all(chunks: Iterable[bytes]) -> List[str]:
+			digests, in_flight = [], deque()
+			def collect():
+				digest, written = in_flight.popleft().result()
+				digests.append(digest)
+				stats.bytes_out += written
+				if written:
+					new_chunks.append(chunk_path(repo, digest))
+			for chunk in chunks:
+				in_flight.append(pool.submit(store_chunk, repo, chunk, level))
+				if len(in_flight) > 2 * threads:
+					collect()
+			while in_flight:
+				collect()
+			return digests
+
+		with gzip.open(target_file + PART_EXT, "wt", encoding="utf8", errors="surrogateescape") as out:
+			out.write(json.dumps({"path": path, "created": dt.now().timestamp(),
+			                      "repo": os.path.relpath(repo, os.path.dirname(target_file))}) + "\n")
+			for entry, arcname in files:
+				key = scan_key(arcname)
+				while old is not None and scan_key(old["name"]) < key:
+					old = next(previous, None)
+				if old is not None and old["name"] == arcname and \
+				   (old["size"], old["mtime_ns"], old["ino"]) == (entry.size, entry.mtime_ns, entry.ino):
+					chunks = old["chunks"]
+				else:
+					with backup_io.open_source(entry.path) as f:
+						chunks = store_all(iter_chunks(f))
+				out.write(json.dumps({"name": arcname, "size": entry.size, "mtime_ns": entry.mtime_ns,
+				                      "ino": entry.ino, "mode": entry.mode, "chunks": chunks}) + "\n")
+				stats.files += 1
+				stats.bytes_in += entry.size
+			out.write(json.dumps({"extra": {name: store_all(iter_chunks_bytes(data))
+			                                for name, data in (extra or {}).items()}}) + "\n")
+
+	# the new chunks (and then the snapshot) are synced to disk all at once at the end
+	backup_io.sync_files(new_chunks)
+	backup_io.sync_files([target_file + PART_EXT])
+	os.replace(target_file + PART_EXT, target_file)
+	stats.bytes_out += os.path.getsize(target_file)
+
+	# the pointer is replaced atomically, so there always is a valid latest snapshot
+	latest = latest_file(repo, path)
+	os.makedirs(os.path.dirname(latest), exist_ok=True)
+	with open(latest + PART_EXT, "w") as f:
+		f.write(os.path.abspath(target_file))
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(latest + PART_EXT, latest)
+	return stats
+
+
+def iter_chunks_bytes(data: bytes) -> Iterable[bytes]:
+	"""Split data already in memory into chunks, see iter_chunks."""
+	while data:
+		cut = find_cut(data)
+		yield data[:cut]
+		data = data[cut:]
+
+
+def restore_snapshot(snapshot_file: str, target_dir: str, names: Iterable[str] = None) -> ArchiveStats:
+	"""Restore all files, or just the files with the given names or in the
+	directories with the given names, listed in the snapshot file to the target
+	directory, using the same relative paths as they would have in a zip or tar
+	archive.
+	"""
+	repo = snapshot_repository(snapshot_file)
+	names = list(names) if names is not None else None
+	stats = ArchiveStats()
+	for f in iter_files(snapshot_file):
+		if names is not None and not matches(f["name"], names):
+			continue
+		path = os.path.join(target_dir, f["name"])
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "wb") as out:
+			for digest in f["chunks"]:
+				out.write(load_chunk(repo, digest))
+		os.chmod(path, f["mode"] & 0o7777)
+		os.utime(path, ns=(f["mtime_ns"], f["mtime_ns"]))
+		stats.files += 1
+		stats.bytes_out += f["size"]
+	return stats
@@ -0,0 +1,292 @@
+# -*- coding: utf8 -*-
+
+"""
+File system scanner for simple Backup tool.
+by Tobias Küster, 2026
+
+Walks a directory tree once using os.scandir and records a snapshot of all the
+regular files found in it, i.e. their paths, sizes, modification times, inodes
+and file modes, as well as devices, link counts and allocated blocks (to find
+hard links and sparse files). This snapshot is then shared by all the parts of
+the program that need to know about the files, like determining whether a backup
+is needed, calculating the size of a directory, or creating the archive, instead
+of each of those walking the tree and stat-ing the files again. Files and
+directories excluded from the backup are left out already while scanning, see
+backup_exclude. The entries of each directory are sorted by name, so snapshots
+(and manifests, see backup_manifest) are always in the same order and can be
+compared by iterating both side by side.
+
+Directories may hold millions of files, so the snapshot is not kept in memory as
+a list, but encoded compactly and spilled to a temporary file, and decoded again
+each time it is iterated; that way, the memory used by the backup does not grow
+with the number of files.
+
+On network file systems (like NFS or SMB), each directory listing and each stat
+is a round trip to the server, so scanning is bound by latency, not bandwidth.
+There, the directories are listed and the files stat-ed by a pool of threads,
+many at a time, while the result is still in the same order as a serial scan.
+"""
+
+import os
+import stat
+import struct
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from backup_exclude import Excludes
+
+
+class FileEntry(NamedTuple):
+	"""Class representing a single regular file found while scanning a directory.
+	"""
+
+	path: str
+	size: int
+	mtime_ns: int
+	ino: int
+	mode: int
+	dev: int = 0
+	nlink: int = 1
+	blocks: int = -1  # allocated 512-byte blocks, or -1 if not known
+
+	@classmethod
+	def from_stat(cls, path: str, st: os.stat_result) -> "FileEntry":
+		"""Create entry for the file with the given path and stat result."""
+		return cls(path, st.st_size, st.st_mtime_ns, st.st_ino, st.st_mode, st.st_dev, st.st_nlink,
+		           getattr(st, "st_blocks", -1))
+
+	@property
+	def mtime(self) -> float:
+		"""Get modification time as float timestamp, like os.path.getmtime."""
+		return self.mtime_ns / 1e9
+
+
+# file system types where a parallel scan is used by default, and its number of threads
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "glusterfs", "lustre",
+                       "fuse.sshfs", "fuse.rclone", "davfs", "fuse.davfs2"}
+NETWORK_WORKERS = 16
+# files in one directory are stat-ed in batches of this size
+STAT_BATCH = 64
+# snapshots are spilled to a temporary file in blocks of this size, and read in such blocks
+SPILL_SIZE = 1 << 20
+# encoding of a snapshot entry: size, mtime_ns, ino, mode, dev, nlink, blocks, length of path
+ENTRY = struct.Struct("<qqQIQQqI")
+
+
+class Cancelled(Exception):
+	"""Exception raised when a scan is cancelled before it is finished."""
+
+
+class Snapshot:
+	"""Class representing a snapshot, i.e. a sequence of entries of files, which
+	are encoded and spilled to a temporary file (but for the last few), instead of
+	being kept in memory. Entries can only be appended; the snapshot can then be
+	iterated any number of times, also several times at once.
+	"""
+
+	def __init__(self, entries: Iterable[FileEntry] = ()):
+		self._file = None
+		self._buffer = bytearray()
+		self._spilled = 0
+		self._count = 0
+		self.extend(entries)
+
+	def append(self, entry: FileEntry):
+		path = os.fsencode(entry.path)
+		self._buffer += ENTRY.pack(*entry[1:], len(path))
+		self._buffer += path
+		self._count += 1
+		if len(self._buffer) >= SPILL_SIZE:
+			self._spill()
+
+	def extend(self, entries: Iterable[FileEntry]):
+		for entry in entries:
+			self.append(entry)
+
+	def _spill(self):
+		if self._file is None:
+			self._file = tempfile.TemporaryFile(prefix="backup-snapshot-")
+		os.pwrite(self._file.fileno(), self._buffer, self._spilled)
+		self._spilled += len(self._buffer)
+		self._buffer = bytearray()  # not cleared, as iterators may still use it
+
+	def __len__(self) -> int:
+		return self._count
+
+	def __iter__(self) -> Iterator[FileEntry]:
+		# entries appended while iterating are not included
+		spilled, buffer, offset, rest = self._spilled, self._buffer[:], 0, b""
+		while offset < spilled:
+			block = os.pread(self._file.fileno(), min(SPILL_SIZE, spilled - offset), offset)
+			offset += len(block)
+			rest = yield from decode_entries(rest + block)
+		yield from decode_entries(rest + buffer)
+
+
+def decode_entries(data: bytes) -> Iterator[FileEntry]:
+	"""Decode the snapshot entries in the data, see Snapshot, and return the rest
+	of the data after the last complete entry.
+	"""
+	pos, size = 0, ENTRY.size
+	while pos + size <= len(data):
+		*fields, length = ENTRY.unpack_from(data, pos)
+		if pos + size + length > len(data):
+			break
+		yield FileEntry(os.fsdecode(data[pos + size:pos + size + length]), *fields)
+		pos += size + length
+	return data[pos:]
+
+
+def scan_key(path: str) -> Tuple[List[str], str]:
+	"""Get the key for sorting paths (all absolute, or all relative to the same
+	directory) in the order of the scan, i.e. the files of each directory sorted by
+	name, followed by those of each of its subdirectories, also sorted by name.
+	"""
+	head, _, tail = path.rpartition(os.sep)
+	return head.split(os.sep), tail
+
+
+def scan(root: str, cancel: Optional[threading.Event] = None, excludes: Optional[Excludes] = None,
+         workers: int = 1) -> Snapshot:
+	"""Walk the directory tree under root and return a snapshot of all regular files
+	in it, in the same order as os.walk would, but with the entries of each directory
+	sorted by name (see scan_key). Symlinks to directories are not followed, symlinks
+	to files are included, and special files like pipes and sockets are skipped, as
+	they can not be put into an archive anyway. Files and directories matching the
+	exclude rules, if any, are skipped, too. If the cancel event is set while
+	scanning, Cancelled is raised. With more than one worker, the tree is scanned
+	in parallel, see iter_scan_parallel.
+	"""
+	if workers > 1:
+		return Snapshot(iter_scan_parallel(root, cancel, excludes, workers=workers))
+	return Snapshot(iter_scan(root, cancel, excludes))
+
+
+def iter_scan(root: str, cancel: Optional[threading.Event] = None,
+              excludes: Optional[Excludes] = None, top: str = None) -> Iterable[FileEntry]:
+	"""Iterate the regular files in the directory tree under root, see scan, or
+	only in the given subdirectory of root (with the exclude rules relative to root).
+	"""
+	excludes = excludes or None
+	prefix = len(os.path.join(root, ""))
+	stack = [top or root]
+	while stack:
+		if cancel is not None and cancel.is_set():
+			raise Cancelled(root)
+		top = stack.pop()
+		try:
+			with os.scandir(top) as it:
+				entries = sorted(it, key=lambda e: e.name)
+		except OSError:
+			continue  # vanished or not readable, same as os.walk
+		if excludes is not None and excludes.is_cache(top, [e.name for e in entries]):
+			continue
+		subdirs = []
+		for entry in entries:
+			try:
+				if entry.is_dir(follow_symlinks=False):
+					if excludes is None or not excludes.excluded(entry.path[prefix:], True):
+						subdirs.append(entry.path)
+					continue
+				if excludes is not None and excludes.excluded(entry.path[prefix:], False):
+					continue
+				st = entry.stat()
+			except OSError:
+				continue  # e.g. broken symlink, or file deleted in the meantime
+			if stat.S_ISREG(st.st_mode) and (excludes is None or not excludes.too_large(st.st_size)):
+				yield FileEntry.from_stat(entry.path, st)
+		stack.extend(reversed(subdirs))
+
+
+def iter_scan_parallel(root: str, cancel: Optional[threading.Event] = None, excludes: Optional[Excludes] = None,
+                       top: str = None, workers: int = NETWORK_WORKERS) -> Iterable[FileEntry]:
+	"""Iterate the regular files in the directory tree under root, like iter_scan
+	and in the same order, but listing directories and stat-ing files using the
+	given number of threads. Each directory listed submits listing its
+	subdirectories (and stat-ing its files, in batches) right away, so the whole
+	tree is scanned concurrently, while the results are collected in the same
+	order as the serial scan.
+	"""
+	excludes = excludes or None
+	prefix = len(os.path.join(root, ""))
+
+	stopped = threading.Event()
+
+	def list_dir(path: str) -> List[Tuple[bool, Future]]:
+		"""List the directory and submit stat-ing its files and listing its
+		subdirectories right away, returning the pending results in order."""
+		if stopped.is_set():
+			return []
+		try:
+			with os.scandir(path) as it:
+				entries = sorted(it, key=lambda e: e.name)
+		except OSError:
+			return []
+		if excludes is not None and excludes.is_cache(path, [e.name for e in entries]):
+			return []
+		files, subdirs = [], []
+		for entry in entries:
+			try:
+				if entry.is_dir(follow_symlinks=False):
+					if excludes is None or not excludes.excluded(entry.path[prefix:], True):
+						subdirs.append(entry.path)
+				elif excludes is None or not excludes.excluded(entry.path[prefix:], False):
+					files.append(entry)
+			except OSError:
+				continue
+		return [(False, pool.submit(stat_files, files[i:i + STAT_BATCH])) for i in range(0, len(files), STAT_BATCH)] + \
+		       [(True, pool.submit(list_dir, d)) for d in subdirs]
+
+	def stat_files(entries: List[os.DirEntry]) -> List[FileEntry]:
+		result = []
+		for entry in entries:
+			if stopped.is_set():
+				break
+			try:
+				st = entry.stat()
+			except OSError:
+				continue
+			if stat.S_ISREG(st.st_mode) and (excludes is None or not excludes.too_large(st.st_size)):
+				result.append(FileEntry.from_stat(entry.path, st))
+		return result
+
+	with ThreadPoolExecutor(workers) as pool:
+		# stack of pending results, either of listing a directory or of stat-ing files
+		stack = [(True, pool.submit(list_dir, top or root))]
+		try:
+			while stack:
+				if cancel is not None and cancel.is_set():
+					raise Cancelled(root)
+				is_dir, future = stack.pop()
+				if is_dir:
+					stack.extend(reversed(future.result()))
+				else:
+					yield from future.result()
+		finally:
+			stopped.set()
+
+
+def is_network_path(path: str) -> bool:
+	"""Check whether the path is on a network file system, according to the mount
+	table, so it should be scanned in parallel.
+	"""
+	path, best, fstype = os.path.realpath(path), "", None
+	try:
+		with open("/proc/self/mounts") as f:
+			for line in f:
+				fields = line.split()
+				if len(fields) < 3:
+					continue
+				mount = fields[1].replace("\\040", " ")
+				if (path == mount or path.startswith(os.path.join(mount, ""))) and len(mount) >= len(best):
+					best, fstype = mount, fields[2]
+	except OSError:
+		return False
+	return fstype in NETWORK_FILESYSTEMS
+
+
+def total_size(entries: Iterable[FileEntry]) -> int:
+	"""Get the total size of all the files in the snapshot."""
+	return sum(e.size for e in entries)
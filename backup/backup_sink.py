@@ -0,0 +1,334 @@
+# -*- coding: utf8 -*-
+
+"""
+Storage sinks for simple Backup tool.
+by Tobias Küster, 2026
+
+By default, archives are written directly to the target file in the local file
+system. For slower targets, like USB drives, network shares, or cloud storage,
+a sink can be configured instead: the archive is then written to a PipeWriter
+that collects the bytes in blocks and hands them over to a separate transfer
+thread through a bounded queue, so compressing the files and transferring the
+archive to the target happen at the same time (and the whole backup takes about
+as long as the slower of the two, instead of both added up), while the queue
+limits how much of the archive is held in memory.
+
+Optionally, the archive is split into volumes of a fixed size, named like the
+target file with ".001", ".002", etc. appended; the original archive is restored
+by simply concatenating the volumes, e.g. using `cat`. Such a volume set is found,
+cataloged and read as a single archive under the name of its first volume.
+
+Available sinks:
+- local: local file system, writing to ".part" files renamed when complete
+- removable: like local, but checking that the drive is actually mounted (and
+  not writing to the system disk instead) and syncing the volumes to disk
+- object: object store with multipart uploads, where each volume becomes an
+  object that is only visible once it is complete; here, a stand-in storing the
+  objects in the local file system is used, which can be replaced by an actual
+  object store client by implementing the same methods
+"""
+
+import bisect
+import io
+import os
+import queue
+import shutil
+import threading
+import uuid
+from typing import BinaryIO, List
+
+from backup_journal import PART_EXT
+
+
+SINK_LOCAL = "local"
+SINK_REMOVABLE = "removable"
+SINK_OBJECT = "object"
+KNOWN_SINKS = (SINK_LOCAL, SINK_REMOVABLE, SINK_OBJECT)
+
+BLOCK_SIZE = 8 << 20
+QUEUE_BLOCKS = 4
+UPLOADS_DIR = ".uploads"
+FIRST_VOLUME = ".001"
+
+
+class Sink:
+	"""Base class for sinks, writing volumes to the local file system.
+	"""
+
+	sync = False
+
+	def __init__(self, volume_size=0):
+		self.volume_size = volume_size
+
+	def open(self, target_file: str) -> "PipeWriter":
+		"""Open a file-like object for writing the archive with the given name."""
+		return PipeWriter(self, target_file)
+
+	def open_volume(self, name: str):
+		"""Start writing a volume with the given name, returning a handle for it."""
+		os.makedirs(os.path.dirname(name), exist_ok=True)
+		return open(name + PART_EXT, "wb")
+
+	def write_volume(self, handle, data: bytes):
+		"""Write the next block of data to the volume."""
+		handle.write(data)
+
+	def close_volume(self, handle):
+		"""Finish writing the volume, without making it visible under its name yet."""
+		if self.sync:
+			handle.flush()
+			os.fsync(handle.fileno())
+		handle.close()
+
+	def commit(self, names: List[str]):
+		"""Make the completely written volumes visible under their names."""
+		for name in names:
+			os.replace(name + PART_EXT, name)
+
+
+class RemovableSink(Sink):
+	"""Sink for removable drives, checking that the drive is mounted and syncing
+	the volumes to the drive before they are committed.
+	"""
+
+	sync = True
+
+	def open_volume(self, name: str):
+		"""Check that the target is on a mounted drive, then start writing the volume."""
+		path = os.path.dirname(os.path.abspath(name))
+		while not os.path.exists(path):
+			path = os.path.dirname(path)
+		if os.stat(path).st_dev == os.stat("/").st_dev:
+			raise Exception(f"Removable drive for {name} is not mounted")
+		return super().open_volume(name)
+
+
+class ObjectSink(Sink):
+	"""Sink for object stores, uploading each volume as an object in several parts.
+	This is a local stand-in for an actual object store: the "bucket" is the
+	directory of the target file, uploaded parts are kept in a staging directory
+	in the bucket, and completing the upload combines them into the object.
+	"""
+
+	def __init__(self, volume_size=0):
+		super().__init__(volume_size)
+		self.uploads = {}  # name -> upload id, list of parts
+
+	def open_volume(self, name: str):
+		"""Start a multipart upload of the object with the given name."""
+		self.uploads[name] = (self.create_multipart_upload(name), [])
+		return name
+
+	def write_volume(self, handle, data: bytes):
+		"""Upload the next block of data as the next part of the object."""
+		upload_id, parts = self.uploads[handle]
+		parts.append(self.upload_part(upload_id, len(parts) + 1, data))
+
+	def close_volume(self, handle):
+		"""Nothing to do, all parts are uploaded already."""
+
+	def commit(self, names: List[str]):
+		"""Complete the uploads of all volumes, making the objects visible."""
+		for name in names:
+			self.complete_multipart_upload(name, *self.uploads.pop(name))
+
+	def create_multipart_upload(self, name: str) -> str:
+		"""Start upload of the object with the given name, returning the upload id."""
+		upload_id = os.path.join(os.path.dirname(name), UPLOADS_DIR, uuid.uuid4().hex)
+		os.makedirs(upload_id)
+		return upload_id
+
+	def upload_part(self, upload_id: str, number: int, data: bytes) -> str:
+		"""Upload a part of the object, returning its identifier (here, its file)."""
+		part = os.path.join(upload_id, f"{number:05d}")
+		with open(part, "wb") as f:
+			f.write(data)
+		return part
+
+	def complete_multipart_upload(self, name: str, upload_id: str, parts: List[str]):
+		"""Combine the uploaded parts into the object with the given name."""
+		with open(name + PART_EXT, "wb") as out:
+			for part in parts:
+				with open(part, "rb") as f:
+					shutil.copyfileobj(f, out)
+		os.replace(name + PART_EXT, name)
+		shutil.rmtree(upload_id)
+
+
+class PipeWriter:
+	"""File-like object collecting the data written to it in blocks and passing
+	them through a bounded queue to a thread writing them to the volumes of the
+	sink. Closing it waits for all data to be written; the volumes still have to
+	be committed to make them visible.
+	"""
+
+	def __init__(self, sink: Sink, target_file: str):
+		self.sink = sink
+		self.target_file = target_file
+		self.names = []
+		self.buffer = bytearray()
+		self.position = 0
+		self.queue = queue.Queue(QUEUE_BLOCKS)
+		self.error = None
+		self.closed = False
+		self.thread = threading.Thread(target=self._transfer, daemon=True)
+		self.thread.start()
+
+	def write(self, data: bytes) -> int:
+		"""Add data to the current block, and pass the block on when it is full
+		or reaches the end of the current volume.
+		"""
+		if self.error is not None:
+			raise self.error
+		self.buffer += data
+		while len(self.buffer) >= self._block_limit():
+			self._put(self._block_limit())
+		return len(data)
+
+	def _block_limit(self) -> int:
+		if not self.sink.volume_size:
+			return BLOCK_SIZE
+		return min(BLOCK_SIZE, self.sink.volume_size - self.position % self.sink.volume_size)
+
+	def _put(self, size: int):
+		block = bytes(self.buffer[:size])
+		del self.buffer[:size]
+		self.position += len(block)
+		self.queue.put(block)
+
+	def tell(self) -> int:
+		"""Get number of bytes written so far."""
+		return self.position + len(self.buffer)
+
+	def flush(self):
+		pass
+
+	def _volume_name(self) -> str:
+		return volume_name(self.target_file, len(self.names) + 1) if self.sink.volume_size else self.target_file
+
+	def _transfer(self):
+		handle, written = None, 0
+		try:
+			while (block := self.queue.get()) is not None:
+				if handle is None:
+					name = self._volume_name()
+					handle, written = self.sink.open_volume(name), 0
+					self.names.append(name)
+				self.sink.write_volume(handle, block)
+				written += len(block)
+				if written == self.sink.volume_size:
+					self.sink.close_volume(handle)
+					handle = None
+			if handle is None and not self.names:
+				name = self._volume_name()
+				handle = self.sink.open_volume(name)
+				self.names.append(name)
+			if handle is not None:
+				self.sink.close_volume(handle)
+		except BaseException as e:
+			self.error = e
+			# keep on taking blocks, so the writing side is not blocked forever
+			while self.queue.get() is not None:
+				pass
+
+	def close(self):
+		"""Pass on the remaining data and wait until everything is written."""
+		if not self.closed:
+			self.closed = True
+			if self.buffer and self.error is None:
+				self._put(len(self.buffer))
+			self.queue.put(None)
+			self.thread.join()
+		if self.error is not None:
+			raise self.error
+
+	def commit(self) -> List[str]:
+		"""Make the volumes written visible under their names, and return those."""
+		self.sink.commit(self.names)
+		return self.names
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+class VolumeReader(io.RawIOBase):
+	"""File-like object for reading the volumes of a volume set as one archive,
+	with random access, e.g. for reading the central directory of a zip file.
+	"""
+
+	def __init__(self, names: List[str]):
+		self.names = names
+		self.offsets = [0]  # offset of each volume in the archive, and the total size
+		for name in names:
+			self.offsets.append(self.offsets[-1] + os.path.getsize(name))
+		self.position = 0
+		self.index, self.fp = None, None
+
+	def readable(self) -> bool:
+		return True
+
+	def seekable(self) -> bool:
+		return True
+
+	def tell(self) -> int:
+		return self.position
+
+	def seek(self, offset: int, whence=io.SEEK_SET) -> int:
+		base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.offsets[-1]}[whence]
+		self.position = max(0, base + offset)
+		return self.position
+
+	def readinto(self, buffer) -> int:
+		"""Read from the volume at the current position, up to its end at most."""
+		index = bisect.bisect_right(self.offsets, self.position) - 1
+		if index >= len(self.names):
+			return 0
+		if index != self.index:
+			if self.fp is not None:
+				self.fp.close()
+			self.fp, self.index = open(self.names[index], "rb"), index
+		self.fp.seek(self.position - self.offsets[index])
+		count = self.fp.readinto(memoryview(buffer)[:self.offsets[index + 1] - self.position])
+		self.position += count
+		return count
+
+	def close(self):
+		if self.fp is not None:
+			self.fp.close()
+			self.fp = None
+		super().close()
+
+
+def volume_name(target_file: str, number: int) -> str:
+	"""Get the name of the volume with the given number (starting at 1)."""
+	return f"{target_file}.{number:03d}"
+
+
+def archive_name(path: str) -> str:
+	"""Get the name of the archive without the extension of the first volume, if
+	any, e.g. for telling its type.
+	"""
+	return path.removesuffix(FIRST_VOLUME)
+
+
+def open_volumes(path: str) -> BinaryIO:
+	"""Open the archive with the given name for reading; if it is the first volume
+	of a volume set, all the volumes are read as one concatenated archive.
+	"""
+	if not path.endswith(FIRST_VOLUME):
+		return open(path, "rb")
+	names, target_file = [], archive_name(path)
+	while os.path.exists(name := volume_name(target_file, len(names) + 1)):
+		names.append(name)
+	return io.BufferedReader(VolumeReader(names), BLOCK_SIZE)
+
+
+def get_sink(kind: str, volume_size=0) -> Sink:
+	"""Get sink of the given kind, splitting archives into volumes of the given size."""
+	sinks = {SINK_LOCAL: Sink, SINK_REMOVABLE: RemovableSink, SINK_OBJECT: ObjectSink}
+	if kind not in sinks:
+		raise Exception(f"Unknown sink {kind}, must be one of {', '.join(KNOWN_SINKS)}")
+	return sinks[kind](volume_size)
@@ -0,0 +1,150 @@
+# -*- coding: utf8 -*-
+
+"""
+Sparse files for simple Backup tool.
+by Tobias Küster, 2026
+
+Sparse files, like disk images of virtual machines or database files, can be much
+larger than the data actually stored in them, the rest being "holes" that read
+as zeros but take no space on disk. Files with fewer blocks allocated than their
+size would need are checked for holes using SEEK_DATA and SEEK_HOLE, and only
+their data is read: tar archives store them as sparse members, in the PAX format
+of GNU tar (version 1.0), which can be extracted by tar as well as by Python's
+tarfile module, and zip archives, which have no such concept, get the compressed
+zeros of the holes without reading them, see backup_zip. When restoring, blocks of
+zeros are skipped instead of written, so the files become sparse again.
+"""
+
+import copy
+import errno
+import os
+import posixpath
+import tarfile
+from collections import deque
+from typing import BinaryIO, List, Tuple
+
+from backup_scan import FileEntry
+
+
+# blocks of zeros of this size are skipped when restoring files
+BLOCK_SIZE = 1 << 16
+ZEROS = bytes(BLOCK_SIZE)
+# tarfile can only read sparse members with less data than this, see add_sparse
+MAX_STORED_SIZE = 8 ** 11
+
+
+def maybe_sparse(entry: FileEntry) -> bool:
+	"""Check whether the file has fewer blocks allocated than its size would need,
+	i.e. it may have holes (or is just compressed by the file system).
+	"""
+	return 0 <= entry.blocks * 512 < entry.size
+
+
+def data_ranges(fd: int, size: int) -> List[Tuple[int, int]]:
+	"""Get the ranges of the open file that hold data, as pairs of offset and length;
+	if the file has no holes, or SEEK_DATA is not supported, that is the entire file.
+	"""
+	if not hasattr(os, "SEEK_DATA"):
+		return [(0, size)]
+	ranges, offset = [], 0
+	try:
+		while offset < size:
+			try:
+				start = os.lseek(fd, offset, os.SEEK_DATA)
+			except OSError as e:
+				if e.errno != errno.ENXIO:
+					raise
+				break  # just a hole up to the end of the file
+			if start >= size:
+				break
+			end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+			ranges.append((start, end - start))
+			offset = end
+	except OSError:
+		return [(0, size)]  # e.g. not supported by the file system
+	finally:
+		os.lseek(fd, 0, os.SEEK_SET)
+	return ranges
+
+
+def has_holes(ranges: List[Tuple[int, int]], size: int) -> bool:
+	"""Check whether the data ranges do not cover the entire file."""
+	return sum(length for _, length in ranges) < size
+
+
+class SparseReader:
+	"""File-like object for reading the content of a sparse tar member: the given
+	header with the map of the file, followed by the file's data ranges.
+	"""
+
+	def __init__(self, fileobj: BinaryIO, ranges: List[Tuple[int, int]], header: bytes):
+		self.fp = fileobj
+		self.buffer = header
+		self.ranges = deque(ranges)
+		self.remaining = 0
+
+	def read(self, size: int) -> bytes:
+		parts = []
+		while size > 0:
+			if self.buffer:
+				part, self.buffer = self.buffer[:size], self.buffer[size:]
+			elif self.remaining:
+				part = self.fp.read(min(size, self.remaining))
+				if not part:
+					break
+				self.remaining -= len(part)
+			elif self.ranges:
+				offset, self.remaining = self.ranges.popleft()
+				self.fp.seek(offset)
+				continue
+			else:
+				break
+			parts.append(part)
+			size -= len(part)
+		return b"".join(parts)
+
+
+def add_sparse(tar_file: tarfile.TarFile, info: tarfile.TarInfo, fileobj: BinaryIO,
+               ranges: List[Tuple[int, int]]) -> bool:
+	"""Add the regular file with the given info (with the file's actual size) to the
+	tar archive as a sparse member holding only the given data ranges, read from
+	fileobj. The member is named like GNU tar does, with the actual name in the PAX
+	header. If the data is too large for tarfile to read it back (the size does not
+	fit in the member's header, and tarfile gets confused by the size in the PAX
+	header then), nothing is written and False is returned.
+	"""
+	sparse_map = list(ranges)
+	if not sparse_map or sum(sparse_map[-1]) < info.size:
+		sparse_map.append((info.size, 0))  # so the size is known even without the PAX header
+	numbers = [len(sparse_map)] + [x for pair in sparse_map for x in pair]
+	header = "".join(f"{x}\n" for x in numbers).encode("ascii")
+	header += bytes(-len(header) % tarfile.BLOCKSIZE)
+	stored_size = len(header) + sum(length for _, length in sparse_map)
+	if stored_size >= MAX_STORED_SIZE:
+		return False
+
+	member = copy.copy(info)
+	dirname, basename = posixpath.split(info.name)
+	member.name = posixpath.join(dirname, "GNUSparseFile.0", basename)
+	if len(member.name) > tarfile.LENGTH_NAME or not member.name.isascii():
+		member.name = "GNUSparseFile.0/sparse"  # the actual name is in the PAX header anyway
+	member.size = stored_size
+	member.pax_headers = {"GNU.sparse.major": "1", "GNU.sparse.minor": "0",
+	                      "GNU.sparse.name": info.name, "GNU.sparse.realsize": str(info.size)}
+	tar_file.addfile(member, SparseReader(fileobj, sparse_map, header))
+	return True
+
+
+def write_sparse(data: BinaryIO, fp: BinaryIO, buffer_size: int = 1 << 20):
+	"""Copy the data to the file, seeking over blocks of zeros instead of writing
+	them, so they become holes, and set the file's size at the end.
+	"""
+	while chunk := data.read(buffer_size):
+		view = memoryview(chunk)
+		for i in range(0, len(view), BLOCK_SIZE):
+			block = view[i:i + BLOCK_SIZE]
+			if len(block) == BLOCK_SIZE and block == ZEROS:
+				fp.seek(BLOCK_SIZE, os.SEEK_CUR)
+			else:
+				fp.write(block)
+	fp.truncate()
@@ -0,0 +1,133 @@
+# -*- coding: utf8 -*-
+
+"""
+Statistics for simple Backup tool.
+by Tobias Küster, 2026
+
+Counters collected while creating the archives, e.g. the number of files and
+bytes read and written, and how much was saved by compressing (or by not
+compressing) the files, which are summed up over an entire backup run, as well
+as the progress events reported while the backup is running.
+"""
+
+from dataclasses import asdict, dataclass, field, fields
+from typing import Dict, Optional
+
+
+@dataclass
+class ArchiveStats:
+	"""Class holding statistics of creating one or more archives.
+	"""
+
+	files: int = 0
+	bytes_in: int = 0
+	bytes_out: int = 0
+	stored_files: int = 0
+	stored_bytes: int = 0
+	deflated_bytes: int = 0
+	compress_seconds: float = 0.0
+
+	def add(self, other: "ArchiveStats"):
+		"""Add the counters of the other stats to this one."""
+		for f in fields(self):
+			setattr(self, f.name, getattr(self, f.name) + getattr(other, f.name))
+
+	def saved_bytes(self) -> int:
+		"""Get number of bytes saved by compression."""
+		return self.bytes_in - self.bytes_out
+
+	def avoided_seconds(self) -> float:
+		"""Estimate CPU time avoided by storing files instead of deflating them,
+		based on the compression throughput of the files that were deflated.
+		"""
+		if not self.deflated_bytes or not self.compress_seconds:
+			return 0.0
+		return self.stored_bytes * self.compress_seconds / self.deflated_bytes
+
+	def __str__(self):
+		text = f"{self.files} files, {format_size(self.bytes_in)} -> {format_size(self.bytes_out)}"
+		if self.stored_files:
+			text += f", {self.stored_files} files stored uncompressed" \
+			        f" (~{self.avoided_seconds():.1f} s CPU time avoided)"
+		return text
+
+
+def format_size(size: int) -> str:
+	"""Get size as human-readable string."""
+	p = max((i for i in range(5) if 1024**i <= size), default=0)
+	ext = ("B", "KB", "MB", "GB", "TB")[p]
+	return f"{size / 1024**p:.1f} {ext}"
+
+
+# kinds of progress events
+EVENT_START = "start"
+EVENT_FILE = "file"
+EVENT_FINISH = "finish"
+EVENT_SKIP = "skip"
+EVENT_DONE = "done"
+EVENT_CANCELLED = "cancelled"
+
+
+@dataclass
+class BackupEvent:
+	"""Class representing the progress of a backup run, e.g. the start or end of
+	backing up a directory, or a file being added to an archive. The counters are
+	those of the entire run so far, while phases (times in seconds spent scanning,
+	creating the archive, and updating the manifest) and stats are those of the
+	directory that was just finished, or of all directories at the end of the run.
+	"""
+
+	kind: str
+	path: str = ""
+	files: int = 0
+	bytes_in: int = 0
+	bytes_out: int = 0
+	bytes_total: int = 0
+	elapsed: float = 0.0
+	phases: Dict[str, float] = field(default_factory=dict)
+	stats: Optional[ArchiveStats] = None
+
+	def fraction(self) -> float:
+		"""Get fraction of the bytes to be backed up that are done."""
+		return 1.0 if self.kind == EVENT_DONE else \
+		       min(1.0, self.bytes_in / self.bytes_total) if self.bytes_total else 0.0
+
+	def throughput(self) -> float:
+		"""Get number of bytes read per second."""
+		return self.bytes_in / self.elapsed if self.elapsed else 0.0
+
+	def ratio(self) -> float:
+		"""Get compression ratio, i.e. bytes written per byte read."""
+		return self.bytes_out / self.bytes_in if self.bytes_in else 0.0
+
+	def eta(self) -> Optional[float]:
+		"""Estimate remaining seconds from the throughput so far, if any."""
+		rate = self.throughput()
+		return max(0.0, self.bytes_total - self.bytes_in) / rate if rate else None
+
+	def to_dict(self) -> dict:
+		"""Get the event as dictionary, including the derived values."""
+		return {**asdict(self), "throughput": self.throughput(), "ratio": self.ratio(), "eta": self.eta()}
+
+	def __str__(self):
+		if self.kind == EVENT_START:
+			return f"Backing up {self.path}"
+		if self.kind == EVENT_SKIP:
+			return f"Skipping {self.path}"
+		if self.kind == EVENT_FINISH:
+			phases = ", ".join(f"{k} {v:.1f} s" for k, v in self.phases.items())
+			return f"Finished {self.path} ({self.stats}; {phases})"
+		if self.kind == EVENT_DONE:
+			return f"Done ({self.stats})" if self.stats and self.stats.files else "Done"
+		if self.kind == EVENT_CANCELLED:
+			return "Cancelled (run the backup again to continue where it stopped)"
+		eta = self.eta()
+		return f"{format_size(self.bytes_in)} of {format_size(self.bytes_total)} ({self.fraction():.0%}), " \
+		       f"{format_size(self.throughput())}/s, ETA {'?' if eta is None else format_duration(eta)}"
+
+
+def format_duration(seconds: float) -> str:
+	"""Get duration as human-readable string."""
+	minutes, seconds = divmod(int(seconds), 60)
+	hours, minutes = divmod(minutes, 60)
+	return f"{hours}:{minutes:02d}:{seconds:02d}"
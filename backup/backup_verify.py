@@ -0,0 +1,175 @@
+# -*- coding: utf8 -*-
+
+"""
+Verification of archives for simple Backup tool.
+by Tobias Küster, 2026
+
+Checks that the archives created are complete and readable, without extracting
+them: all the files listed in the catalog for an archive (see backup_catalog)
+have to be in the archive, and their data is read and checked against the size
+and CRC32 recorded when the archive was written. For zip archives, the CRCs are
+those of the central directory, which zipfile also checks while reading; for tar
+archives, they are calculated while adding the files (except for sparse files
+and files stored as deltas, whose data is only read). Optionally, a random sample
+of the files is also compared byte for byte to the source files, if those have not
+been changed since the archive was created.
+
+The archives are verified in parallel, and the entries of zip archives are split
+among several threads, too, as those can be read with random access, while tar
+archives can only be read as a stream. The results are recorded in the catalog,
+so archives verified successfully are not verified again.
+"""
+
+import os
+import random
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import backup_archive
+from backup_catalog import CatalogEntry
+
+
+READ_SIZE = 1 << 20
+# maximum number of errors reported per archive
+MAX_ERRORS = 20
+
+
+class VerifyResult(NamedTuple):
+	"""Class holding the result of verifying (a part of) an archive: the number
+	of files checked, how many of those were compared to the source files, and
+	the errors found, if any.
+	"""
+
+	path: str
+	files: int
+	compared: int
+	errors: List[str]
+
+
+def verify_archives(archives: List[tuple], sample: float = 0.0, threads: int = None) -> Iterable[VerifyResult]:
+	"""Verify the archives, given as tuples of path, the directory they are a
+	backup of, their creation time and their entries in the catalog, comparing the
+	given fraction of the files to the source files, too. The results are yielded
+	in the order the archives are done.
+	"""
+	threads = threads or os.cpu_count() or 1
+	with ThreadPoolExecutor(threads) as pool:
+		futures, parts, results = {}, {}, {}
+		for path, directory, created, entries in archives:
+			expected = {e.name: e for e in entries}
+			source = os.path.join(directory, os.pardir)
+			try:
+				tasks = split_members(path, expected, threads)
+			except Exception as e:
+				yield VerifyResult(path, 0, 0, [f"Can not read archive: {e}"])
+				continue
+			parts[path], results[path] = len(tasks), []
+			for names, errors in tasks:
+				future = pool.submit(verify_members, path, expected, names, source, created, sample)
+				futures[future] = path
+				results[path].append(VerifyResult(path, 0, 0, errors))
+		for future in as_completed(futures):
+			path = futures[future]
+			results[path].append(future.result())
+			parts[path] -= 1
+			if not parts[path]:
+				done = results.pop(path)
+				errors = [e for r in done for e in r.errors]
+				yield VerifyResult(path, sum(r.files for r in done), sum(r.compared for r in done),
+				                   errors[:MAX_ERRORS])
+
+
+def split_members(path: str, expected: Dict[str, CatalogEntry], parts: int) -> List[tuple]:
+	"""Split the members of the archive into parts that can be verified in parallel,
+	as pairs of names (or None for the entire archive) and errors found already.
+	For zip archives, the names are compared to the catalog right away, for tar
+	archives, this is done while reading them.
+	"""
+	archive = backup_archive.open_archive(path)
+	try:
+		if not isinstance(archive, backup_archive.ZipArchive):
+			return [(None, [])]
+		names = [m.name for m in archive.members()]
+	finally:
+		archive.close()
+	errors = [f"{n}: missing in archive" for n in sorted(set(expected) - set(names))]
+	errors += [f"{n}: not in catalog" for n in names if n not in expected]
+	names = [n for n in names if n in expected]
+	size = max(1, -(-len(names) // parts))
+	return [(set(names[i:i + size]), errors if i == 0 else []) for i in range(0, len(names), size)] or [(set(), errors)]
+
+
+def verify_members(path: str, expected: Dict[str, CatalogEntry], names: Optional[set], source: str,
+                   created: float, sample: float) -> VerifyResult:
+	"""Read the members of the archive with the given names (or all of them) and
+	check their sizes and CRCs, comparing a random sample of them to the source
+	files, in the given parent directory, if not changed since the archive was
+	created. Reading stops at the first error in the archive's data itself.
+	"""
+	files, compared, errors, seen = 0, 0, [], set()
+	archive = backup_archive.open_archive(path)
+	try:
+		deltas = archive.deltas()
+		for member, data in archive.iter_data(names):
+			seen.add(member.name)
+			entry = expected.get(member.name)
+			if entry is None:
+				errors.append(f"{member.name}: not in catalog")
+				continue
+			if data is None:
+				continue  # links, checked as part of the file they link to
+			src = None
+			if member.name not in deltas and random.random() < sample:
+				src = open_unchanged(os.path.join(source, member.name), entry.size, created)
+			try:
+				size, crc, same = read_member(data, src)
+			finally:
+				if src is not None:
+					src.close()
+			files += 1
+			if member.name in deltas:
+				continue  # the size and CRC are those of the file, not of the delta
+			if size != entry.size:
+				errors.append(f"{member.name}: size {size} instead of {entry.size}")
+			elif entry.crc is not None and crc != entry.crc:
+				errors.append(f"{member.name}: CRC {crc:08x} instead of {entry.crc:08x}")
+			if src is not None:
+				compared += 1
+				if not same:
+					errors.append(f"{member.name}: differs from source file")
+		if names is None:
+			errors += [f"{n}: missing in archive" for n in sorted(set(expected) - seen)]
+	except Exception as e:
+		errors.append(f"Can not read archive: {e}")
+	finally:
+		archive.close()
+	return VerifyResult(path, files, compared, errors)
+
+
+def open_unchanged(path: str, size: int, created: float):
+	"""Open the source file for comparing it to the file in the archive, if it has
+	the same size and was not modified since the archive was created, else None.
+	"""
+	try:
+		st = os.stat(path)
+		if st.st_size == size and st.st_mtime <= created:
+			return open(path, "rb")
+	except OSError:
+		pass
+	return None
+
+
+def read_member(data, src=None) -> tuple:
+	"""Read the data of a member, returning its size and CRC32, and whether it is
+	the same as the content of the source file, if any.
+	"""
+	size, crc, same = 0, 0, True
+	while chunk := data.read(READ_SIZE):
+		size += len(chunk)
+		crc = zlib.crc32(chunk, crc)
+		if src is not None and same:
+			same = src.read(len(chunk)) == chunk
+	if src is not None and same:
+		same = not src.read(1)
+	return size, crc, same
@@ -0,0 +1,413 @@
+# -*- coding: utf8 -*-
+
+"""
+Watching directories for changes for simple Backup tool.
+by Tobias Küster, 2026
+
+Instead of scanning all the configured directories again to find out whether
+and which files changed since the last backup, a long-running watcher can be
+started that is notified by the operating system (using inotify on Linux, or
+else by scanning the directories every now and then) about all changes and
+records the paths of changed files and directories in a "dirty journal" next to
+the configuration. Refreshing the include flags and finding the files for an
+incremental backup then only has to look at those paths, and takes the state of
+all other files from the manifest of the last backup, without walking the tree.
+
+The journal is only used for a directory if the watcher that wrote it is still
+running and was already running when the directory was last backed up (i.e.
+the backup recorded the time of its snapshot in the journal after that watcher
+started), and no events were lost in the meantime; otherwise, the directory is
+scanned as usual. Optionally, the watcher starts a backup of the changed
+directories by itself after a given time without any further changes.
+
+Journal records (one JSON object per line):
+- {"start": path, "pid": pid, "time": t}: a watcher started watching the directory
+- {"dirty": path, "path": rel, "time": t}: the file or directory at the relative
+  path changed (or was added or removed); a path of null means that events were
+  lost, so the whole directory has to be scanned again
+- {"clean": path, "time": t}: the directory was backed up, including all
+  changes made before the given time
+"""
+
+import ctypes
+import ctypes.util
+import functools
+import heapq
+import json
+import os
+import select
+import stat
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from backup_exclude import CACHEDIR_TAG, Excludes
+from backup_manifest import Manifest, ManifestEntry
+from backup_scan import FileEntry, Snapshot, iter_scan, scan_key
+
+
+# time between scans of the polling watcher, in seconds
+POLL_INTERVAL = 60
+# changes recorded up to this many seconds before reading the journal are kept
+# as changed after a backup, in case they were written just while reading it
+CLOCK_MARGIN = 2
+# the journal is rewritten with only the relevant records when it gets this large
+COMPACT_SIZE = 1 << 20
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+             IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class DirtySet(NamedTuple):
+	"""Class representing the paths changed in a directory according to the journal.
+	"""
+
+	paths: Set[str]     # relative paths of changed files and directories
+	loaded: float       # time the journal was read, i.e. all changes before are known
+	excludes: Optional[Excludes] = None  # exclude rules of the watcher, if known
+
+
+# WATCHERS
+
+class PollingWatcher:
+	"""Watcher scanning the directories every now and then and comparing the
+	results, for systems (or file systems, or numbers of directories) where
+	inotify can not be used.
+	"""
+
+	def __init__(self, roots: Dict[str, Excludes], interval: float = POLL_INTERVAL):
+		self.roots = roots
+		self.interval = interval
+		self.states = {root: self._state(root) for root in roots}
+		self.next_poll = time.monotonic() + interval
+
+	def _state(self, root: str) -> Dict[str, tuple]:
+		return {e.path: e[1:] for e in iter_scan(root, excludes=self.roots[root])}
+
+	def poll(self, timeout: float) -> List[Tuple[str, Optional[str]]]:
+		"""Wait up to the given time and return changed paths as pairs of watched
+		directory and relative path.
+		"""
+		time.sleep(max(0.0, min(timeout, self.next_poll - time.monotonic())))
+		if time.monotonic() < self.next_poll:
+			return []
+		self.next_poll = time.monotonic() + self.interval
+		changes = []
+		for root, old in self.states.items():
+			new = self.states[root] = self._state(root)
+			prefix = len(os.path.join(root, ""))
+			changes.extend((root, p[prefix:]) for p in new.keys() | old.keys() if new.get(p) != old.get(p))
+		return changes
+
+	def close(self):
+		pass
+
+
+class InotifyWatcher:
+	"""Watcher using the Linux inotify API (through ctypes), with a watch on
+	each (not excluded) subdirectory of the watched directories.
+	"""
+
+	def __init__(self, roots: Dict[str, Excludes]):
+		self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+		self.roots = roots
+		self.watches: Dict[int, Tuple[str, str]] = {}  # watch descriptor -> root, relative path
+		try:
+			for root in roots:
+				self._add_tree(root, "")
+		except OSError:
+			self.close()
+			raise
+
+	def _add_tree(self, root: str, rel: str):
+		"""Add watches for the directory at the relative path and its subdirectories;
+		raises OSError if the number of watches is exhausted.
+		"""
+		stack = [rel]
+		while stack:
+			rel = stack.pop()
+			path = os.path.join(root, rel)
+			wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+			if wd < 0:
+				errno = ctypes.get_errno()
+				if errno in (2, 13, 20):  # ENOENT, EACCES, ENOTDIR: vanished or not readable
+					continue
+				raise OSError(errno, f"inotify_add_watch failed for {path}")
+			self.watches[wd] = (root, rel)
+			try:
+				with os.scandir(path) as it:
+					entries = list(it)
+			except OSError:
+				continue
+			excludes = self.roots[root]
+			if excludes.is_cache(path, [e.name for e in entries]):
+				continue
+			for entry in entries:
+				sub = os.path.join(rel, entry.name)
+				if entry.is_dir(follow_symlinks=False) and not excludes.excluded(sub, True):
+					stack.append(sub)
+
+	def poll(self, timeout: float) -> List[Tuple[str, Optional[str]]]:
+		"""Wait up to the given time and return changed paths as pairs of watched
+		directory and relative path (or None if events were lost).
+		"""
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return []
+		try:
+			data = os.read(self.fd, 1 << 16)
+		except BlockingIOError:
+			return []
+		changes, offset = [], 0
+		while offset < len(data):
+			wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+			name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+			offset += EVENT_HEADER.size + length
+			if mask & IN_Q_OVERFLOW:
+				changes.extend((root, None) for root in self.roots)
+				continue
+			if wd not in self.watches:
+				continue
+			root, rel = self.watches[wd]
+			if mask & IN_IGNORED:
+				del self.watches[wd]
+				continue
+			if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+				if not rel:
+					changes.append((root, None))  # the watched directory itself is gone
+				continue
+			path = os.path.join(rel, name)
+			is_dir = bool(mask & IN_ISDIR)
+			if self.roots[root].excluded(path, is_dir):
+				continue
+			if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+				try:
+					self._add_tree(root, path)
+				except OSError:
+					changes.append((root, None))
+			changes.append((root, path))
+		return changes
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
+
+
+def create_watcher(roots: Dict[str, Excludes], interval: float = POLL_INTERVAL):
+	"""Create an inotify watcher for the directories, if possible, or a polling
+	watcher otherwise, e.g. if inotify is not available or there are too many
+	directories for the number of watches allowed.
+	"""
+	try:
+		return InotifyWatcher(roots)
+	except (OSError, AttributeError, TypeError):
+		return PollingWatcher(roots, interval)
+
+
+# JOURNAL
+
+def read_records(filename: str) -> Iterable[dict]:
+	"""Read the records from the journal file, if any."""
+	try:
+		with open(filename, encoding="utf8", errors="surrogateescape") as f:
+			for line in f:
+				try:
+					yield json.loads(line)
+				except ValueError:
+					pass  # incomplete line, written when interrupted
+	except FileNotFoundError:
+		pass
+
+
+def write_record(filename: str, record: dict):
+	"""Append a record to the journal file; each record is written at once, so
+	records of the watcher and of backups running at the same time do not mix.
+	"""
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	with open(filename, "a", encoding="utf8", errors="surrogateescape") as f:
+		f.write(json.dumps(record) + "\n")
+
+
+def load_dirty(filename: str) -> Dict[str, DirtySet]:
+	"""Load the changed paths of all directories for which the journal can be used,
+	i.e. that are watched by a running watcher since before their last backup.
+	"""
+	loaded = time.time() - CLOCK_MARGIN
+	started, cleaned, dirty = {}, {}, {}
+	for record in read_records(filename):
+		if "start" in record:
+			started[record["start"]] = (record["pid"], record["time"], record.get("excludes"))
+			dirty[record["start"]] = {}
+		elif "clean" in record:
+			cleaned[record["clean"]] = max(cleaned.get(record["clean"], 0), record["time"])
+		elif "dirty" in record and record["dirty"] in dirty:
+			paths = dirty[record["dirty"]]
+			paths[record["path"]] = max(paths.get(record["path"], 0), record["time"])
+
+	result = {}
+	for path, (pid, start, excludes) in started.items():
+		clean = cleaned.get(path, 0)
+		if clean < start or not is_running(pid):
+			continue
+		paths = {p for p, t in dirty[path].items() if t >= clean}
+		if None not in paths:
+			result[path] = DirtySet(paths, loaded, Excludes(*excludes) if excludes is not None else None)
+	return result
+
+
+def mark_clean(filename: str, path: str, snapshot_time: float):
+	"""Record that the directory has been backed up, with all changes made before
+	the given time, if the directory is watched at all.
+	"""
+	if os.path.exists(filename):
+		write_record(filename, {"clean": path, "time": snapshot_time})
+
+
+def is_running(pid: int) -> bool:
+	"""Check whether the process with the given id is still running."""
+	try:
+		os.kill(pid, 0)
+		return True
+	except PermissionError:
+		return True
+	except OSError:
+		return False
+
+
+def scan_dirty(root: str, manifest: Manifest, dirty: Iterable[str], excludes: Excludes = None) -> Snapshot:
+	"""Create a snapshot of the directory from the manifest of its last backup,
+	scanning only the changed files and directories, and merging the entries of
+	those (sorted in memory, as there are usually few) into the ones from the
+	manifest, so the snapshot is in the order of the scan. The files taken from the
+	manifest are filtered by the exclude rules, too, as those may have changed since
+	the last backup; directories in which a CACHEDIR.TAG changed are scanned again.
+	"""
+	dirty = set(dirty)
+	dirty.update(os.path.dirname(name) for name in list(dirty) if os.path.basename(name) == CACHEDIR_TAG)
+	dirty.discard("")
+
+	def is_dirty(name: str) -> bool:
+		while name:
+			if name in dirty:
+				return True
+			name = os.path.dirname(name)
+		return False
+
+	@functools.lru_cache(maxsize=1024)
+	def is_excluded_dir(name: str) -> bool:
+		return bool(name) and (excludes.excluded(name, True) or is_excluded_dir(os.path.dirname(name)))
+
+	def is_kept(name: str, entry: ManifestEntry) -> bool:
+		return not is_dirty(name) and not (excludes and (excludes.excluded(name, False) or excludes.too_large(entry.size)
+		                                                 or is_excluded_dir(os.path.dirname(name))))
+
+	excludes = excludes or Excludes()
+	scanned = []
+	# scan only the topmost changed paths, the others are scanned as part of those
+	for name in sorted(dirty):
+		if is_dirty(os.path.dirname(name)) or is_excluded_dir(os.path.dirname(name)):
+			continue
+		path = os.path.join(root, name)
+		if os.path.isdir(path) and not os.path.islink(path):
+			if not excludes.excluded(name, True):
+				scanned.extend(iter_scan(root, excludes=excludes, top=path))
+			continue
+		try:
+			st = os.stat(path)
+		except OSError:
+			continue  # deleted, or a broken symlink
+		if stat.S_ISREG(st.st_mode) and not excludes.excluded(name, False) and not excludes.too_large(st.st_size):
+			scanned.append(FileEntry.from_stat(path, st))
+	scanned.sort(key=lambda e: scan_key(e.path))
+	kept = (FileEntry(os.path.join(root, name), *entry[:-1]) for name, entry in manifest.items() if is_kept(name, entry))
+	return Snapshot(heapq.merge(kept, scanned, key=lambda e: scan_key(e.path)))
+
+
+# WATCHING
+
+def watch(directories: List, journal_file: str, stop: threading.Event, quiet_period: float = None,
+          backup: Callable[[], None] = None, interval: float = POLL_INTERVAL):
+	"""Watch the directories until the stop event is set, recording changed paths
+	in the journal file and setting the directories' include flags. If a quiet
+	period is given, the backup function is called once there were no further
+	changes for that many seconds.
+	"""
+	directories = {d.path: d for d in directories}
+	watcher = create_watcher({p: d.excludes() for p, d in directories.items()}, interval)
+	recorded: Dict[str, Set[str]] = {p: set() for p in directories}
+	last_change = None
+
+	# start with a new journal, the changes recorded by a previous watcher can not be used anyway
+	with open(journal_file + ".tmp", "w", encoding="utf8") as f:
+		for path in directories:
+			excludes = directories[path].excludes()
+			f.write(json.dumps({"start": path, "pid": os.getpid(), "time": time.time(),
+			                    "excludes": [excludes.patterns, excludes.max_size, excludes.caches]}) + "\n")
+	os.replace(journal_file + ".tmp", journal_file)
+
+	# directories that did not change since their last backup can use the journal right away
+	for directory in directories.values():
+		if directory.manifest(refresh=True) is not None:
+			directory.scan(refresh=True)
+			if not any(directory.iter_modified()) and not directory.deleted_files():
+				mark_clean(journal_file, directory.path, directory.snapshot_time())
+	size = os.path.getsize(journal_file)
+
+	try:
+		while not stop.is_set():
+			changes = watcher.poll(1.0)
+			# a backup (e.g. by another process) recorded directories as clean: record changes again
+			if os.path.getsize(journal_file) != size:
+				pending = load_dirty(journal_file)
+				recorded = {p: set(pending[p].paths) if p in pending else recorded[p] for p in directories}
+			for path, rel in changes:
+				if rel not in recorded[path]:
+					recorded[path].add(rel)
+					write_record(journal_file, {"dirty": path, "path": rel, "time": time.time()})
+				directories[path].include = True
+			if changes:
+				last_change = time.monotonic()
+			if os.path.getsize(journal_file) > COMPACT_SIZE:
+				compact(journal_file)
+			size = os.path.getsize(journal_file)
+
+			if quiet_period is not None and last_change is not None and \
+					time.monotonic() - last_change >= quiet_period and backup is not None:
+				last_change = None
+				backup()
+				size = -1  # read the records written by the backup
+	finally:
+		watcher.close()
+
+
+def compact(filename: str):
+	"""Rewrite the journal with just the records still relevant."""
+	records = list(read_records(filename))
+	cleaned = {}
+	for r in records:
+		if "clean" in r:
+			cleaned[r["clean"]] = max(cleaned.get(r["clean"], 0), r["time"])
+	keep = [r for r in records if "start" in r or "clean" in r and r["time"] == cleaned[r["clean"]] or
+	        "dirty" in r and r["time"] >= cleaned.get(r["dirty"], 0)]
+	with open(filename + ".tmp", "w", encoding="utf8", errors="surrogateescape") as f:
+		f.writelines(json.dumps(r) + "\n" for r in keep)
+	os.replace(filename + ".tmp", filename)
@@ -0,0 +1,438 @@
+# -*- coding: utf8 -*-
+
+"""
+Parallel zip writer for simple Backup tool.
+by Tobias Küster, 2026
+
+The zipfile module compresses one file after the other, using just a single
+CPU core. Instead, this module splits the files into chunks that are deflated
+independently in a pool of threads (the zlib module releases the GIL while
+compressing), similar to pigz, and then writes the compressed chunks to the
+archive in the original order. All but the last chunk of each file are ended
+with a sync-flush, so the concatenated chunks form a single valid deflate
+stream, and the result is a standard zip file that can be read by zipfile,
+unzip, or any other zip tool.
+
+For the "auto" archive type, files that can not be compressed (any further),
+like images, videos or other archives, are stored uncompressed instead, based on
+their extension, or on how well a sample of them can be compressed.
+
+Sparse files are checked for holes (see backup_sparse), and chunks lying entirely
+within a hole are not read, but taken as zeros, whose compressed data is cached.
+
+The archive is written strictly sequentially, without ever seeking back in the
+target file; for files spanning several chunks, the CRC and sizes are written
+in a data descriptor following the compressed data. The records of the central
+directory are collected in a temporary file (in memory only up to a few MB), so
+the memory used does not grow with the number of files in the archive.
+"""
+
+import functools
+import os
+import struct
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+import backup_io
+import backup_manifest
+import backup_sparse
+from backup_journal import Checkpoint
+from backup_scan import FileEntry
+from backup_stats import ArchiveStats
+
+
+CHUNK_SIZE = 1 << 20
+DEFAULT_LEVEL = 5
+# the central directory is kept in memory up to this size, then in a temporary file
+CENTRAL_SPOOL_SIZE = 4 << 20
+
+# for "auto" mode: files are stored if compressing does not reduce the size
+# by at least 5%, either as a whole or for a sample, or by their extension
+STORE_RATIO = 0.95
+SAMPLE_SIZE = 1 << 16
+STORED_EXTENSIONS = {
+	".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+	".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac",
+	".mp4", ".m4v", ".mkv", ".mov", ".avi", ".webm",
+	".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".7z", ".rar",
+	".jar", ".apk", ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".epub",
+	".pack",
+}
+
+ZIP64_LIMIT = (1 << 31) - 1
+FLAG_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+END_RECORD = struct.Struct("<4s4H2LH")
+END_RECORD64 = struct.Struct("<4sQ2H2L4Q")
+END_LOCATOR64 = struct.Struct("<4sLQL")
+
+
+class EntryInfo(NamedTuple):
+	"""Class holding the attributes of a single zip member, as needed for the local
+	header and the central directory.
+	"""
+
+	name: str
+	mtime: float
+	mode: int
+	compress_type: int
+	zip64: bool
+
+
+class ZipWriter:
+	"""Class for writing a zip file sequentially to a file-like object, where the
+	content of each entry is provided already compressed. For continuing a partial
+	zip file, the offset of its end and its central directory records can be given.
+	The central directory records are spooled to a temporary file, see above.
+	"""
+
+	def __init__(self, fileobj, offset=0, central: Optional[Iterable[bytes]] = None):
+		self.fp = fileobj
+		self.offset = offset
+		self.central = tempfile.SpooledTemporaryFile(CENTRAL_SPOOL_SIZE)
+		self.count = 0
+		self.current = None
+		for record in central or []:
+			self._add_central(record)
+
+	def _add_central(self, record: bytes):
+		self.central.write(record)
+		self.count += 1
+
+	def _write(self, data: bytes):
+		self.fp.write(data)
+		self.offset += len(data)
+
+	def start_entry(self, info: EntryInfo, crc=None, compress_size=None, file_size=None):
+		"""Write local header of a new entry. If the CRC and sizes are not known
+		yet, they are written in a data descriptor when the entry is finished.
+		"""
+		name, flags = encode_name(info.name)
+		if crc is None:
+			flags |= FLAG_DESCRIPTOR
+			crc, compress_size, file_size = 0, 0, 0
+		extra = b""
+		if info.zip64:
+			extra = struct.pack("<2H2Q", 1, 16, file_size, compress_size)
+			compress_size = file_size = 0xFFFFFFFF
+		dostime, dosdate = dos_date_time(info.mtime)
+		self.current = (info, flags, self.offset)
+		self._write(LOCAL_HEADER.pack(b"PK\x03\x04", get_version(info), 0, flags, info.compress_type,
+		                              dostime, dosdate, crc, compress_size, file_size, len(name), len(extra)))
+		self._write(name)
+		self._write(extra)
+
+	def write(self, data: bytes):
+		"""Write (compressed) data of the current entry."""
+		self._write(data)
+
+	def end_entry(self, crc: int, compress_size: int, file_size: int) -> bytes:
+		"""Finish the current entry, writing the data descriptor if needed, and
+		remember the entry for the central directory, returning its record.
+		"""
+		info, flags, header_offset = self.current
+		if flags & FLAG_DESCRIPTOR:
+			fmt = "<4sL2Q" if info.zip64 else "<4s3L"
+			self._write(struct.pack(fmt, b"PK\x07\x08", crc, compress_size, file_size))
+		name, _ = encode_name(info.name)
+		extra_values = [x for x in (file_size, compress_size, header_offset) if x > ZIP64_LIMIT]
+		extra = struct.pack(f"<2H{len(extra_values)}Q", 1, 8 * len(extra_values), *extra_values) if extra_values else b""
+		if file_size > ZIP64_LIMIT: file_size = 0xFFFFFFFF
+		if compress_size > ZIP64_LIMIT: compress_size = 0xFFFFFFFF
+		if header_offset > ZIP64_LIMIT: header_offset = 0xFFFFFFFF
+		version = max(get_version(info), 45 if extra else 0)
+		dostime, dosdate = dos_date_time(info.mtime)
+		record = CENTRAL_HEADER.pack(b"PK\x01\x02", version, 3, version, 0, flags, info.compress_type,
+		                             dostime, dosdate, crc, compress_size, file_size, len(name), len(extra),
+		                             0, 0, 0, (info.mode & 0xFFFF) << 16, header_offset) + name + extra
+		self._add_central(record)
+		self.current = None
+		return record
+
+	def writestr(self, name: str, data: bytes, compress_type=ZIP_DEFLATED, level=DEFAULT_LEVEL):
+		"""Write a complete entry with the given content in one go."""
+		compressed = deflate(data, level) if compress_type == ZIP_DEFLATED else data
+		crc = zlib.crc32(data)
+		info = EntryInfo(name, time.time(), 0o100644, compress_type, False)
+		self.start_entry(info, crc, len(compressed), len(data))
+		self.write(compressed)
+		self.end_entry(crc, len(compressed), len(data))
+
+	def close(self):
+		"""Write the central directory and end records."""
+		start = self.offset
+		self.central.seek(0)
+		while data := self.central.read(CHUNK_SIZE):
+			self._write(data)
+		self.central.close()
+		count, size = self.count, self.offset - start
+		if count >= 0xFFFF or start > ZIP64_LIMIT or size > ZIP64_LIMIT:
+			end64 = self.offset
+			self._write(END_RECORD64.pack(b"PK\x06\x06", 44, 45, 45, 0, 0, count, count, size, start))
+			self._write(END_LOCATOR64.pack(b"PK\x06\x07", 0, end64, 1))
+			count, size, start = min(count, 0xFFFF), min(size, 0xFFFFFFFF), min(start, 0xFFFFFFFF)
+		self._write(END_RECORD.pack(b"PK\x05\x06", 0, 0, count, count, size, start, 0))
+
+
+def write_zip(files: Iterable[Tuple[FileEntry, str]], fileobj, level=DEFAULT_LEVEL, threads=None,
+              extra: Dict[str, bytes] = None, auto=False, checkpoint: Checkpoint = None) -> ArchiveStats:
+	"""Write zip archive with the given files, as pairs of snapshot entry and name in
+	the archive, plus additional members with the given names and contents, to the
+	given file-like object, compressing chunks of the files in a pool of threads.
+	If auto is set, files that can not be compressed are stored instead, see
+	is_compressible. If a checkpoint is given, the archive continues after the
+	files recorded in it, and each file written is recorded. Returns statistics
+	on the files written.
+	"""
+	threads = threads or os.cpu_count() or 1
+	checkpoint = checkpoint or Checkpoint()
+	offset = checkpoint.records[-1].end if checkpoint.records else 0
+	writer = ZipWriter(fileobj, offset, (bytes.fromhex(r.central) for r in checkpoint.records))
+	stats = ArchiveStats()
+	with ThreadPoolExecutor(threads) as pool:
+		in_flight = deque()
+		current = None
+		for chunk in iter_chunks(files, auto):
+			in_flight.append((chunk, pool.submit(compress_chunk, chunk, level, auto)))
+			if len(in_flight) > 2 * threads:
+				current = write_chunk(writer, current, stats, *in_flight.popleft(), checkpoint)
+		while in_flight:
+			current = write_chunk(writer, current, stats, *in_flight.popleft(), checkpoint)
+	for name, data in (extra or {}).items():
+		writer.writestr(name, data, level=level)
+	writer.close()
+	return stats
+
+
+class Chunk(NamedTuple):
+	"""Class representing a chunk of a file to be compressed.
+	"""
+
+	entry: FileEntry
+	arcname: str
+	offset: int
+	length: int
+	first: bool
+	last: bool
+	compress_type: int
+	hole: bool = False
+
+
+def iter_chunks(files: Iterable[Tuple[FileEntry, str]], auto=False) -> Iterable[Chunk]:
+	"""Split files into chunks to be compressed. For small files, consisting of
+	just one chunk, whether to compress them in auto mode is decided when actually
+	compressing, for larger files it is decided up front, by probing a sample.
+	"""
+	for entry, arcname in files:
+		offsets = range(0, entry.size, CHUNK_SIZE) or [0]
+		compress_type = ZIP_DEFLATED
+		if auto and len(offsets) > 1 and not is_compressible(entry.path, entry.size):
+			compress_type = ZIP_STORED
+		ranges = get_data_ranges(entry) if len(offsets) > 1 else [(0, entry.size)]
+		k = 0  # first data range not ending before the current chunk
+		for i, offset in enumerate(offsets):
+			length = min(CHUNK_SIZE, entry.size - offset)
+			while k < len(ranges) and sum(ranges[k]) <= offset:
+				k += 1
+			hole = k == len(ranges) or ranges[k][0] >= offset + length
+			yield Chunk(entry, arcname, offset, length, i == 0, i == len(offsets) - 1, compress_type, hole)
+
+
+def get_data_ranges(entry: FileEntry) -> List[Tuple[int, int]]:
+	"""Get the ranges of the file holding data, see backup_sparse.data_ranges."""
+	if not backup_sparse.maybe_sparse(entry):
+		return [(0, entry.size)]
+	try:
+		with open(entry.path, "rb") as f:
+			return backup_sparse.data_ranges(f.fileno(), entry.size)
+	except OSError:
+		return [(0, entry.size)]  # reading the file will fail later, too
+
+
+def compress_chunk(chunk: Chunk, level: int, auto=False) -> Tuple[bytes, bytes, int, float]:
+	"""Read and deflate a single chunk of a file, returning the raw and compressed
+	data, the compress type actually used, and the CPU time used for compressing;
+	only the last chunk of each file finishes the deflate stream.
+	"""
+	if chunk.hole:
+		data = bytes(chunk.length)
+		if chunk.compress_type == ZIP_DEFLATED:
+			return data, deflate_zeros(chunk.length, level, chunk.last), ZIP_DEFLATED, 0.0
+	else:
+		data = backup_io.read_range(chunk.entry.path, chunk.offset, chunk.length)
+	if chunk.compress_type == ZIP_STORED or auto and chunk.first and chunk.last and has_stored_ext(chunk.arcname):
+		return data, data, ZIP_STORED, 0.0
+	start = time.thread_time()
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+	compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if chunk.last else zlib.Z_SYNC_FLUSH)
+	seconds = time.thread_time() - start
+	if auto and chunk.first and chunk.last and len(compressed) > STORE_RATIO * len(data):
+		return data, data, ZIP_STORED, seconds
+	return data, compressed, ZIP_DEFLATED, seconds
+
+
+@functools.lru_cache(maxsize=16)
+def deflate_zeros(length: int, level: int, last: bool) -> bytes:
+	"""Deflate a chunk of zeros like compress_chunk, caching the result, as holes
+	in sparse files mostly consist of many such chunks of the same length.
+	"""
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+	return compressor.compress(bytes(length)) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def write_chunk(writer: ZipWriter, current, stats: ArchiveStats, chunk: Chunk, future, checkpoint: Checkpoint):
+	"""Write compressed chunk to the zip writer, starting and ending entries as
+	needed, and return the updated state of the current entry (CRC, sizes, and
+	hash of the content, if the checkpoint collects those).
+	"""
+	data, compressed, compress_type, seconds = future.result()
+	entry = chunk.entry
+	if chunk.first:
+		zip64 = entry.size * 1.05 > ZIP64_LIMIT
+		info = EntryInfo(chunk.arcname.replace(os.sep, "/"), entry.mtime, entry.mode, compress_type, zip64)
+		if chunk.last:
+			crc = zlib.crc32(data)
+			writer.start_entry(info, crc, len(compressed), len(data))
+		else:
+			writer.start_entry(info)
+		current = (0, 0, 0, backup_manifest.new_hash() if checkpoint.hashes is not None else None)
+		stats.files += 1
+		stats.stored_files += compress_type == ZIP_STORED
+	crc, compress_size, file_size, hasher = current
+	if hasher is not None:
+		hasher.update(data)
+	current = (zlib.crc32(data, crc), compress_size + len(compressed), file_size + len(data), hasher)
+	writer.write(compressed)
+	stats.bytes_in += len(data)
+	stats.bytes_out += len(compressed)
+	stats.compress_seconds += seconds
+	if compress_type == ZIP_STORED:
+		stats.stored_bytes += len(data)
+	else:
+		stats.deflated_bytes += len(data)
+	if chunk.last:
+		record = writer.end_entry(*current[:3])
+		digest = backup_manifest.final_hash(hasher, entry) if hasher is not None else None
+		checkpoint.add(entry, chunk.arcname, writer.offset, record, digest=digest)
+		current = None
+	return current
+
+
+def has_stored_ext(name: str) -> bool:
+	"""Check whether the file name has the extension of an already compressed format."""
+	return os.path.splitext(name)[1].lower() in STORED_EXTENSIONS
+
+
+def is_compressible(path: str, size: int) -> bool:
+	"""Check whether a file is worth compressing, based on its extension, or by
+	compressing a sample from the middle of the file (to skip any headers).
+	"""
+	if has_stored_ext(path):
+		return False
+	with open(path, "rb") as f:
+		f.seek(max(0, size // 2 - SAMPLE_SIZE // 2))
+		sample = f.read(SAMPLE_SIZE)
+	return len(zlib.compress(sample, 1)) <= STORE_RATIO * len(sample)
+
+
+def deflate(data: bytes, level=DEFAULT_LEVEL) -> bytes:
+	"""Compress data to raw deflate stream, as used in zip files."""
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+	return compressor.compress(data) + compressor.flush()
+
+
+def encode_name(name: str) -> Tuple[bytes, int]:
+	"""Encode file name, setting the UTF-8 flag for non-ascii names."""
+	try:
+		return name.encode("ascii"), 0
+	except UnicodeEncodeError:
+		return name.encode("utf8", "surrogateescape"), FLAG_UTF8
+
+
+def get_version(info: EntryInfo) -> int:
+	"""Get zip version needed to extract the entry."""
+	return 45 if info.zip64 else 20 if info.compress_type == ZIP_DEFLATED else 10
+
+
+def dos_date_time(timestamp: float) -> Tuple[int, int]:
+	"""Convert timestamp to DOS time and date, as used in zip files; dates before
+	1980 can not be represented and are clamped, the same as zipfile does.
+	"""
+	t = time.localtime(timestamp)
+	if t.tm_year < 1980:
+		return 0, (0 << 9) | (1 << 5) | 1
+	return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+	       ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class CentralRecord(NamedTuple):
+	"""Class holding the attributes of a zip member from the central directory.
+	"""
+
+	name: str
+	file_size: int
+	compress_size: int
+	mtime: float
+	mode: int
+	crc: int
+	header_offset: int
+	compress_type: int
+
+
+def iter_central(fp) -> Iterable[CentralRecord]:
+	"""Iterate the records of the central directory of the zip file, reading them
+	one after the other, instead of all at once like zipfile does, so the memory
+	used does not grow with the number of files in the archive.
+	"""
+	size = fp.seek(0, os.SEEK_END)
+	fp.seek(max(0, size - END_RECORD.size - 0xFFFF))
+	tail = fp.read()
+	pos = tail.rfind(b"PK\x05\x06")
+	if pos < 0:
+		raise ValueError("Not a zip file")
+	_, _, _, _, count, _, start, _ = END_RECORD.unpack_from(tail, pos)
+	locator = pos - END_LOCATOR64.size
+	if locator >= 0 and tail[locator:locator + 4] == b"PK\x06\x07":
+		_, _, end64, _ = END_LOCATOR64.unpack_from(tail, locator)
+		fp.seek(end64)
+		record = END_RECORD64.unpack(fp.read(END_RECORD64.size))
+		count, start = record[7], record[9]
+	fp.seek(start)
+	for _ in range(count):
+		header = CENTRAL_HEADER.unpack(fp.read(CENTRAL_HEADER.size))
+		if header[0] != b"PK\x01\x02":
+			raise ValueError("Bad central directory record")
+		flags, compress_type, dostime, dosdate, crc, compress_size, file_size = header[5:12]
+		name, extra = fp.read(header[12]), fp.read(header[13])
+		fp.seek(header[14], os.SEEK_CUR)
+		header_offset = header[18]
+		# values that do not fit are in the zip64 extra field, in this order
+		values = [file_size, compress_size, header_offset]
+		pos = 0
+		while pos + 4 <= len(extra):
+			tag, length = struct.unpack_from("<2H", extra, pos)
+			if tag == 1:
+				large = iter(struct.unpack_from(f"<{length // 8}Q", extra, pos + 4))
+				values = [next(large) if v == 0xFFFFFFFF else v for v in values]
+			pos += 4 + length
+		mtime = time.mktime(((dosdate >> 9) + 1980, (dosdate >> 5) & 0xF, dosdate & 0x1F,
+		                     dostime >> 11, (dostime >> 5) & 0x3F, (dostime & 0x1F) * 2, 0, 0, -1))
+		name = name.decode("utf8" if flags & FLAG_UTF8 else "cp437", "surrogateescape")
+		yield CentralRecord(name, values[0], values[1], mtime, header[17] >> 16, crc, values[2], compress_type)
+
+
+def read_entry(fp, record: CentralRecord) -> bytes:
+	"""Read the (decompressed) data of the zip member with the given record."""
+	fp.seek(record.header_offset)
+	name_len, extra_len = struct.unpack("<2H", fp.read(LOCAL_HEADER.size)[26:30])
+	fp.seek(name_len + extra_len, os.SEEK_CUR)
+	data = fp.read(record.compress_size)
+	return zlib.decompress(data, -15) if record.compress_type == ZIP_DEFLATED else data
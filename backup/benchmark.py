@@ -0,0 +1,298 @@
+# -*- coding: utf8 -*-
+
+"""
+Benchmarks for simple Backup tool.
+by Tobias Küster, 2026
+
+Generates a synthetic directory tree (deterministically, for a given seed) with a
+configurable number of files, size distribution, depth, and compressibility, and
+measures how long the different steps of the backup take on that tree, such as
+scanning, determining modified files, calculating the size, and creating archives.
+Optionally, scanning is also measured with an artificial latency added to each
+directory listing and stat, like on a network file system. The cold start of the
+command-line tool (and of the graphical UI, if GTK is available) is measured in
+a new Python process each. The peak memory (RSS) of backing up a directory as zip
+and as tar archive is measured in new processes, too, for trees of two numbers of
+small files, and reported as the memory used per additional file, which should be
+close to zero, as directories of millions of files have to be backed up with
+bounded memory. The results are written as JSON,
+so they can be compared between commits, e.g.
+
+    python3 backup/benchmark.py --files 10000 --output before.json
+"""
+
+import argparse
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict
+
+import backup_core
+import backup_scan
+import config
+from backup_model import Configuration, Directory, write_to_json
+
+
+TEXT = (b"Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod "
+        b"tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, ")
+
+
+def make_tree(root: str, files=1000, mean_size=16384, sigma=1.5, depth=3, fanout=4,
+              compressibility=0.5, seed=0) -> int:
+	"""Create synthetic directory tree under root with the given number of files,
+	distributed over directories nested up to the given depth with the given number
+	of subdirectories each. File sizes follow a log-normal distribution with the
+	given mean and sigma; compressibility is the fraction of each file's content
+	that is (highly compressible) text, the rest is random bytes. The same
+	parameters and seed always result in the same tree. Returns the total size.
+	"""
+	rnd = random.Random(seed)
+	dirs, level = [root], [root]
+	for _ in range(depth):
+		level = [os.path.join(d, f"dir{i}") for d in level for i in range(fanout)]
+		dirs += level
+	for d in dirs:
+		os.makedirs(d, exist_ok=True)
+
+	# parameter of log-normal distribution so that the mean is mean_size
+	mu = math.log(max(1, mean_size)) - sigma ** 2 / 2
+	total = 0
+	for i in range(files):
+		size = int(rnd.lognormvariate(mu, sigma))
+		text_size = int(size * compressibility)
+		data = (TEXT * (text_size // len(TEXT) + 1))[:text_size] + rnd.randbytes(size - text_size)
+		with open(os.path.join(rnd.choice(dirs), f"file{i}.dat"), "wb") as f:
+			f.write(data)
+		total += size
+	return total
+
+
+class LatencyOS:
+	"""Stand-in for the os module in backup_scan, adding the given latency (in
+	seconds) to each directory listing and each stat, like a network file system.
+	"""
+
+	def __init__(self, latency: float):
+		self.latency = latency
+
+	def __getattr__(self, name):
+		return getattr(os, name)
+
+	def scandir(self, path):
+		time.sleep(self.latency)
+		with os.scandir(path) as it:
+			return LatencyListing([LatencyEntry(e, self.latency) for e in it])
+
+
+class LatencyListing(list):
+	"""Result of LatencyOS.scandir, usable like the one of os.scandir."""
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		pass
+
+
+class LatencyEntry:
+	"""Directory entry of LatencyOS.scandir, adding latency to stat."""
+
+	def __init__(self, entry: os.DirEntry, latency: float):
+		self.entry, self.latency = entry, latency
+		self.name, self.path = entry.name, entry.path
+
+	def is_dir(self, follow_symlinks=True) -> bool:
+		return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+	def stat(self, follow_symlinks=True) -> os.stat_result:
+		time.sleep(self.latency)
+		return self.entry.stat(follow_symlinks=follow_symlinks)
+
+
+def measure(function: Callable, repeat=3) -> float:
+	"""Run function repeatedly and return the best time in seconds."""
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		function()
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+
+def measure_startup(code: str, repeat=3) -> float:
+	"""Measure the best time for running the Python code in a new process."""
+	cwd = os.path.dirname(os.path.abspath(__file__))
+	return measure(lambda: subprocess.run([sys.executable, "-c", code], cwd=cwd, check=True,
+	                                      stdout=subprocess.DEVNULL), repeat)
+
+
+def measure_rss(code: str) -> int:
+	"""Measure the peak memory (RSS) in bytes for running the Python code in a new
+	process, or -1 where this is not supported.
+	"""
+	if importlib.util.find_spec("resource") is None:
+		return -1
+	code += "\nimport resource; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+	cwd = os.path.dirname(os.path.abspath(__file__))
+	out = subprocess.run([sys.executable, "-c", code], cwd=cwd, check=True, capture_output=True, text=True).stdout
+	# maximum RSS is in kilobytes on Linux, but in bytes on macOS
+	return int(out.split()[-1]) * (1 if sys.platform == "darwin" else 1024)
+
+
+def measure_archive_rss(tmp: str, files: int) -> Dict[str, float]:
+	"""Measure the memory used per file for backing up a tree of the given number of
+	(small) files and one of five times as many, as zip and as tar archives, each in
+	a new process running the whole backup like the command-line tool: scanning,
+	archiving, cataloging and updating the manifest, followed by an incremental
+	backup (of no changes) comparing the snapshot to that manifest.
+	"""
+	roots = [os.path.join(tmp, f"rss{count}") for count in [files, 5 * files]]
+	for root, count in zip(roots, [files, 5 * files]):
+		make_tree(root, files=count, mean_size=64, depth=2)
+	results = {}
+	for kind in ["zip", "tar"]:
+		rss = []
+		for root in roots:
+			work = os.path.join(tmp, f"rss-{kind}-{os.path.basename(root)}")
+			code = (f"import os, config\n"
+			        f"work = {work!r}\n"
+			        f"config.MANIFEST_PATH = os.path.join(work, 'manifests')\n"
+			        f"config.CATALOG_FILE = os.path.join(work, 'catalog')\n"
+			        f"config.JOURNAL_FILE = os.path.join(work, 'journal')\n"
+			        f"config.DIRTY_FILE = os.path.join(work, 'dirty')\n"
+			        f"import backup_core\n"
+			        f"from backup_model import Configuration, Directory\n"
+			        f"directory = Directory({root!r}, {kind!r}, include=True)\n"
+			        f"conf = Configuration(os.path.join(work, '{{dirname}}{{inc}}'), [directory])\n"
+			        f"for incremental in [False, True]:\n"
+			        f"	directory.incremental = incremental\n"
+			        f"	conf.update_includes()\n"
+			        f"	list(backup_core.perform_backup_iter(conf))")
+			rss.append(measure_rss(code))
+		results[f"rss_{kind}_per_file"] = (rss[1] - rss[0]) / (4 * files) if min(rss) >= 0 else -1
+	return results
+
+
+def run_benchmarks(root: str, repeat=3, latency=0.0, rss_files=20000) -> Dict[str, float]:
+	"""Run the benchmarks on the tree at root, returning the times in seconds (and
+	the memory used per file when backing up trees with the given number of files,
+	in bytes, unless 0); if a latency (in seconds) is given, also measure scanning
+	with that latency.
+	"""
+	results = {}
+	with tempfile.TemporaryDirectory() as tmp:
+		manifest_path, config.MANIFEST_PATH = config.MANIFEST_PATH, os.path.join(tmp, "manifests")
+		journal_file, config.JOURNAL_FILE = config.JOURNAL_FILE, os.path.join(tmp, "journal")
+		catalog_file, config.CATALOG_FILE = config.CATALOG_FILE, os.path.join(tmp, "catalog")
+		dirty_file, config.DIRTY_FILE = config.DIRTY_FILE, os.path.join(tmp, "dirty")
+		try:
+			directory = Directory(root, backup_core.TYPE_ZIP, include=True)
+			conf = Configuration(os.path.join(tmp, "{dirname}"), [directory])
+			target = os.path.join(tmp, "target")
+
+			results["scan"] = measure(lambda: directory.scan(refresh=True), repeat)
+			results["scan_parallel"] = measure(lambda: backup_scan.scan(root, workers=backup_scan.NETWORK_WORKERS), repeat)
+			if latency:
+				backup_scan.os = LatencyOS(latency)
+				try:
+					results["scan_latency"] = measure(lambda: backup_scan.scan(root), repeat)
+					results["scan_parallel_latency"] = measure(
+						lambda: backup_scan.scan(root, workers=backup_scan.NETWORK_WORKERS), repeat)
+				finally:
+					backup_scan.os = os
+			# importing the frontend and loading the configuration, without scanning
+			conf_file = os.path.join(tmp, "config.json")
+			with open(conf_file, "w") as f:
+				f.write(write_to_json(conf))
+			load = f"config.load_from_json(open({conf_file!r}).read())"
+			results["startup_cli"] = measure_startup(f"import main, config; {load}", repeat)
+			if importlib.util.find_spec("gi") is not None:
+				results["startup_gui"] = measure_startup(f"import backup_gtk, config; {load}", repeat)
+			results["iter_files"] = measure(lambda: sum(1 for _ in Directory(root, "zip").iter_files()), repeat)
+			results["iter_modified"] = measure(lambda: sum(1 for _ in Directory(root, "zip").iter_modified()), repeat)
+			results["update_includes"] = measure(conf.update_includes, repeat)
+			results["get_size"] = measure(lambda: backup_core.get_size(Directory(root, "zip")), repeat)
+			results["create_zip"] = measure(lambda: backup_core.create_zip(directory.iter_members(), target + ".zip"), repeat)
+			results["create_tar"] = measure(lambda: backup_core.create_tar(directory.iter_members(), target + ".tar"), repeat)
+
+			# full backup to create the manifest, then modify some files for the incremental one
+			directory.incremental = False
+			list(backup_core.perform_backup_iter(conf))
+			rnd = random.Random(1)
+			for path in rnd.sample(list(directory.iter_files()), max(1, len(directory.scan()) // 20)):
+				with open(path, "ab") as f:
+					f.write(b"modified")
+			directory.incremental = True
+			def incremental():
+				directory.include = True
+				conf.update_includes()
+				list(backup_core.perform_backup_iter(conf))
+			results["incremental"] = measure(incremental, 1)
+			if rss_files:
+				results.update(measure_archive_rss(tmp, rss_files))
+		finally:
+			config.MANIFEST_PATH = manifest_path
+			config.JOURNAL_FILE = journal_file
+			config.CATALOG_FILE = catalog_file
+			config.DIRTY_FILE = dirty_file
+	return results
+
+
+def get_commit() -> str:
+	"""Get current git commit, if any, to tell apart results of different versions."""
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(__file__) or ".",
+		                      capture_output=True, text=True).stdout.strip()
+	except OSError:
+		return ""
+
+
+def main():
+	"""Parse command line arguments, generate the tree, run the benchmarks and
+	write the results.
+	"""
+	parser = argparse.ArgumentParser(description="Benchmarks for Simple Backup Tool.")
+	parser.add_argument("--files", type=int, default=1000, help="Number of files to generate")
+	parser.add_argument("--mean-size", type=int, default=16384, help="Mean file size in bytes")
+	parser.add_argument("--sigma", type=float, default=1.5, help="Sigma of the log-normal file size distribution")
+	parser.add_argument("--depth", type=int, default=3, help="Depth of the directory tree")
+	parser.add_argument("--fanout", type=int, default=4, help="Number of subdirectories per directory")
+	parser.add_argument("--compressibility", type=float, default=0.5, help="Fraction of compressible content")
+	parser.add_argument("--seed", type=int, default=0, help="Seed for the tree generator")
+	parser.add_argument("--latency", type=float, default=1.0,
+	                    help="Latency in milliseconds added to directory listings and stats for "
+	                         "the scan_latency benchmarks, or 0 to skip those")
+	parser.add_argument("--rss-files", type=int, default=20000,
+	                    help="Number of files for measuring the memory used per file in backups, or 0 to skip that")
+	parser.add_argument("--repeat", type=int, default=3, help="Number of repetitions, the best time is used")
+	parser.add_argument("--tree", help="Use this existing directory instead of a generated tree")
+	parser.add_argument("--output", help="Write results as JSON to this file instead of stdout")
+	args = parser.parse_args()
+
+	params = {k: v for k, v in vars(args).items() if k not in ("output", "tree", "repeat", "rss_files")}
+	with tempfile.TemporaryDirectory() as tmp:
+		root = args.tree or os.path.join(tmp, "tree")
+		if not args.tree:
+			params["total_size"] = make_tree(root, args.files, args.mean_size, args.sigma, args.depth,
+			                                 args.fanout, args.compressibility, args.seed)
+		results = run_benchmarks(root, args.repeat, args.latency / 1000, args.rss_files)
+
+	report = {"commit": get_commit(), "python": platform.python_version(), "cpus": os.cpu_count(),
+	          "time": time.strftime("%Y-%m-%d %H:%M:%S"), "params": params, "results": results}
+	text = json.dumps(report, indent=4)
+	if args.output:
+		with open(args.output, "w") as f:
+			f.write(text + "\n")
+	else:
+		print(text)
+
+
+if __name__ == "__main__":
+	main()
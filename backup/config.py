@@ -18,6 +18,10 @@ from backup_model import load_from_json, write_to_json, Configuration
 USER_DIR = os.environ["HOME"]
 CONFIG_PATH = os.path.join(USER_DIR, ".config", "t-kuester")
 CONFIG_FILE = os.path.join(CONFIG_PATH, "backup.json")
+MANIFEST_PATH = os.path.join(CONFIG_PATH, "manifests")
+JOURNAL_FILE = os.path.join(CONFIG_PATH, "journal.jsonl")
+CATALOG_FILE = os.path.join(CONFIG_PATH, "catalog.sqlite")
+DIRTY_FILE = os.path.join(CONFIG_PATH, "dirty.jsonl")
 
 DEFAULT_TARGET_PATTERN = "~/BACKUP/{parent}/{dirname} {date}{inc}"
 DEFAULT_ARCHIVE_TYPE = "zip"
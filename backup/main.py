@@ -10,15 +10,26 @@ automatically creating backups for all directories that have been changes since
 """
 
 import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
 
 import backup_core
-import backup_gtk
+import backup_watch
 import config
+from backup_catalog import Catalog
+from backup_stats import format_size
 
 
-def run_commandline(interactive=True):
+def run_commandline(interactive=True, jobs=None, stats_json=None):
 	"""Run in command-line mode, either asking whether to back up each directory,
-	or determining it based on last modification time.
+	or determining it based on last modification time, showing the progress and
+	optionally writing the statistics of the backup run to a JSON file. The backup
+	can be cancelled with Ctrl-C and is continued when running it again.
 	"""
 	with config.open_config() as conf:
 		conf.check()
@@ -28,15 +39,111 @@ def run_commandline(interactive=True):
 				incl = input(f"Include {d.path}? [y/N] ")
 				d.include = incl.lower().startswith("y")
 		else:
-			conf.update_includes()
+			conf.update_includes(backup_watch.load_dirty(config.DIRTY_FILE))
 
-		for msg in backup_core.perform_backup_iter(conf):
+		# on Ctrl-C (or when killed), stop at the next file, so the backup can be continued
+		cancel = threading.Event()
+		def cancel_backup(signum, _frame):
+			print("\nCancelling...")
+			cancel.set()
+			signal.signal(signum, signal.SIG_DFL)  # a second time stops immediately
+		signal.signal(signal.SIGINT, cancel_backup)
+		signal.signal(signal.SIGTERM, cancel_backup)
+
+		finished, last_update = [], 0.0
+		# the number of jobs given on the command line is not saved in the configuration
+		for event in backup_core.perform_backup_events(conf, jobs, cancel=cancel):
+			if event.kind == backup_core.EVENT_FILE:
+				# show progress in the same line, but only every now and then
+				if sys.stdout.isatty() and time.monotonic() - last_update > 0.5:
+					print(f"\r{event}\033[K", end="", flush=True)
+					last_update = time.monotonic()
+				continue
+			if last_update:
+				print("\r\033[K", end="")
+			print(event)
+			if event.kind == backup_core.EVENT_FINISH:
+				finished.append(event.to_dict())
+
+		if stats_json:
+			with open(stats_json, "w") as f:
+				json.dump({"directories": finished, "total": event.to_dict()}, f, indent=4)
+
+
+def run_watch(quiet_period=None, jobs=None):
+	"""Watch the directories for changes until stopped with Ctrl-C, recording them
+	so refreshing and incremental backups only have to look at those files, and
+	optionally back up the changed directories after a period without changes.
+	"""
+	with config.open_config() as conf:
+		conf.check()
+		stop = threading.Event()
+		signal.signal(signal.SIGINT, lambda *_: stop.set())
+		signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+		def backup():
+			conf.update_includes(backup_watch.load_dirty(config.DIRTY_FILE))
+			for msg in backup_core.perform_backup_iter(conf, jobs):
+				print(msg)
+
+		print(f"Watching {len(conf.directories)} directories, stop with Ctrl-C")
+		backup_watch.watch(conf.directories, config.DIRTY_FILE, stop, quiet_period, backup)
+
+
+def run_consolidate():
+	"""Merge the latest full backup and following incremental backups of each
+	directory into a new full backup, without reading the directories again.
+	"""
+	with config.open_config() as conf:
+		for msg in backup_core.consolidate_iter(conf):
 			print(msg)
 
 
+def run_restore(target_dir, as_of=None, names=None, directories=None):
+	"""Restore the files of all (or the given) directories as of the given time
+	to the target directory, optionally only the given files or directories.
+	"""
+	with config.open_config() as conf:
+		paths = [os.path.abspath(d) for d in directories] if directories else None
+		for msg in backup_core.restore_iter(conf, target_dir, as_of, names, paths):
+			print(msg)
+
+
+def run_verify(sample=0.0):
+	"""Verify the archives of all directories not verified yet, comparing the
+	given fraction of the files to the source files, too.
+	"""
+	with config.open_config() as conf:
+		for msg in backup_core.verify_iter(conf, sample):
+			print(msg)
+
+
+def run_index():
+	"""Add the existing archives of all directories to the catalog.
+	"""
+	with config.open_config() as conf:
+		for msg in backup_core.import_catalog_iter(conf):
+			print(msg)
+
+
+def run_search(names, pattern=None, since=None, until=None):
+	"""Print all versions of the files with the given names, or matching the given
+	pattern in the backups made in the given time span, according to the catalog.
+	"""
+	with Catalog(config.CATALOG_FILE) as catalog:
+		entries = [e for name in names for e in catalog.versions(name, since, until)]
+		if pattern:
+			entries.extend(catalog.search(pattern, since, until))
+	for e in entries:
+		print(f"{datetime.fromtimestamp(e.created):%Y-%m-%d %H:%M:%S}  {format_size(e.size):>10}  "
+		      f"{datetime.fromtimestamp(e.mtime):%Y-%m-%d %H:%M:%S}  {e.name}  ({e.archive})")
+
+
 def run_graphical():
-	"""Run with the graphical GTK UI (default).
+	"""Run with the graphical GTK UI (default); GTK is only loaded in this mode,
+	so the command-line modes also work on hosts without a display.
 	"""
+	import backup_gtk
 	with config.open_config() as conf:
 		backup_gtk.BackupFrame(conf)
 		backup_gtk.Gtk.main()
@@ -46,17 +153,68 @@ def main():
 	"""Set up command line arguments parser and chose which way to use the program.
 	"""
 	parser = argparse.ArgumentParser(description='Simple Backup Tool.')
-	parser.add_argument("--mode", dest="mode", choices=["interactive", "automatic", "graphical"],
+	parser.add_argument("--mode", dest="mode", choices=["interactive", "automatic", "graphical", "consolidate", "restore",
+	                                                "index", "search", "watch", "verify"],
 	                    default="graphical", required=False,
 						help="Interactive: Ask whether to back up each directory first; "
 							 "Automatic: Include if modified since last backup; "
-							 "Graphical: Show graphical UI (default)")
+							 "Graphical: Show graphical UI (default); "
+							 "Consolidate: Merge latest full and incremental backups into a new full backup; "
+							 "Restore: Restore files from the backups to the directory given with --restore-to; "
+							 "Index: Add existing archives to the catalog; "
+							 "Search: Find versions of files given with --path or --glob in the catalog; "
+							 "Watch: Record changes in the directories, for faster refreshes and incremental backups; "
+							 "Verify: Check that the archives not verified yet are complete and readable")
+	parser.add_argument("--jobs", dest="jobs", type=int, default=None, required=False,
+	                    help="Number of directories to back up concurrently; directories "
+	                         "on the same (rotational) disk are never read at the same time")
+	parser.add_argument("--stats-json", dest="stats_json", default=None, required=False,
+	                    help="Write statistics of the backup run (sizes, throughput and times "
+	                         "of the different phases per directory) to this JSON file")
+	parser.add_argument("--restore-to", dest="restore_to", default=None, required=False,
+	                    help="Directory to restore the files to (in restore mode)")
+	parser.add_argument("--as-of", dest="as_of", default=None, required=False,
+	                    help="Restore files as they were at the given date (and time), e.g. '2021-03-14 12:00'; "
+	                         "in search mode, only search backups made until then")
+	parser.add_argument("--since", dest="since", default=None, required=False,
+	                    help="In search mode, only search backups made since the given date (and time)")
+	parser.add_argument("--glob", dest="glob", default=None, required=False,
+	                    help="In search mode, find files matching this pattern, e.g. '*/letters/*.odt'")
+	parser.add_argument("--path", dest="names", action="append", default=None, required=False,
+	                    help="Restore only this file or directory, as named in the archive, e.g. "
+	                         "'Documents/letters'; can be given several times")
+	parser.add_argument("--directory", dest="directories", action="append", default=None, required=False,
+	                    help="Restore only backups of this configured directory; can be given several times")
 
+	parser.add_argument("--quiet-period", dest="quiet_period", type=float, default=None, required=False,
+	                    help="In watch mode, back up changed directories after this many seconds without changes")
+	parser.add_argument("--sample", dest="sample", type=float, default=0.0, required=False,
+	                    help="In verify mode, also compare this fraction of the files (0 to 1) "
+	                         "to the source files, if not changed since")
 	args = parser.parse_args()
 	if args.mode == "graphical":
 		run_graphical()
+	elif args.mode == "consolidate":
+		run_consolidate()
+	elif args.mode == "restore":
+		if not args.restore_to:
+			parser.error("restore mode requires --restore-to")
+		as_of = datetime.fromisoformat(args.as_of).timestamp() if args.as_of else None
+		run_restore(args.restore_to, as_of, args.names, args.directories)
+	elif args.mode == "index":
+		run_index()
+	elif args.mode == "search":
+		if not args.names and not args.glob:
+			parser.error("search mode requires --path or --glob")
+		since = datetime.fromisoformat(args.since).timestamp() if args.since else None
+		until = datetime.fromisoformat(args.as_of).timestamp() if args.as_of else None
+		run_search(args.names or [], args.glob, since, until)
+	elif args.mode == "watch":
+		run_watch(args.quiet_period, args.jobs)
+	elif args.mode == "verify":
+		run_verify(args.sample)
 	else:
-		run_commandline(args.mode == "interactive")
+		run_commandline(args.mode == "interactive", args.jobs, args.stats_json)
 
 
 if __name__ == "__main__":
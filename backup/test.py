@@ -1,8 +1,39 @@
+import gzip
+import hashlib
+import io
+import json
+import mmap
 import os
+import random
+import re
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
+import zlib
 
 from backup_model import Configuration, Directory, write_to_json, load_from_json
+from backup_scan import Cancelled
+import backup_archive
+import backup_catalog
 import backup_core
+import backup_delta
+import backup_io
+import backup_scan
+import backup_sparse
+import backup_verify
+import backup_watch
+import backup_exclude
+import backup_journal
+import backup_manifest
+import benchmark
+import backup_repo
+import backup_zip
+import config
 from config import open_config, USER_DIR
 
 TEST_CONFIG = "./test.json"
@@ -11,11 +42,24 @@ TEST_FILE = "./test.txt"
 
 class TestModel(unittest.TestCase):
 
+	def setUp(self):
+		"""keep manifests etc. of test cases out of the actual config directory"""
+		self.config_dir = tempfile.TemporaryDirectory()
+		self.manifest_path, config.MANIFEST_PATH = config.MANIFEST_PATH, self.config_dir.name
+		self.journal_file, config.JOURNAL_FILE = config.JOURNAL_FILE, os.path.join(self.config_dir.name, "journal")
+		self.catalog_file, config.CATALOG_FILE = config.CATALOG_FILE, os.path.join(self.config_dir.name, "catalog")
+		self.dirty_file, config.DIRTY_FILE = config.DIRTY_FILE, os.path.join(self.config_dir.name, "dirty")
+
 	def tearDown(self):
 		"""remove config file from last test after each test case"""
 		for f in [TEST_CONFIG, TEST_FILE]:
 			if os.path.isfile(f):
 				os.remove(f)
+		config.MANIFEST_PATH = self.manifest_path
+		config.JOURNAL_FILE = self.journal_file
+		config.CATALOG_FILE = self.catalog_file
+		config.DIRTY_FILE = self.dirty_file
+		self.config_dir.cleanup()
 
 	def test_config_json(self):
 		"""test basic JSON serialization and deserialization"""
@@ -57,16 +101,820 @@ class TestModel(unittest.TestCase):
 		)
 
 	def test_create_zip(self):
-		"""test creation of zip file"""
-		pass
+		"""test creation of zip file, with files spanning several compressed chunks"""
+		with tempfile.TemporaryDirectory() as tmp:
+			src = os.path.join(tmp, "src")
+			make_files(src, ["a.txt", "sub/b.txt", "sub/ümläut.txt"])
+			make_files(src, ["big.txt"], content="".join(f"line {i}\n" for i in range(100000)))
+			make_files(src, ["empty.txt"], content="")
+			directory = Directory(src, "zip")
+			target_file = os.path.join(tmp, "test.zip")
+			chunk_size, backup_zip.CHUNK_SIZE = backup_zip.CHUNK_SIZE, 4096
+			spool_size, backup_zip.CENTRAL_SPOOL_SIZE = backup_zip.CENTRAL_SPOOL_SIZE, 100
+			try:
+				backup_core.create_zip(directory.iter_members(), target_file, {"extra": b"data"}, threads=4)
+			finally:
+				backup_zip.CHUNK_SIZE = chunk_size
+				backup_zip.CENTRAL_SPOOL_SIZE = spool_size
+			with zipfile.ZipFile(target_file) as zf:
+				self.assertIsNone(zf.testzip())
+				self.assertEqual(sorted(zf.namelist()), ["extra", "src/a.txt", "src/big.txt", "src/empty.txt",
+				                                         "src/sub/b.txt", "src/sub/ümläut.txt"])
+				for entry, name in directory.iter_members():
+					with open(entry.path, "rb") as f:
+						self.assertEqual(zf.read(name), f.read())
+				self.assertLess(zf.getinfo("src/big.txt").compress_size, os.path.getsize(os.path.join(src, "big.txt")) / 2)
+				infos = {i.filename: (i.file_size, i.CRC, i.header_offset) for i in zf.infolist()}
+			with open(target_file, "rb") as f:
+				self.assertEqual({r.name: (r.file_size, r.crc, r.header_offset) for r in backup_zip.iter_central(f)}, infos)
 
 	def test_create_tar(self):
-		"""test creation of tar file"""
-		pass
+		"""test creation of plain and compressed tar files"""
+		with tempfile.TemporaryDirectory() as tmp:
+			src = os.path.join(tmp, "src")
+			make_files(src, ["a.txt", "sub/b.txt"])
+			make_files(src, ["big.txt"], content="".join(f"line {i}\n" for i in range(300000)))
+			directory = Directory(src, "tar")
+			for ext in ["tar", "tar.gz", "tar.xz"]:
+				target_file = os.path.join(tmp, f"test.{ext}")
+				stats = backup_core.create_tar(directory.iter_members(), target_file, {"extra": b"data"}, threads=3)
+				self.assertEqual(stats.files, 3)
+				with tarfile.open(target_file) as tf:
+					self.assertEqual(sorted(tf.getnames()), ["extra", "src/a.txt", "src/big.txt", "src/sub/b.txt"])
+					for entry, name in directory.iter_members():
+						with open(entry.path, "rb") as f:
+							self.assertEqual(tf.extractfile(name).read(), f.read())
+				if ext != "tar":
+					self.assertLess(stats.bytes_out, stats.bytes_in / 2)
+
+			# the threads compressing the data are stopped also if writing the archive fails
+			def failing():
+				yield from directory.iter_members()
+				raise OSError("disk full")
+			threads = threading.active_count()
+			with self.assertRaises(OSError):
+				backup_core.create_tar(failing(), os.path.join(tmp, "failed.tar.gz"), threads=3)
+			self.assertEqual(threading.active_count(), threads)
+
+	def test_create_auto(self):
+		"""test that incompressible files are stored in auto mode"""
+		with tempfile.TemporaryDirectory() as tmp:
+			src = os.path.join(tmp, "src")
+			make_files(src, ["text.txt", "image.jpg"], content="compressible " * 1000)
+			with open(os.path.join(src, "random.bin"), "wb") as f:
+				f.write(os.urandom(100000))
+			directory = Directory(src, "auto")
+			target_file = os.path.join(tmp, "test.zip")
+			stats = backup_core.create_auto(directory.iter_members(), target_file)
+			with zipfile.ZipFile(target_file) as zf:
+				self.assertIsNone(zf.testzip())
+				types = {i.filename: i.compress_type for i in zf.infolist()}
+			self.assertEqual(types, {"src/text.txt": zipfile.ZIP_DEFLATED, "src/image.jpg": zipfile.ZIP_STORED,
+			                         "src/random.bin": zipfile.ZIP_STORED})
+			self.assertEqual((stats.files, stats.stored_files, stats.stored_bytes), (3, 2, 113000))
+			self.assertGreater(stats.saved_bytes(), 10000)
+
+	def test_repository(self):
+		"""test that unchanged chunks are stored only once in the repository"""
+		with tempfile.TemporaryDirectory() as tmp:
+			src = os.path.join(tmp, "src")
+			big = random.Random(0).randbytes(8 << 20)
+			make_files(src, ["a.txt", "sub/b.txt"])
+			with open(os.path.join(src, "big.bin"), "wb") as f:
+				f.write(big)
+			directory = Directory(src, "repo", include=True)
+			# the repository is shared by snapshots in directories named after the date
+			conf = Configuration(tmp + "/tgt/{date}/{dirname} {datetime}", [directory])
+			repo = backup_repo.get_repository(conf.target_pattern)
+			first = backup_core.backup_directory(conf, directory)
+			self.assertGreater(first.bytes_out, 8 << 20)
+			self.assertEqual(repo, os.path.join(tmp, "tgt", "chunks"))
+
+			# a chunk left incomplete, e.g. by a crash, is written again
+			latest = backup_repo.latest_snapshot(repo, src)
+			chunks = next(f["chunks"] for f in backup_repo.iter_files(latest) if f["name"] == "src/big.bin")
+			chunk = min((backup_repo.chunk_path(repo, d) for d in chunks[1:]), key=os.path.getsize)
+			with open(chunk, "r+b") as f:
+				f.truncate(10)
+
+			# insert some bytes at the start: only the first chunk changes
+			with open(os.path.join(src, "big.bin"), "wb") as f:
+				f.write(b"inserted" + big)
+			second = backup_core.backup_directory(conf, Directory(src, "repo", include=True))
+			self.assertLess(second.bytes_out, first.bytes_out / 4)
+
+			# snapshots of an older version hold all the files in a single object
+			files = list(backup_repo.iter_files(backup_repo.latest_snapshot(repo, src)))
+			with gzip.open(backup_repo.latest_snapshot(repo, src), "wt", encoding="utf8") as f:
+				json.dump({"path": src, "created": 0, "files": files[::-1], "extra": {}}, f)
+			third = backup_core.backup_directory(conf, Directory(src, "repo", include=True))
+			self.assertLess(third.bytes_out, 10000)
+			self.assertEqual(list(backup_repo.iter_files(backup_repo.latest_snapshot(repo, src))), files)
+
+			backup_repo.restore_snapshot(backup_repo.latest_snapshot(repo, src), os.path.join(tmp, "restore"))
+			for name in ["a.txt", "sub/b.txt", "big.bin"]:
+				with open(os.path.join(src, name), "rb") as f1, open(os.path.join(tmp, "restore/src", name), "rb") as f2:
+					self.assertEqual(f1.read(), f2.read())
 
 	def test_calc_include(self):
 		"""test directories to include with (a) no prior backup, (b) modified files, (c) no changes"""
-		pass
+		with tempfile.TemporaryDirectory() as tmp:
+			make_files(tmp, ["a.txt", "sub/b.txt"])
+			directory = Directory(tmp, "zip")
+			conf = Configuration("{dirname}", [directory])
+			conf.update_includes()
+			self.assertTrue(directory.include)
+			directory.last_backup = os.path.getmtime(os.path.join(tmp, "a.txt")) + 10
+			conf.update_includes()
+			self.assertFalse(directory.include)
+			make_files(tmp, ["sub/c.txt"], mtime=directory.last_backup + 10)
+			conf.update_includes()
+			self.assertTrue(directory.include)
+			directory.incremental = True
+			self.assertEqual(list(directory.to_relative(directory.iter_include())),
+			                 [os.path.join(os.path.basename(tmp), "sub", "c.txt")])
+
+	def test_manifest_incremental(self):
+		"""test that files moved in with old mtime and deleted files are detected"""
+		with tempfile.TemporaryDirectory() as tmp:
+			src, tgt = os.path.join(tmp, "src"), os.path.join(tmp, "tgt")
+			make_files(src, ["a.txt", "b.txt"])
+			directory = Directory(src, "zip", incremental=True, include=True)
+			conf = Configuration(tgt + "/{dirname} {datetime}{inc}", [directory])
+			self.assertEqual(list(backup_core.perform_backup_iter(conf))[0], f"Backing up {src}")
+			conf.update_includes()
+			self.assertFalse(directory.include)
+
+			make_files(src, ["c.txt"], mtime=946684800.0)
+			os.remove(os.path.join(src, "b.txt"))
+			conf.update_includes()
+			self.assertTrue(directory.include)
+			self.assertEqual(list(directory.to_relative(directory.iter_modified())), ["src/c.txt"])
+			self.assertEqual(list(directory.to_relative(directory.deleted_files())), ["src/b.txt"])
+
+			target_file = backup_core.get_target_file(conf, directory)
+			list(backup_core.perform_backup_iter(conf))
+			with zipfile.ZipFile(target_file) as zf:
+				self.assertEqual(sorted(zf.namelist()), [".backup_deleted", "src/c.txt"])
+				self.assertEqual(zf.read(".backup_deleted"), b"src/b.txt\n")
+			conf.update_includes()
+			self.assertFalse(directory.include)
+
+	def test_hash_check(self):
+		"""test that files with changed mtime but same content are not modified"""
+		with tempfile.TemporaryDirectory() as tmp:
+			make_files(tmp, ["a.txt", "b.txt"])
+			directory = Directory(tmp, "zip", hash_check=True)
+			directory.update_manifest()
+			self.assertTrue(all(e.hash for e in directory.manifest().values()))
+			make_files(tmp, ["a.txt"], mtime=946684800.0)
+			make_files(tmp, ["b.txt"], content="changed\n", mtime=946684800.0)
+			conf = Configuration("{dirname}", [directory])
+			conf.update_includes()
+			self.assertTrue(directory.include)
+			self.assertEqual(list(directory.to_relative(directory.iter_modified())), [os.path.basename(tmp) + "/b.txt"])
+			# verified file is updated in the manifest and not hashed again
+			self.assertEqual(dict(directory.manifest(refresh=True).items())["a.txt"].mtime_ns, 946684800 * 10**9)
+
+		# files are hashed while archiving them, instead of reading them again afterwards
+		for archive_type in ["zip", "tar.gz"]:
+			with tempfile.TemporaryDirectory() as tmp:
+				make_files(os.path.join(tmp, "src"), ["a.txt", "sub/b.txt"])
+				directory = Directory(os.path.join(tmp, "src"), archive_type, include=True, hash_check=True)
+				conf = Configuration(tmp + "/tgt/{dirname}", [directory])
+				hash_file, hashed = backup_manifest.hash_file, []
+				backup_manifest.hash_file = lambda entry: hashed.append(entry) or hash_file(entry)
+				try:
+					list(backup_core.perform_backup_iter(conf))
+				finally:
+					backup_manifest.hash_file = hash_file
+				self.assertEqual(hashed, [])
+				expected = hashlib.blake2b(b"content\n", digest_size=16).hexdigest()
+				self.assertEqual({n: e.hash for n, e in directory.manifest().items()},
+				                 {"a.txt": expected, "sub/b.txt": expected})
+
+	def test_parallel_backup(self):
+		"""test backing up several directories concurrently"""
+		with tempfile.TemporaryDirectory() as tmp:
+			dirs = [Directory(os.path.join(tmp, f"src{i}"), "tar", include=i != 2) for i in range(5)]
+			for d in dirs:
+				make_files(d.path, ["a.txt", "sub/b.txt"])
+			conf = Configuration(tmp + "/tgt/{dirname}", dirs, jobs=3)
+			msgs = list(backup_core.perform_backup_iter(conf))
+			self.assertTrue(msgs[-1].startswith("Done (8 files"))
+			self.assertEqual(sorted(msgs[:-1]), sorted(f"{'Skipping' if i == 2 else 'Backing up'} {d.path}"
+			                                           for i, d in enumerate(dirs)))
+			for i, d in enumerate(dirs):
+				self.assertEqual(os.path.isfile(f"{tmp}/tgt/src{i}.tar"), i != 2)
+				self.assertEqual(d.last_backup > 0, i != 2)
+
+	def test_backup_events(self):
+		"""test progress events with bytes and phases of the backup"""
+		with tempfile.TemporaryDirectory() as tmp:
+			dirs = [Directory(os.path.join(tmp, f"src{i}"), "zip", include=i != 1) for i in range(2)]
+			make_files(dirs[0].path, ["a.txt", "sub/b.txt"])
+			conf = Configuration(tmp + "/tgt/{dirname}", dirs)
+			events = list(backup_core.perform_backup_events(conf))
+			self.assertEqual([e.kind for e in events], ["start", "file", "file", "finish", "skip", "done"])
+			self.assertEqual(events[2].bytes_total, 16)
+			self.assertEqual(events[2].fraction(), 1.0)
+			self.assertEqual(set(events[3].phases), {"scan", "archive", "manifest"})
+			self.assertEqual(events[3].stats.files, 2)
+			self.assertEqual(events[-1].bytes_out, events[3].stats.bytes_out)
+			self.assertTrue(str(events[-1]).startswith("Done (2 files"))
+
+	def test_resume_backup(self):
+		"""test cancelling a backup and continuing it from the checkpoint journal"""
+		checkpoint_files, backup_journal.CHECKPOINT_FILES = backup_journal.CHECKPOINT_FILES, 4
+		try:
+			for archive_type in ["zip", "tar"]:
+				with tempfile.TemporaryDirectory() as tmp:
+					dirs = [Directory(os.path.join(tmp, f"src{i}"), archive_type, include=True) for i in range(2)]
+					make_files(dirs[0].path, ["a.txt"])
+					make_files(dirs[1].path, [f"f{i:02d}.txt" for i in range(30)], content="x" * 5000)
+					conf = Configuration(tmp + "/tgt/{dirname}", dirs)
+					target_file = backup_core.get_target_file(conf, dirs[1])
+
+					cancel = threading.Event()
+					for event in backup_core.perform_backup_events(conf, cancel=cancel):
+						if event.kind == "file" and event.path.endswith("f20.txt"):
+							cancel.set()
+					self.assertEqual(event.kind, "cancelled")
+					self.assertTrue(os.path.isfile(backup_core.get_target_file(conf, dirs[0])))
+					self.assertTrue(os.path.isfile(target_file + ".part"))
+					self.assertFalse(os.path.exists(target_file))
+
+					events = list(backup_core.perform_backup_events(conf))
+					self.assertEqual([e.kind for e in events if e.kind != "file"], ["skip", "start", "finish", "done"])
+					self.assertLess(events[-1].stats.files, 30)
+					self.assertFalse(os.path.exists(target_file + ".part"))
+					self.assertFalse(os.path.exists(config.JOURNAL_FILE))
+					if archive_type == "zip":
+						with zipfile.ZipFile(target_file) as zf:
+							self.assertIsNone(zf.testzip())
+							names = zf.namelist()
+					else:
+						with tarfile.open(target_file) as tf:
+							names = tf.getnames()
+					self.assertEqual(sorted(names), [f"src1/f{i:02d}.txt" for i in range(30)])
+		finally:
+			backup_journal.CHECKPOINT_FILES = checkpoint_files
+
+	def test_sinks(self):
+		"""test writing archives through the object store sink, split into volumes"""
+		with tempfile.TemporaryDirectory() as tmp:
+			directory = Directory(os.path.join(tmp, "src"), "tar", include=True)
+			make_files(directory.path, [f"f{i}.txt" for i in range(10)], content="x" * 3000)
+			conf = Configuration(tmp + "/tgt/{dirname}", [directory], sink="object", volume_size=10000)
+			self.assertEqual(list(backup_core.perform_backup_iter(conf))[-1][:13], "Done (10 file")
+			volumes = sorted(f for f in os.listdir(tmp + "/tgt") if f.startswith("src.tar."))
+			self.assertEqual(volumes, [f"src.tar.{i:03d}" for i in range(1, len(volumes) + 1)])
+			self.assertTrue(all(os.path.getsize(f"{tmp}/tgt/{v}") == 10000 for v in volumes[:-1]))
+			self.assertEqual(os.listdir(tmp + "/tgt/.uploads"), [])
+			data = b"".join(open(f"{tmp}/tgt/{v}", "rb").read() for v in volumes)
+			with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+				self.assertEqual(len(tf.getnames()), 10)
+
+			conf.sink = "unknown"
+			self.assertRaises(Exception, conf.check)
+
+	def test_volumes(self):
+		"""test that archives split into volumes are cataloged, verified and restored"""
+		for archive_type in ["zip", "tar.gz"]:
+			with tempfile.TemporaryDirectory() as tmp:
+				directory = Directory(os.path.join(tmp, "src"), archive_type, include=True, compression_level=0)
+				make_files(directory.path, [f"f{i}.txt" for i in range(10)], content="x" * 3000)
+				conf = Configuration(tmp + "/tgt/{dirname}", [directory], volume_size=10000)
+				list(backup_core.perform_backup_iter(conf))
+				first = f"{tmp}/tgt/src.{archive_type}.001"
+				self.assertTrue(os.path.exists(f"{tmp}/tgt/src.{archive_type}.002"))
+				self.assertEqual(backup_core.find_archives(conf, directory), [(first, None)])
+				with backup_catalog.Catalog(config.CATALOG_FILE) as catalog:
+					self.assertEqual(len(catalog.entries(first)), 10)
+				self.assertTrue(all(m.startswith("Verified") for m in list(backup_core.verify_iter(conf))[1:]))
+				out = os.path.join(tmp, "out")
+				list(backup_core.restore_iter(conf, out))
+				self.assertEqual(sorted(os.listdir(os.path.join(out, "src"))), [f"f{i}.txt" for i in range(10)])
+				with open(os.path.join(out, "src/f9.txt")) as f:
+					self.assertEqual(f.read(), "x" * 3000)
+
+	def test_consolidate(self):
+		"""test merging full and incremental backups into a new full backup"""
+		for archive_type in ["zip", "tar.gz"]:
+			with tempfile.TemporaryDirectory() as tmp:
+				src = os.path.join(tmp, "src")
+				make_files(src, ["a.txt", "b.txt", "c.txt"])
+				directory = Directory(src, archive_type, include=True)
+				conf = Configuration(tmp + "/tgt/{dirname} {datetime}{inc}", [directory])
+				list(backup_core.perform_backup_iter(conf))
+				directory.incremental = True
+				make_files(src, ["b.txt", "d.txt"], content="changed\n", mtime=946684800.0)
+				os.remove(os.path.join(src, "c.txt"))
+				conf.update_includes()
+				list(backup_core.perform_backup_iter(conf))
+				self.assertEqual(len(backup_core.find_chain(conf, directory)), 2)
+
+				chain = backup_core.find_chain(conf, directory)
+				msgs = list(backup_core.consolidate_iter(conf))
+				full = msgs[-1][len("Created "):msgs[-1].index(" (")]
+				self.assertEqual(msgs[-1][len(full) + 8:len(full) + 17], " (3 files")
+				self.assertNotIn(full, chain)
+				self.assertTrue(all(os.path.exists(p) for p in chain))
+				archive = backup_archive.open_archive(full)
+				contents = {m.name: data.read() for m, data in archive.iter_data()}
+				self.assertEqual(contents, {"src/a.txt": b"content\n", "src/b.txt": b"changed\n", "src/d.txt": b"changed\n"})
+				self.assertFalse(archive.is_incremental())
+				archive.close()
+				if archive_type == "zip":
+					with zipfile.ZipFile(full) as zf:
+						self.assertIsNone(zf.testzip())
+				with backup_catalog.Catalog(config.CATALOG_FILE) as catalog:
+					self.assertEqual(sorted(e.name for e in catalog.entries(full)), ["src/a.txt", "src/b.txt", "src/d.txt"])
+
+				# archives of the chain are not replaced by the new full backup
+				conf.target_pattern = tmp + "/tgt2/{dirname} {date}{inc}"
+				directory.incremental = False
+				list(backup_core.perform_backup_iter(conf))
+				directory.incremental = True
+				make_files(src, ["e.txt"])
+				conf.update_includes()
+				list(backup_core.perform_backup_iter(conf))
+				full = backup_core.find_chain(conf, directory)[0]
+				mtime = os.path.getmtime(full)
+				self.assertEqual(list(backup_core.consolidate_iter(conf)),
+				                 [f"Not consolidating {src}, as {full} exists already"])
+				self.assertEqual(os.path.getmtime(full), mtime)
+
+		# directories backed up incrementally from the start are consolidated, too
+		with tempfile.TemporaryDirectory() as tmp:
+			src = os.path.join(tmp, "src")
+			make_files(src, ["a.txt"])
+			directory = Directory(src, "zip", include=True, incremental=True)
+			conf = Configuration(tmp + "/tgt/{dirname} {datetime}{inc}", [directory])
+			list(backup_core.perform_backup_iter(conf))
+			first = backup_core.find_archives(conf, directory)[0][0]
+			os.utime(first, (1000000000, 1000000000))
+			os.rename(first, first.replace(" 20", " 19"))
+			make_files(src, ["b.txt"])
+			conf.update_includes()
+			list(backup_core.perform_backup_iter(conf))
+			self.assertEqual(list(backup_core.consolidate_iter(conf))[0], f"Consolidating 2 archives of {src}")
+
+	def test_sparse_hardlinks(self):
+		"""test that sparse files are archived without their holes, hard links as links,
+		and both are restored and consolidated as such, also if the linked file is gone"""
+		size, data_offset = 4 * backup_zip.CHUNK_SIZE, 2 * backup_zip.CHUNK_SIZE + 100
+		for archive_type in ["zip", "tar", "tar.gz"]:
+			with tempfile.TemporaryDirectory() as tmp:
+				src = os.path.join(tmp, "src")
+				make_files(src, ["a.txt"])
+				for name in ["b.txt", "c.txt"]:
+					os.link(os.path.join(src, "a.txt"), os.path.join(src, name))
+				with open(os.path.join(src, "disk.img"), "wb") as f:
+					f.truncate(size)
+					f.seek(data_offset)
+					f.write(b"data")
+				with open(os.path.join(src, "disk.img"), "rb") as f:
+					ranges = backup_sparse.data_ranges(f.fileno(), size)
+				self.assertEqual(ranges[0][0] > 0, backup_sparse.has_holes(ranges, size))
+				directory = Directory(src, archive_type, include=True)
+				conf = Configuration(tmp + "/tgt/{dirname} {datetime}{inc}", [directory])
+				list(backup_core.perform_backup_iter(conf))
+				first = backup_core.find_archives(conf, directory)[0][0]
+				members = {m.name: m for m in backup_archive.open_archive(first).members()}
+				# the scan order decides which of the links is the first one
+				links = {n: m.link for n, m in members.items() if m.link}
+				self.assertEqual(len(links), 2)
+				linked = set(links.values())
+				self.assertEqual(len(linked | set(links)), 3)
+				if archive_type == "tar" and backup_sparse.has_holes(ranges, size):
+					self.assertTrue(members["src/disk.img"].info.issparse())
+					self.assertLess(os.path.getsize(first), backup_zip.CHUNK_SIZE)
+
+				# remove the file the others link to, so the first remaining link gets its data
+				os.rename(first, re.sub(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d", "2001-09-09 01:46:40", first))
+				os.remove(os.path.join(tmp, linked.pop()))
+				make_files(src, ["d.txt"])
+				directory.incremental = True
+				conf.update_includes()
+				list(backup_core.perform_backup_iter(conf))
+				chain = backup_core.find_chain(conf, directory)
+				self.assertEqual(len(chain), 2)
+				consolidated = os.path.join(tmp, "consolidated." + ("tar" if archive_type == "zip" else "zip"))
+				backup_archive.consolidate(chain, consolidated)
+
+				# the chain is restored also with the archives listed from the catalog
+				list(backup_core.import_catalog_iter(conf))
+				for paths in [chain, [consolidated], None]:
+					out = os.path.join(tmp, "out", os.path.basename(paths[-1]) if paths else "catalog")
+					if paths is None:
+						list(backup_core.restore_iter(conf, out))
+					else:
+						backup_archive.restore(paths, out)
+					files = {os.path.relpath(os.path.join(d, f), out) for d, _, fs in os.walk(out) for f in fs}
+					self.assertEqual(len(files), 4)
+					links = [os.path.join(out, f) for f in files if f.endswith(".txt") and f != "src/d.txt"]
+					self.assertEqual(len(links), 2)
+					self.assertTrue(os.path.samefile(*links))
+					self.assertEqual(open(links[0]).read(), "content\n")
+					img = os.path.join(out, "src/disk.img")
+					with open(img, "rb") as f:
+						self.assertEqual(f.read(), bytes(data_offset) + b"data" + bytes(size - data_offset - 4))
+					if backup_sparse.has_holes(ranges, size):
+						self.assertLess(os.stat(img).st_blocks * 512, size)
+
+	def test_deltas(self):
+		"""test that large files changed in parts are stored as deltas in incremental
+		backups, and restored and consolidated from those, also if the previous
+		version of the file is a hard link to a file deleted since"""
+		block = backup_delta.BLOCK_SIZE
+		for archive_type in ["zip", "tar.gz"]:
+			with tempfile.TemporaryDirectory() as tmp:
+				src = os.path.join(tmp, "src")
+				make_files(src, ["a.txt"])
+				big = os.path.join(src, "big.log")
+				content = random.Random(0).randbytes(8 * block + 100)
+				with open(big, "wb") as f:
+					f.write(content)
+				linked = random.Random(1).randbytes(3 * block)
+				with open(os.path.join(src, "x.log"), "wb") as f:
+					f.write(linked)
+				os.link(os.path.join(src, "x.log"), os.path.join(src, "y.log"))
+				directory = Directory(src, archive_type, include=True, delta_size=block)
+				conf = Configuration(tmp + "/tgt/{dirname} {datetime}{inc}", [directory])
+				for i in range(3):
+					list(backup_core.perform_backup_iter(conf))
+					# move each backup back in time, out of the way of the next one
+					archive = backup_core.find_archives(conf, directory)[-1][0]
+					older = re.sub(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d", f"2001-09-09 01:46:4{i}", archive)
+					os.rename(archive, older)
+					os.utime(older, (1000000000 + i, 1000000000 + i))
+					if i == 0:
+						# delete the file the other one links to, and change the latter
+						[link] = [m for m in backup_archive.open_archive(older).members() if m.link]
+						os.remove(os.path.join(tmp, link.link))
+						linked = linked[:block] + bytes(block) + linked[2 * block:]
+						with open(os.path.join(tmp, link.name), "wb") as f:
+							f.write(linked)
+					if i == 1 and archive_type != "zip":
+						self.assertIn(link.name, backup_archive.open_archive(older).deltas())
+					if i > 0:
+						self.assertIn("src/big.log", backup_archive.open_archive(older).deltas())
+						self.assertLess(os.path.getsize(older), 4 * block)
+						_, entries, _ = backup_catalog.read_entries(older)
+						self.assertIn(("src/big.log", len(content)), [e[:2] for e in entries])
+					# change a block in the middle and append to the file
+					content = content[:3 * block] + bytes(block) + content[4 * block:] + b"appended" * i
+					with open(big, "wb") as f:
+						f.write(content)
+					directory.incremental = True
+					conf.update_includes()
+				content = content[:-8 * 2]  # the last change is not backed up
+
+				chain = backup_core.find_chain(conf, directory)
+				self.assertEqual(len(chain), 3)
+				consolidated = os.path.join(tmp, "consolidated.zip")
+				backup_archive.consolidate(chain, consolidated)
+				# the chain is restored also with the archives listed from the catalog
+				list(backup_core.import_catalog_iter(conf))
+				for paths in [chain, [consolidated], None]:
+					out = os.path.join(tmp, "out", os.path.basename(paths[-1]) if paths else "catalog")
+					if paths is None:
+						list(backup_core.restore_iter(conf, out))
+					else:
+						backup_archive.restore(paths, out)
+					self.assertEqual(sorted(os.listdir(os.path.join(out, "src"))),
+					                 sorted(["a.txt", "big.log", os.path.basename(link.name)]))
+					with open(os.path.join(out, "src/big.log"), "rb") as f:
+						self.assertEqual(f.read(), content)
+					with open(os.path.join(out, link.name), "rb") as f:
+						self.assertEqual(f.read(), linked)
+
+	def test_verify(self):
+		"""test verifying archives against the catalog and the source files, and
+		that archives verified successfully are not verified again"""
+		for archive_type in ["zip", "tar", "tar.gz"]:
+			with tempfile.TemporaryDirectory() as tmp:
+				src = os.path.join(tmp, "src")
+				make_files(src, [f"f{i}.txt" for i in range(20)], mtime=946684800.0)
+				directory = Directory(src, archive_type, include=True)
+				conf = Configuration(tmp + "/tgt/{dirname}", [directory])
+				list(backup_core.perform_backup_iter(conf))
+				target_file = backup_core.get_target_file(conf, directory)
+				with backup_catalog.Catalog(config.CATALOG_FILE) as catalog:
+					entries = catalog.entries(target_file)
+				self.assertTrue(all(e.crc == zlib.crc32(b"content\n") for e in entries))
+
+				msgs = list(backup_core.verify_iter(conf, sample=1.0))
+				self.assertEqual(msgs, ["Verifying 1 archives", f"Verified {target_file} (20 files, 20 compared to source)"])
+				self.assertEqual(list(backup_core.verify_iter(conf)), ["Verifying 0 archives"])
+
+				# a changed source file with the old modification time, and a truncated archive
+				make_files(src, ["f0.txt"], content="changed\n", mtime=946684800.0)
+				archive = (target_file, src, os.path.getmtime(target_file), entries)
+				[result] = backup_verify.verify_archives([archive], sample=1.0)
+				self.assertEqual(result.errors, ["src/f0.txt: differs from source file"])
+				with open(target_file, "r+b") as f:
+					f.truncate(os.path.getsize(target_file) // 2)
+				[result] = backup_verify.verify_archives([archive])
+				self.assertTrue(result.errors)
+
+	def test_restore_incremental_only(self):
+		"""test restoring a directory backed up incrementally from the start"""
+		for archive_type in ["zip", "tar.gz"]:
+			with tempfile.TemporaryDirectory() as tmp:
+				src, out = os.path.join(tmp, "src"), os.path.join(tmp, "out")
+				make_files(src, ["a.txt", "sub/b.txt"])
+				directory = Directory(src, archive_type, include=True, incremental=True)
+				conf = Configuration(tmp + "/tgt/{dirname}{inc} {datetime}", [directory])
+				list(backup_core.perform_backup_iter(conf))
+				self.assertEqual(len(backup_core.find_chain(conf, directory)), 1)
+				msgs = list(backup_core.restore_iter(conf, out))
+				self.assertEqual(msgs[0], f"Restoring {src} from 1 archives")
+				self.assertEqual(sorted(os.path.relpath(os.path.join(d, f), out) for d, _, fs in os.walk(out) for f in fs),
+				                 ["src/a.txt", "src/sub/b.txt"])
+
+	def test_restore(self):
+		"""test restoring files from full and incremental backups, as of a given time,
+		reading each compressed tar archive only once, with or without the catalog"""
+		for archive_type in ["zip", "tar", "tar.gz", "repo"]:
+			with tempfile.TemporaryDirectory() as tmp:
+				src = os.path.join(tmp, "src")
+				make_files(src, ["a.txt", "b.txt", "sub/c.txt"])
+				directory = Directory(src, archive_type, include=True)
+				conf = Configuration(tmp + "/tgt/{dirname} {datetime}{inc}", [directory])
+				list(backup_core.perform_backup_iter(conf))
+				# move first backup back in time (and out of the way of the second)
+				first = backup_core.find_archives(conf, directory)[0][0]
+				older = re.sub(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d", "2001-09-09 01:46:40", first)
+				os.rename(first, older)
+				os.utime(older, (1000000000, 1000000000))
+				directory.incremental = archive_type != "repo"
+				make_files(src, ["b.txt", "sub/d.txt"], content="changed\n", mtime=946684800.0)
+				os.remove(os.path.join(src, "sub/c.txt"))
+				conf.update_includes()
+				list(backup_core.perform_backup_iter(conf))
+
+				def restored(until=None, names=None):
+					out = os.path.join(tmp, "out", str(until), str(names))
+					list(backup_core.restore_iter(conf, out, until, names))
+					return {os.path.relpath(os.path.join(d, f), out): open(os.path.join(d, f)).read()
+					        for d, _, fs in os.walk(out) for f in fs}
+
+				self.assertEqual(restored(), {"src/a.txt": "content\n", "src/b.txt": "changed\n",
+				                              "src/sub/d.txt": "changed\n"})
+				self.assertEqual(restored(names=["src/sub"]), {"src/sub/d.txt": "changed\n"})
+				self.assertEqual(restored(1500000000, ["src/b.txt", "src/sub/"]),
+				                 {"src/b.txt": "content\n", "src/sub/c.txt": "content\n"})
+				self.assertEqual(os.path.getmtime(os.path.join(tmp, "out/None/None/src/b.txt")), 946684800.0)
+
+				if archive_type == "tar.gz":
+					# with the catalog, the archives are read only for extracting files
+					list(backup_core.import_catalog_iter(conf))
+					open_decompressed, reads = backup_archive.backup_compress.open_decompressed, []
+					backup_archive.backup_compress.open_decompressed = lambda *args: reads.append(args) or open_decompressed(*args)
+					try:
+						self.assertEqual(restored(names=["src/none"]), {})
+						self.assertEqual(len(reads), 0)
+						self.assertEqual(len(restored(names=["src/a.txt", "src/sub"])), 2)
+						self.assertEqual(len(reads), 2)
+						os.remove(config.CATALOG_FILE)
+						reads.clear()
+						self.assertEqual(len(restored(names=["src/b.txt", "src/sub"])), 2)
+						self.assertEqual(len(reads), 2)
+					finally:
+						backup_archive.backup_compress.open_decompressed = open_decompressed
+
+	def test_catalog(self):
+		"""test that new archives are added to the catalog and existing ones imported"""
+		with tempfile.TemporaryDirectory() as tmp:
+			types = ["zip", "tar", "tar.gz", "repo"]
+			for archive_type in types:
+				make_files(os.path.join(tmp, archive_type, "src"), ["a.txt", "sub/b.txt"])
+			directories = [Directory(os.path.join(tmp, t, "src"), t, include=True) for t in types]
+			conf = Configuration(tmp + "/tgt/{parent}/{dirname} {datetime}", directories)
+			list(backup_core.perform_backup_iter(conf))
+			with backup_catalog.Catalog(config.CATALOG_FILE) as catalog:
+				versions = {v.archive.rsplit(".", 1)[-1]: v for v in catalog.versions("src/sub/b.txt")}
+				self.assertEqual(set(versions), {"zip", "tar", "gz", "snapshot"})
+				self.assertTrue(all(v.size == 8 for v in versions.values()))
+				self.assertEqual(versions["zip"].crc, zlib.crc32(b"content\n"))
+				self.assertIsNone(versions["gz"].offset)
+				with open(versions["tar"].archive, "rb") as f:
+					f.seek(versions["tar"].offset)
+					self.assertEqual(f.read(8), b"content\n")
+				self.assertEqual(len(catalog.search("src/*.txt")), 8)
+				self.assertEqual(catalog.search("src/*.txt", until=1000000000), [])
+
+			# import again from scratch, without the removed archive
+			os.remove(config.CATALOG_FILE)
+			os.remove(versions["zip"].archive)
+			msgs = list(backup_core.import_catalog_iter(conf))
+			self.assertEqual(msgs, [f"Added {n} archives of {d.path} to catalog" for n, d in zip([0, 1, 1, 1], directories)]
+			                 + ["Removed 0 missing archives from catalog"])
+			with backup_catalog.Catalog(config.CATALOG_FILE) as catalog:
+				self.assertEqual(len(catalog.search("*")), 6)
+				self.assertIn(versions["tar"].offset, [v.offset for v in catalog.versions("src/sub/b.txt", since=1000000000)])
+
+	def test_exclude(self):
+		"""test excluding files and subtrees by pattern, size and cache tag"""
+		with tempfile.TemporaryDirectory() as tmp:
+			make_files(tmp, ["a.txt", "a.pyc", "keep.pyc", "build/x.o", "sub/build/y.txt", "sub/node_modules/m.js",
+			                 "docs/one/tmp/t.txt", "docs/tmp/u.txt", "cache/c.dat", "large.bin"])
+			with open(os.path.join(tmp, "cache", backup_exclude.CACHEDIR_TAG), "wb") as f:
+				f.write(backup_exclude.CACHEDIR_SIGNATURE + b"\n")
+			with open(os.path.join(tmp, "large.bin"), "wb") as f:
+				f.write(bytes(1000))
+			directory = Directory(tmp, "zip", exclude=["node_modules", "/build/", "docs/**/tmp", "# comment", "!keep.pyc"])
+			conf = Configuration("{dirname}", [directory], exclude=["*.pyc"], exclude_size=100, exclude_caches=True)
+			names = lambda: sorted(os.path.relpath(p, tmp) for p in directory.iter_files())
+			# directory rules are added after the global ones, so they can include files again
+			self.assertEqual(names(), ["a.txt", "keep.pyc", "sub/build/y.txt"])
+			conf.exclude_caches, directory.exclude = False, []
+			conf.apply_excludes()
+			self.assertEqual(len(names()), 8)
+
+			excludes = backup_exclude.Excludes(["*.log", "!important.log", "tmp/", "a/**/b", "[!x]?.dat"])
+			self.assertTrue(excludes.excluded("x/debug.log", False))
+			self.assertFalse(excludes.excluded("x/important.log", False))
+			self.assertTrue(excludes.excluded("x/tmp", True))
+			self.assertFalse(excludes.excluded("x/tmp", False))
+			self.assertTrue(excludes.excluded("a/b", False) and excludes.excluded("a/x/y/b", True))
+			self.assertEqual([excludes.excluded(n, False) for n in ["ab.dat", "xb.dat", "abc.dat"]], [True, False, False])
+
+	def test_watch(self):
+		"""test that changes recorded by the watcher are used instead of scanning"""
+		with tempfile.TemporaryDirectory() as tgt, tempfile.TemporaryDirectory() as tmp:
+			make_files(tmp, ["a.txt", "b.txt", "sub/c.txt"])
+			directory = Directory(tmp, "zip", include=True, incremental=True)
+			conf = Configuration(tgt + "/{dirname} {datetime}{inc}", [directory])
+			list(backup_core.perform_backup_iter(conf))
+
+			def wait_for(condition):
+				for _ in range(100):
+					if condition():
+						return True
+					time.sleep(0.05)
+
+			stop = threading.Event()
+			watcher = threading.Thread(target=backup_watch.watch, args=([directory], config.DIRTY_FILE, stop))
+			watcher.start()
+			try:
+				self.assertTrue(wait_for(lambda: tmp in backup_watch.load_dirty(config.DIRTY_FILE)))
+				make_files(tmp, ["b.txt", "new/d.txt"], content="changed\n")
+				os.remove(os.path.join(tmp, "sub/c.txt"))
+				self.assertTrue(wait_for(lambda: {"b.txt", "new", "sub/c.txt"} <=
+				                         backup_watch.load_dirty(config.DIRTY_FILE)[tmp].paths))
+
+				conf.update_includes(backup_watch.load_dirty(config.DIRTY_FILE))
+				self.assertTrue(directory.include)
+				self.assertEqual(sorted(directory.scan()), sorted(backup_scan.scan(tmp)))
+				self.assertEqual(sorted(os.path.relpath(p, tmp) for p in directory.iter_modified()), ["b.txt", "new/d.txt"])
+				list(backup_core.perform_backup_iter(conf))
+				# changes recorded shortly before the backup are looked at once more, but not included
+				conf.update_includes(backup_watch.load_dirty(config.DIRTY_FILE))
+				self.assertFalse(directory.include)
+			finally:
+				stop.set()
+				watcher.join()
+
+			# files excluded since the last backup are left out of the ones taken from the manifest
+			snapshot = backup_watch.scan_dirty(tmp, directory.manifest(), [], backup_exclude.Excludes(["new/", "a.*"]))
+			self.assertEqual([os.path.relpath(e.path, tmp) for e in snapshot], ["b.txt"])
+
+			polling = backup_watch.PollingWatcher({tmp: directory.excludes()}, interval=0)
+			make_files(tmp, ["a.txt"], content="again\n")
+			self.assertEqual(polling.poll(0), [(tmp, "a.txt")])
+
+	def test_parallel_scan(self):
+		"""test that the parallel scan finds the same files in the same order"""
+		with tempfile.TemporaryDirectory() as tmp:
+			benchmark.make_tree(tmp, files=300, depth=3, fanout=3, mean_size=100, seed=3)
+			make_files(tmp, ["skip/x.txt", "dir0/skip/y.txt"])
+			excludes = backup_exclude.Excludes(["skip/"])
+			serial = backup_scan.scan(tmp, excludes=excludes)
+			self.assertEqual(len(serial), 300)
+			self.assertEqual(list(backup_scan.scan(tmp, excludes=excludes, workers=8)), list(serial))
+			self.assertEqual(list(Directory(tmp, "zip", exclude=["skip/"], scan_workers=4).scan()), list(serial))
+			cancel = threading.Event()
+			cancel.set()
+			with self.assertRaises(Cancelled):
+				backup_scan.scan(tmp, cancel, workers=4)
+			self.assertFalse(backup_scan.is_network_path(tmp))
+
+	def test_spilled_snapshot(self):
+		"""test that snapshots spilled to a file and manifests in the order of the scan
+		(also of older, unsorted manifests) find changed and deleted files"""
+		with tempfile.TemporaryDirectory() as tmp:
+			names = ["b.txt", "a/x.txt", "a b/y.txt", "a/sub/z.txt", "\udcff.txt", "c.txt"]
+			make_files(tmp, names)
+			spill_size, backup_scan.SPILL_SIZE = backup_scan.SPILL_SIZE, 100
+			try:
+				directory = Directory(tmp, "zip")
+				snapshot = directory.scan()
+				self.assertEqual(len(snapshot), 6)
+				self.assertEqual([os.path.relpath(e.path, tmp) for e in snapshot],
+				                 ["b.txt", "c.txt", "\udcff.txt", "a/x.txt", "a/sub/z.txt", "a b/y.txt"])
+				self.assertEqual(sorted(snapshot, key=lambda e: backup_scan.scan_key(e.path)), list(snapshot))
+				self.assertEqual([(a, b) for a, b in zip(snapshot, snapshot)], [(e, e) for e in snapshot])
+				# manifest of an older version, not sorted and without device, link count and blocks
+				entries = [(os.path.relpath(e.path, tmp), backup_manifest.ManifestEntry(*e[1:5])) for e in snapshot]
+				os.makedirs(config.MANIFEST_PATH, exist_ok=True)
+				with gzip.open(backup_manifest.manifest_file(tmp), "wb") as f:
+					for name, entry in entries[::-1]:
+						f.write(b"\0".join([os.fsencode(name), *(b"%d" % x for x in entry[:4]), b"", b""]))
+				make_files(tmp, ["a/new.txt"])
+				os.remove(os.path.join(tmp, "a b/y.txt"))
+				conf = Configuration("{dirname}", [directory])
+				conf.update_includes()
+				self.assertTrue(directory.manifest().is_current())
+				self.assertEqual(list(directory.manifest()), [n for n, _ in entries])
+				self.assertEqual([os.path.relpath(p, tmp) for p in directory.iter_modified()], ["a/new.txt"])
+				self.assertEqual([os.path.relpath(p, tmp) for p in directory.deleted_files()], ["a b/y.txt"])
+			finally:
+				backup_scan.SPILL_SIZE = spill_size
+
+	def test_io(self):
+		"""test reading ranges of files with and without mmap, and large buffers"""
+		with tempfile.TemporaryDirectory() as tmp:
+			path = os.path.join(tmp, "data")
+			data = random.Random(0).randbytes(3 * mmap.ALLOCATIONGRANULARITY + 123)
+			with open(path, "wb") as f:
+				f.write(data)
+			threshold = backup_io.MMAP_THRESHOLD
+			try:
+				for backup_io.MMAP_THRESHOLD in [0, 1]:
+					for offset, length in [(0, len(data)), (5000, 70000), (len(data) - 10, 10), (len(data), 0)]:
+						self.assertEqual(backup_io.read_range(path, offset, length), data[offset:offset + length])
+			finally:
+				backup_io.MMAP_THRESHOLD = threshold
+			backup_io.configure(buffer_size=1000, drop_cache=True)
+			with backup_io.open_source(path) as f:
+				self.assertEqual(f.read(100), data[:100])
+				self.assertEqual(f.read(), data[100:])
+			backup_io.configure()
+			self.assertEqual(backup_io.settings.buffer_size, backup_io.DEFAULT_BUFFER)
+			backup_io.sync_files([path])
+
+	def test_benchmark(self):
+		"""test that the benchmark tree is deterministic and the benchmarks run"""
+		with tempfile.TemporaryDirectory() as tmp:
+			sizes = []
+			for name in ["a", "b"]:
+				root = os.path.join(tmp, name)
+				total = benchmark.make_tree(root, files=50, depth=2, fanout=2, seed=7)
+				sizes.append(sorted((os.path.relpath(p, root), os.path.getsize(p))
+				                    for p in Directory(root, "zip").iter_files()))
+				self.assertEqual(total, sum(s for _, s in sizes[-1]))
+			self.assertEqual(sizes[0], sizes[1])
+			results = benchmark.run_benchmarks(os.path.join(tmp, "a"), repeat=1, latency=0.001, rss_files=500)
+			expected = {"scan", "scan_parallel", "scan_latency", "scan_parallel_latency", "startup_cli",
+			            "iter_files", "iter_modified", "update_includes",
+			            "get_size", "create_zip", "create_tar", "incremental", "rss_zip_per_file", "rss_tar_per_file"}
+			self.assertEqual(set(results) - {"startup_gui"}, expected)
+			self.assertLess(results["startup_cli"], 1.0)
+			self.assertLess(results["scan_parallel_latency"], results["scan_latency"])
+
+	def test_directory_stats(self):
+		"""test that the statistics of the last scan are persisted, and the frontend
+		is not imported in command-line mode"""
+		with tempfile.TemporaryDirectory() as tmp:
+			make_files(tmp, ["a.txt", "sub/b.txt"])
+			os.utime(os.path.join(tmp, "a.txt"), (1e9, 1e9))
+			os.utime(os.path.join(tmp, "sub/b.txt"), (2e9, 2e9))
+			directory = Directory(tmp, "zip")
+			self.assertEqual((directory.files, directory.newest_mtime, directory.scanned), (0, -1.0, -1.0))
+			before = time.time()
+			directory.scan()
+			self.assertEqual((directory.files, directory.newest_mtime), (2, 2e9))
+			self.assertGreaterEqual(directory.scanned, before)
+			loaded = load_from_json(write_to_json(Configuration("{dirname}", [directory]))).directories[0]
+			self.assertEqual((loaded.files, loaded.newest_mtime, loaded.scanned),
+			                 (directory.files, directory.newest_mtime, directory.scanned))
+			modules = subprocess.run([sys.executable, "-c", "import sys, main; print(sorted(sys.modules))"],
+			                         cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+			self.assertEqual(modules.returncode, 0, modules.stderr)
+			self.assertNotIn("backup_gtk", modules.stdout)
+
+	def test_scan_snapshot(self):
+		"""test that the snapshot contains regular files only and is reused"""
+		with tempfile.TemporaryDirectory() as tmp:
+			make_files(tmp, ["a.txt", "sub/b.txt", "sub/deeper/c.txt"])
+			os.mkfifo(os.path.join(tmp, "pipe"))
+			os.symlink(os.path.join(tmp, "sub"), os.path.join(tmp, "link"))
+			directory = Directory(tmp, "zip")
+			expected = sorted(os.path.join(d, f) for d, _, fs in os.walk(tmp) for f in fs if f != "pipe")
+			self.assertEqual(sorted(directory.iter_files()), expected)
+			self.assertEqual(backup_core.get_size(directory), "24.0 B")
+			make_files(tmp, ["d.txt"])
+			self.assertEqual(len(list(directory.iter_files())), 3)
+			self.assertEqual(len(directory.scan(refresh=True)), 4)
+			self.assertNotIn("_snapshot", write_to_json(Configuration("{dirname}", [directory])))
+			# cancelled scan raises and keeps the previous snapshot
+			cancel = threading.Event()
+			cancel.set()
+			self.assertRaises(Cancelled, directory.scan, refresh=True, cancel=cancel)
+			self.assertEqual(len(directory.scan()), 4)
 
 
 	"""
@@ -81,5 +929,16 @@ class TestModel(unittest.TestCase):
 	"""
 
 
+def make_files(root, names, content="content\n", mtime=None):
+	"""create files with given relative names and content in the root directory"""
+	for name in names:
+		path = os.path.join(root, name)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "w") as f:
+			f.write(content)
+		if mtime is not None:
+			os.utime(path, (mtime, mtime))
+
+
 if __name__ == "__main__":
 	unittest.main()